@@ -1,69 +1,217 @@
 import boto3
-import click
+import botocore.session
+import json
+import os
+import threading
+import time
 
+from botocore.credentials import RefreshableCredentials
 from datetime import datetime, timedelta
 from prettytable import PrettyTable
-from tqdm import tqdm
+
+from .reporting import REPORTER
+from .resilience import GUARD
+from .telemetry import TELEMETRY, phase
+from .throttling import LIMITER
 
 
 DEBUG = True
 
+IMDSHIFT_HOME = os.path.join(os.path.expanduser('~'), '.imdshift')
+REGION_CACHE_FILE = os.path.join(IMDSHIFT_HOME, 'regions.json')
+REGION_CACHE_TTL = 24 * 60 * 60
+
 
 class AWS_Utils():
 
-    def get_enabled_regions(self, profile=None, role_arn=None):
+    # Enabled regions already resolved in this process, keyed by account
+    enabled_regions_cache = dict()
+
+    # Regions each service is offered in according to botocore's bundled endpoint data, keyed by service
+    supported_regions_cache = dict()
+
+    # Callables applied to every client created by generate_client, e.g. telemetry instrumentation. Rate
+    # limiting comes first, so time spent waiting for a token is not counted as API latency.
+    client_hooks = [LIMITER.install, TELEMETRY.instrument]
+
+    # Sessions and clients are slow to create and safe to share, so they are kept warm for the whole process
+    sessions = dict()
+    clients = dict()
+    client_lock = threading.RLock()
+
+    @classmethod
+    def register_client_hook(cls, hook):
+        if hook not in cls.client_hooks:
+            cls.client_hooks.append(hook)
+            cls.clear_client_cache()
+
+
+    @classmethod
+    def unregister_client_hook(cls, hook):
+        if hook in cls.client_hooks:
+            cls.client_hooks.remove(hook)
+            cls.clear_client_cache()
+
+
+    @classmethod
+    def clear_client_cache(cls):
+        with cls.client_lock:
+            cls.sessions.clear()
+            cls.clients.clear()
+
+
+    def apply_client_hooks(self, client):
+        for hook in self.client_hooks:
+            client = hook(client)
+        return client
+
+
+    def account_key(self, profile=None, role_arn=None):
+        # Same precedence as generate_session, so the key always names the account the session reaches
+        if profile:
+            return f"profile:{profile}"
+        if role_arn:
+            return f"account:{role_arn.split(':')[4]}"
+        # Without a profile, boto3 picks credentials up from the environment, so the key follows it too
+        profile = os.environ.get('AWS_PROFILE') or os.environ.get('AWS_DEFAULT_PROFILE')
+        if profile:
+            return f"profile:{profile}"
+        if os.environ.get('AWS_ACCESS_KEY_ID'):
+            return f"access-key:{os.environ['AWS_ACCESS_KEY_ID']}"
+        return "default"
+
+
+    @classmethod
+    def supported_regions(cls, service):
+        if service not in cls.supported_regions_cache:
+            # Only reads the endpoint data shipped with botocore, no network calls
+            botocore_session = botocore.session.get_session()
+            regions = set()
+            for partition in botocore_session.get_available_partitions():
+                regions.update(botocore_session.get_available_regions(service, partition_name=partition))
+            cls.supported_regions_cache[service] = regions
+        return cls.supported_regions_cache[service]
+
+
+    def regions_for(self, scanner, service, regions):
+        # Regions botocore does not know at all, e.g. launched after this version, are kept and scanned
+        known_regions = self.supported_regions('ec2')
+        offered_regions = self.supported_regions(service)
+
+        result = list()
+        for region in regions or []:
+            if region in known_regions and region not in offered_regions:
+                GUARD.mark(scanner, region, 'skipped', f"{service} is not offered in this region")
+            else:
+                result.append(region)
+        return result
+
+
+    def read_region_cache(self):
+        try:
+            with open(REGION_CACHE_FILE) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return dict()
+
+
+    def write_region_cache(self, key, regions):
+        cache = self.read_region_cache()
+        cache[key] = {'timestamp': time.time(), 'regions': regions}
+        try:
+            os.makedirs(IMDSHIFT_HOME, exist_ok=True)
+            # Written to a temporary file first, so concurrent or interrupted runs never leave a truncated cache
+            with open(f"{REGION_CACHE_FILE}.tmp", 'w') as cache_file:
+                json.dump(cache, cache_file, indent=2)
+            os.replace(f"{REGION_CACHE_FILE}.tmp", REGION_CACHE_FILE)
+        except OSError as error:
+            REPORTER.echo(f'[!] Unable to write region cache: {error}.', fg='yellow')
+
+
+    def get_cached_regions(self, profile=None, role_arn=None, ttl=REGION_CACHE_TTL):
+        key = self.account_key(profile, role_arn)
+        if key in self.enabled_regions_cache:
+            return self.enabled_regions_cache[key]
+
+        entry = self.read_region_cache().get(key)
+        if entry and ttl and time.time() - entry['timestamp'] < ttl:
+            self.enabled_regions_cache[key] = entry['regions']
+            return entry['regions']
+
+        return None
+
+
+    def get_enabled_regions(self, profile=None, role_arn=None, ttl=REGION_CACHE_TTL):
+        cached_regions = self.get_cached_regions(profile, role_arn, ttl)
+        if cached_regions is not None:
+            return cached_regions
+
         client = self.generate_client(resource="ec2", region=None, profile=profile, role_arn=role_arn)
         enabled_regions = [region['RegionName']\
                            for region in client.describe_regions()['Regions']\
                             if region['OptInStatus'] in ["opt-in-not-required", "opted-in"]]
+
+        key = self.account_key(profile, role_arn)
+        self.enabled_regions_cache[key] = enabled_regions
+        if ttl:
+            self.write_region_cache(key, enabled_regions)
         return enabled_regions
 
 
-    def generate_client(self, resource, region=None, profile=None, role_arn=None):
-        try:
-            if region:
-                if profile:
-                    session_obj = boto3.Session(profile_name=profile, region_name=region)
-                elif role_arn:
-                    session_obj = self.assume_role(role_arn, region)
-                else:
-                    session_obj = boto3.Session(region_name=region)
-                return session_obj.client(resource)
-            else:
+    def generate_session(self, profile=None, role_arn=None):
+        with self.client_lock:
+            key = (profile, role_arn)
+            if key not in self.sessions:
                 if profile:
-                    session_obj = boto3.Session(profile_name=profile)
+                    self.sessions[key] = boto3.Session(profile_name=profile)
                 elif role_arn:
-                    session_obj = self.assume_role(role_arn)
+                    self.sessions[key] = self.assume_role(role_arn)
                 else:
-                    session_obj = boto3.Session()
-                return session_obj.client(resource)
+                    self.sessions[key] = boto3.Session()
+            return self.sessions[key]
+
+
+    def generate_client(self, resource, region=None, profile=None, role_arn=None):
+        # Clients depend on the guard's timeouts and retries, which can change between runs
+        key = (resource, region, profile, role_arn, GUARD.call_timeout, GUARD.max_attempts)
+        try:
+            with self.client_lock:
+                if key not in self.clients:
+                    session_obj = self.generate_session(profile, role_arn)
+                    self.clients[key] = self.apply_client_hooks(session_obj.client(resource, region_name=region, config=GUARD.client_config()))
+                return self.clients[key]
         except:
             return None
 
 
-
     def assume_role(self, role_arn, region=None):
         sts = boto3.client("sts")
-        assumed_role_obj = sts.assume_role(
-            RoleArn=role_arn,
-            RoleSessionName="IMDShift"
-        )['Credentials']
-        
-        session = boto3.Session(
-            aws_access_key_id=assumed_role_obj['AccessKeyId'],
-            aws_secret_access_key=assumed_role_obj['SecretAccessKey'],
-            aws_session_token=assumed_role_obj['SessionToken'],
-            region_name=region
-        ) if region else \
-            boto3.Session(
-            aws_access_key_id=assumed_role_obj['AccessKeyId'],
-            aws_secret_access_key=assumed_role_obj['SecretAccessKey'],
-            aws_session_token=assumed_role_obj['SessionToken']
+
+        def refresh():
+            assumed_role_obj = sts.assume_role(
+                RoleArn=role_arn,
+                RoleSessionName="IMDShift"
+            )['Credentials']
+            return {
+                'access_key': assumed_role_obj['AccessKeyId'],
+                'secret_key': assumed_role_obj['SecretAccessKey'],
+                'token': assumed_role_obj['SessionToken'],
+                'expiry_time': assumed_role_obj['Expiration'].isoformat(),
+            }
+
+        # Assumed again shortly before the credentials expire, so a warm session never goes stale
+        botocore_session = botocore.session.get_session()
+        botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+            metadata=refresh(),
+            refresh_using=refresh,
+            method='sts-assume-role'
         )
-        return session
+        return boto3.Session(botocore_session=botocore_session, region_name=region)
     
 class EC2():
     
+    STEPS = ['update_hop_limit', 'enable_metadata', 'set_account_defaults', 'migrate']
+
     def __init__(self, regions=None, profile=None, role_arn=None) -> None:
         self.regions = regions
         self.aws_utils = AWS_Utils()
@@ -75,17 +223,59 @@ class EC2():
         self.resource_with_metadata_disabled = list()
         self.resources_with_hop_limit_1 = list()
         self.imdsv1_usage_analysis = dict()
+        # region -> account level instance metadata defaults, None if they could not be read
+        self.account_defaults = dict()
 
 
     def generate_result(self):
         for region in self.regions:
-            self.process_result(region, self.profile, self.role_arn)
+            GUARD.run('EC2', region, self.process_result, region, self.profile, self.role_arn)
+            GUARD.run('EC2', region, self.fetch_account_defaults, region)
+
+        self.print_account_defaults()
+
+
+    @phase("discovery")
+    def fetch_account_defaults(self, region):
+        ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+        try:
+            self.account_defaults[region] = ec2.get_instance_metadata_defaults()['AccountLevel']
+        except Exception as error:
+            self.account_defaults[region] = None
+            REPORTER.echo(f'[!] Could not read the instance metadata defaults for {region}: {error}.', fg='yellow')
+
+
+    def print_account_defaults(self):
+        if not self.account_defaults:
+            return
+
+        stats_table = PrettyTable()
+        stats_table.align = 'c' 
+        stats_table.valign = 'c' 
+        stats_table.field_names = ['Region', 'HttpTokens', 'Hop Limit', 'Metadata Endpoint', 'Managed By']
+
+        for region, defaults in self.account_defaults.items():
+            if defaults is None:
+                stats_table.add_row([region, 'unknown', 'unknown', 'unknown', 'unknown'])
+                continue
+
+            stats_table.add_row(
+                [
+                    region,
+                    defaults.get('HttpTokens', 'no-preference'),
+                    defaults.get('HttpPutResponseHopLimit', 'no-preference'),
+                    defaults.get('HttpEndpoint', 'no-preference'),
+                    defaults.get('ManagedBy', 'account')
+                ]
+            )
+
+        REPORTER.table(f"[+] Account level instance metadata defaults for new instances:", stats_table)
 
 
     def generate_imdsv1_usage_result(self):
         for region in self.regions:
-            self.process_result(region, self.profile, self.role_arn, analyse_resources_flag=False)
-            self.analyse_imdsv1_usage(region, self.profile, self.role_arn)
+            GUARD.run('EC2', region, self.process_result, region, self.profile, self.role_arn, analyse_resources_flag=False)
+            GUARD.run('EC2', region, self.analyse_imdsv1_usage, region)
 
         stats_table = PrettyTable()
         stats_table.align = 'c' 
@@ -96,18 +286,19 @@ class EC2():
             stats_table.add_row(
                 [
                     region_name,
-                    self.imdsv1_usage_analysis[region]
+                    self.imdsv1_usage_analysis[region_name]
                 ]
             )
         
-        click.echo(f"[+] Statistics for IMDSv1 usage:")
-        click.secho(stats_table.get_string(), bold=True, fg='yellow')
+        REPORTER.table(f"[+] Statistics for IMDSv1 usage:", stats_table)
 
     
+    @phase("discovery")
     def process_result(self, region, profile=None, role_arn=None, analyse_resources_flag=True):
         self.ec2 = self.aws_utils.generate_client("ec2", region, profile, role_arn)
         instances_details = self.ec2.get_paginator('describe_instances')
         for page in instances_details.paginate():
+            GUARD.check()
             for reservation in page['Reservations']:
                 self.resource_list.extend(reservation['Instances'])
 
@@ -115,11 +306,13 @@ class EC2():
             self.analyse_resources()
     
 
+    @phase("usage_check")
     def analyse_imdsv1_usage(self, region):
         self.imdsv1_usage_analysis[region] = 0
-        progress_bar_with_resources = tqdm(self.resource_list, desc=f"[+] Analysing EC2 resources for IMDSv1 usage", colour='green', unit=' resources')
+        progress_bar_with_resources = REPORTER.progress(self.resource_list, desc=f"[+] Analysing EC2 resources for IMDSv1 usage", colour='green', unit=' resources')
         
         for resource in progress_bar_with_resources:
+            GUARD.check()
             cloudwatch_client = self.aws_utils.generate_client('cloudwatch', region=region, profile=self.profile, role_arn=self.role_arn)
             get_metric_data = cloudwatch_client.get_paginator('get_metric_data')
 
@@ -157,9 +350,14 @@ class EC2():
                 self.imdsv1_usage_analysis[region] += 1
 
 
+    @phase("analysis")
     def analyse_resources(self):
 
-        progress_bar_with_resources = tqdm(self.resource_list, desc=f"[+] Analysing EC2 resources", colour='green', unit=' resources')
+        self.resource_with_metadata_disabled = list()
+        self.resources_with_imds_v1 = list()
+        self.resources_with_hop_limit_1 = list()
+
+        progress_bar_with_resources = REPORTER.progress(self.resource_list, desc=f"[+] Analysing EC2 resources", colour='green', unit=' resources')
         
         for resource in progress_bar_with_resources:
             if resource['MetadataOptions']['HttpEndpoint'] == 'disabled':
@@ -187,60 +385,194 @@ class EC2():
 
 
         # click.echo(f"[+] Analysed all EC2 resources")
-        click.echo(f"[+] Statistics from analysis:")
-        click.secho(stats_table.get_string(), bold=True, fg='yellow')
+        REPORTER.table(f"[+] Statistics from analysis:", stats_table)
         
+    @phase("mutation")
     def enable_metadata_for_resources(self, hop_limit=None):
-        click.echo(f"[+] Enabling metadata endpoint for EC2 resources for which it is disabled")
-        progress_bar_with_resources = tqdm(self.resource_with_metadata_disabled, desc=f"[+] Enabling metadata for EC2 resources", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Enabling metadata endpoint for EC2 resources for which it is disabled")
+        progress_bar_with_resources = REPORTER.progress(self.resource_with_metadata_disabled, desc=f"[+] Enabling metadata for EC2 resources", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource['Placement']['AvailabilityZone'][:-1]
+            if not GUARD.claim(region, resource['InstanceId'], 'enable_metadata'):
+                continue
+            if not GUARD.allow('EC2', region, resource=resource['InstanceId']):
+                continue
             ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
-            response = ec2.modify_instance_metadata_options(
-                InstanceId = resource['InstanceId'],
-                HttpTokens = 'required',
-                HttpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                HttpEndpoint = 'enabled',
-                HttpProtocolIpv6 = 'disabled',
-                InstanceMetadataTags = 'disabled'
-            ) 
+            try:
+                response = ec2.modify_instance_metadata_options(
+                    InstanceId = resource['InstanceId'],
+                    **self.metadata_options_change(hop_limit)
+                )
+                GUARD.record_success('EC2', region)
+            except Exception as error:
+                GUARD.record_error('EC2', region, error, resource=resource['InstanceId'])
+                REPORTER.echo(f'[!] An error occurred while updating EC2 resource {resource["InstanceId"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red') 
 
     # ecs_obj.ecs
+    @phase("mutation")
     def update_hop_limit_for_resources(self, hop_limit=None):
-        click.echo(f"[+] Updating hop limit for EC2 resources with metadata enabled")
-        progress_bar_with_resources = tqdm(self.resources_with_hop_limit_1, desc=f"[+] Updating hop limit for EC2 resources to {hop_limit}", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Updating hop limit for EC2 resources with metadata enabled")
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_hop_limit_1, desc=f"[+] Updating hop limit for EC2 resources to {hop_limit}", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource['Placement']['AvailabilityZone'][:-1]
+            if not GUARD.claim(region, resource['InstanceId'], 'update_hop_limit'):
+                continue
+            if not GUARD.allow('EC2', region, resource=resource['InstanceId']):
+                continue
             ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
-            response = ec2.modify_instance_metadata_options(
-                InstanceId = resource['InstanceId'],
-                HttpTokens = 'required',
-                HttpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                HttpEndpoint = 'enabled',
-                HttpProtocolIpv6 = 'disabled',
-                InstanceMetadataTags = 'disabled'
-            )
+            try:
+                response = ec2.modify_instance_metadata_options(
+                    InstanceId = resource['InstanceId'],
+                    **self.metadata_options_change(hop_limit)
+                )
+                GUARD.record_success('EC2', region)
+            except Exception as error:
+                GUARD.record_error('EC2', region, error, resource=resource['InstanceId'])
+                REPORTER.echo(f'[!] An error occurred while updating EC2 resource {resource["InstanceId"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
 
     # Migrate to imdsv2    
+    @phase("mutation")
     def migrate_resources(self, hop_limit=None):
-        click.echo(f"[+] Performing migration of EC2 resources to IMDSv2")
-        progress_bar_with_resources = tqdm(self.resource_list, desc=f"[+] Migrating all EC2 resources to IMDSv2", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Performing migration of EC2 resources to IMDSv2")
+        progress_bar_with_resources = REPORTER.progress(self.migration_targets(hop_limit), desc=f"[+] Migrating all EC2 resources to IMDSv2", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
-            if resource not in self.resource_with_metadata_disabled and resource not in  self.resources_with_hop_limit_1:
-                region = resource['Placement']['AvailabilityZone'][:-1]
-                ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+            region = resource['Placement']['AvailabilityZone'][:-1]
+            if not GUARD.claim(region, resource['InstanceId'], 'migrate'):
+                continue
+            if not GUARD.allow('EC2', region, resource=resource['InstanceId']):
+                continue
+            ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+            try:
                 response = ec2.modify_instance_metadata_options(
                     InstanceId = resource['InstanceId'],
-                    HttpTokens = "required",
-                    HttpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                    HttpEndpoint = 'enabled',
-                    HttpProtocolIpv6 = 'disabled',
-                    InstanceMetadataTags = 'disabled'
+                    **self.metadata_options_change(hop_limit)
                 )
+                GUARD.record_success('EC2', region)
+            except Exception as error:
+                GUARD.record_error('EC2', region, error, resource=resource['InstanceId'])
+                REPORTER.echo(f'[!] An error occurred while migrating EC2 resource {resource["InstanceId"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
+
+
+    @phase("mutation")
+    def set_account_defaults(self, hop_limit=None):
+        REPORTER.echo(f"[+] Setting account level instance metadata defaults to require IMDSv2")
+        progress_bar_with_regions = REPORTER.progress(self.account_defaults_targets(hop_limit), desc=f"[+] Updating instance metadata defaults", colour='green', unit=' regions')
+        for region in progress_bar_with_regions:
+            if not GUARD.allow('EC2', region, resource='account defaults'):
+                continue
+            ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+            try:
+                response = ec2.modify_instance_metadata_defaults(**self.account_defaults_change(hop_limit))
+                GUARD.record_success('EC2', region)
+            except Exception as error:
+                GUARD.record_error('EC2', region, error, resource='account defaults')
+                REPORTER.echo(f'[!] An error occurred while updating instance metadata defaults for {region}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
+
+
+    def account_defaults_change(self, hop_limit=None):
+        return {
+            'HttpTokens': 'required',
+            'HttpPutResponseHopLimit': hop_limit if hop_limit != None else 2,
+        }
+
+
+    def account_defaults_targets(self, hop_limit=None):
+        target = self.account_defaults_change(hop_limit)
+        targets = list()
+
+        for region, defaults in self.account_defaults.items():
+            if defaults is None or all(defaults.get(key) == value for key, value in target.items()):
+                continue
+            # Defaults enforced by a declarative policy can only be changed through the organization
+            if defaults.get('ManagedBy') == 'declarative-policy':
+                REPORTER.echo(f'[!] Instance metadata defaults for {region} are managed by a declarative policy, skipping.', fg='yellow')
+                continue
+            targets.append(region)
+
+        return targets
+
+
+    def metadata_options_change(self, hop_limit=None):
+        return {
+            'HttpTokens': 'required',
+            'HttpPutResponseHopLimit': hop_limit if hop_limit != None else 2,
+            'HttpEndpoint': 'enabled',
+            'HttpProtocolIpv6': 'disabled',
+            'InstanceMetadataTags': 'disabled'
+        }
+
+
+    def migration_targets(self, hop_limit=None):
+        excluded = set(resource['InstanceId'] for resource in self.resource_with_metadata_disabled + self.resources_with_hop_limit_1)
+        target = self.metadata_options_change(hop_limit)
+        targets = list()
+
+        for resource in self.resource_list:
+            if resource['InstanceId'] in excluded:
+                continue
+            # Skip calls that would not change anything
+            if all(resource['MetadataOptions'].get(key) == value for key, value in target.items()):
+                continue
+            targets.append(resource)
+
+        return targets
+
+
+    def findings(self):
+        return [
+            {
+                'region': resource['Placement']['AvailabilityZone'][:-1],
+                'resource': resource['InstanceId'],
+                'kind': 'ec2:instance',
+                'imdsv1': resource['MetadataOptions'].get('HttpTokens') != 'required',
+                'metadata_disabled': resource['MetadataOptions'].get('HttpEndpoint') == 'disabled',
+                'hop_limit': resource['MetadataOptions'].get('HttpPutResponseHopLimit'),
+            }
+            for resource in self.resource_list
+        ]
+
+
+    def planned_changes(self, step, hop_limit=None):
+        if step == 'set_account_defaults':
+            target = self.account_defaults_change(hop_limit)
+            return [
+                {
+                    'region': region,
+                    'resource': 'account defaults',
+                    'operation': 'ec2:ModifyInstanceMetadataDefaults',
+                    'current': {key: self.account_defaults[region].get(key, 'no-preference') for key in target},
+                    'target': target,
+                }
+                for region in self.account_defaults_targets(hop_limit)
+            ]
+
+        targets = {
+            'update_hop_limit': self.resources_with_hop_limit_1,
+            'enable_metadata': self.resource_with_metadata_disabled,
+            'migrate': self.migration_targets(hop_limit),
+        }[step]
+        target = self.metadata_options_change(hop_limit)
+
+        return [
+            {
+                'region': resource['Placement']['AvailabilityZone'][:-1],
+                'resource': resource['InstanceId'],
+                'operation': 'ec2:ModifyInstanceMetadataOptions',
+                'current': {key: resource['MetadataOptions'].get(key) for key in target},
+                'target': target,
+            }
+            for resource in targets
+        ]
 
 
 class Sagemaker():
 
+    STEPS = ['migrate']
+
     def __init__(self, regions=None, profile=None, role_arn=None) -> None:
         self.regions = regions
         self.aws_utils = AWS_Utils()
@@ -251,38 +583,42 @@ class Sagemaker():
         self.resources_with_imds_v1 = list()
         self.resource_with_metadata_disabled = list()
         self.resources_with_hop_limit_1 = list()
+        self.analysed_resources = 0
     
     def generate_result(self):
-        for region in self.regions:
-            self.process_result(region)
+        for region in self.aws_utils.regions_for('Sagemaker', 'sagemaker', self.regions):
+            GUARD.run('Sagemaker', region, self.process_result, region)
     
+    @phase("discovery")
     def process_result(self, region):
-        try:
-            self.sagemaker = self.aws_utils.generate_client("sagemaker", region=region, profile=self.profile, role_arn=self.role_arn)
-            instances_details = self.sagemaker.get_paginator('list_notebook_instances')
-            for page in instances_details.paginate():
-                for instance in page["NotebookInstances"]:
-                    name = instance["NotebookInstanceName"]
-                    self.resource_list.append((name, region))
-            self.analyse_resources()
-        except Exception as error:
-            click.secho(f'[!] An error occurred while listing Sagemaker resources.', bold=True, fg='red')
-            click.secho(f'[!] Error message: {error}.', bold=True, fg='red')
+        self.sagemaker = self.aws_utils.generate_client("sagemaker", region=region, profile=self.profile, role_arn=self.role_arn)
+        instances_details = self.sagemaker.get_paginator('list_notebook_instances')
+        for page in instances_details.paginate():
+            GUARD.check()
+            for instance in page["NotebookInstances"]:
+                name = instance["NotebookInstanceName"]
+                self.resource_list.append((name, region))
+        self.analyse_resources()
 
+    @phase("analysis")
     def analyse_resources(self):
 
-        progress_bar_with_resources = tqdm(self.resource_list, desc=f"[+] Analysing Sagemaker resources", colour='green', unit=' resources')
+        progress_bar_with_resources = REPORTER.progress(self.resource_list[self.analysed_resources:], desc=f"[+] Analysing Sagemaker resources", colour='green', unit=' resources')
+        self.analysed_resources = len(self.resource_list)
 
         for resource in progress_bar_with_resources:
             name = resource[0]
+            GUARD.check()
             try:
                 imds = self.define_metadataservice(name)
                 if imds == "1":
                     self.resources_with_imds_v1.append(resource)
+                GUARD.record_success('Sagemaker', resource[1])
                     
             except Exception as error:
-                click.secho(f'[!] An error occurred while analysing Sagemaker resource.', bold=True, fg='red')
-                click.secho(f'[!] Error message: {error}.\n', bold=True, fg='red')            
+                GUARD.record_error('Sagemaker', resource[1], error, resource=name)
+                REPORTER.echo(f'[!] An error occurred while analysing Sagemaker resource.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')            
 
 
         stats_table = PrettyTable()
@@ -296,15 +632,17 @@ class Sagemaker():
             ]
         )
 
-        click.echo(f"[+] Statistics from analysis:")
-        click.secho(stats_table.get_string(), bold=True, fg='yellow')
+        REPORTER.table(f"[+] Statistics from analysis:", stats_table)
 
-    def migrate_resources(self):
-        click.echo(f"[+] Performing migration of Sagemaker resources to IMDSv2")
-        progress_bar_with_resources = tqdm(self.resources_with_imds_v1, desc=f"[+] Migrating all Sagemaker resources to IMDSv2", colour='green', unit=' resources')
+    @phase("mutation")
+    def migrate_resources(self, hop_limit=None):
+        REPORTER.echo(f"[+] Performing migration of Sagemaker resources to IMDSv2")
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_imds_v1, desc=f"[+] Migrating all Sagemaker resources to IMDSv2", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource[1]
             name = resource[0]
+            if not GUARD.allow('Sagemaker', region, resource=name):
+                continue
             sagemaker = self.aws_utils.generate_client("sagemaker", region=region, profile=self.profile, role_arn=self.role_arn)
             try:
                 resource = sagemaker.update_notebook_instance(
@@ -313,9 +651,37 @@ class Sagemaker():
                             "MinimumInstanceMetadataServiceVersion": '2'
                         }
                     )
+                GUARD.record_success('Sagemaker', region)
             except Exception as error:
-                click.secho(f'[!] An error occurred while analysing Sagemaker resource.', bold=True, fg='red')
-                click.secho(f'[!] Error message: {error}.\n', bold=True, fg='red')            
+                GUARD.record_error('Sagemaker', region, error, resource=name)
+                REPORTER.echo(f'[!] An error occurred while analysing Sagemaker resource.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')            
+
+    def findings(self):
+        return [
+            {
+                'region': region,
+                'resource': name,
+                'kind': 'sagemaker:notebook-instance',
+                'imdsv1': (name, region) in self.resources_with_imds_v1,
+            }
+            for name, region in self.resource_list
+        ]
+
+    def planned_changes(self, step, hop_limit=None):
+        if step != 'migrate':
+            return list()
+
+        return [
+            {
+                'region': region,
+                'resource': name,
+                'operation': 'sagemaker:UpdateNotebookInstance',
+                'current': {'MinimumInstanceMetadataServiceVersion': '1'},
+                'target': {'MinimumInstanceMetadataServiceVersion': '2'},
+            }
+            for name, region in self.resources_with_imds_v1
+        ]
 
     def define_metadataservice(self, name):
         metadata = self.sagemaker.describe_notebook_instance(
@@ -326,32 +692,42 @@ class Sagemaker():
 # Auto Scaling Groups
 class ASG():
 
-    def __init__(self, regions=None, ec2_obj=None, profile=None, role_arn=None):
+    def __init__(self, regions=None, ec2_obj=None, profile=None, role_arn=None, launch_templates=None):
         self.regions = regions
         self.ec2_obj = ec2_obj
+        self.launch_templates = launch_templates
         self.aws_utils = AWS_Utils()
         self.ec2 = None
         self.autoscaling = None
+        self.region = None
         self.profile = profile
         self.role_arn = role_arn    
 
     def generate_results(self):
-        for region in self.regions:
-            self.process_result(region)
+        for region in self.aws_utils.regions_for('ASG', 'autoscaling', self.regions):
+            GUARD.run('ASG', region, self.process_result, region)
 
+    @phase("discovery")
     def process_result(self, region):
+        self.region = region
         self.autoscaling = self.aws_utils.generate_client("autoscaling", region=region, profile=self.profile, role_arn=self.role_arn)
         self.ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
         instances = self.list_asg_instances()
         instance_data = self.asg_instance_data(instances)
-        self.ec2_obj.resource_list = instance_data
+        self.ec2_obj.resource_list.extend(instance_data)
         self.ec2_obj.analyse_resources()
 
+        if self.launch_templates:
+            self.launch_templates.analyse_region(region)
+
     def list_asg_instances(self):
         result = []
         paginator = self.autoscaling.get_paginator('describe_auto_scaling_groups')
         for page in paginator.paginate():
+            GUARD.check()
             for as_group in page["AutoScalingGroups"]:
+                if self.launch_templates:
+                    self.launch_templates.add_auto_scaling_group(self.region, as_group)
                 instances = as_group["Instances"]
                 for instance in instances:
                     instance_id = instance['InstanceId']
@@ -360,6 +736,9 @@ class ASG():
 
     def asg_instance_data(self, instance_ids):
         result = []
+        # Without IDs describe_instances would return every instance in the region
+        if not instance_ids:
+            return result
         paginator = self.ec2.get_paginator('describe_instances')
         for page in paginator.paginate(InstanceIds=instance_ids):
             for reservation in page['Reservations']:
@@ -367,8 +746,358 @@ class ASG():
         return result
 
 
+# Launch templates behind Auto Scaling groups and EKS managed nodegroups
+class LaunchTemplates():
+
+    STEPS = ['migrate_templates']
+
+    def __init__(self, profile=None, role_arn=None) -> None:
+        self.aws_utils = AWS_Utils()
+        self.profile = profile
+        self.role_arn = role_arn
+        # (region, launch template id) -> {'name', 'consumers', 'versions'}
+        self.templates = dict()
+        self.launch_configurations = list()
+        self.eks_managed = list()
+        self.resources_with_imds_v1 = list()
+
+
+    def add_consumer(self, region, template_id, template_name, consumer):
+        template = self.templates.setdefault((region, template_id), {'name': template_name, 'consumers': list(), 'versions': dict()})
+        template['consumers'].append(consumer)
+
+
+    def add_auto_scaling_group(self, region, as_group):
+        name = as_group['AutoScalingGroupName']
+        tags = [tag['Key'] for tag in as_group.get('Tags', [])]
+
+        # Nodegroup templates are owned by EKS, they are handled through the nodegroup instead
+        if 'eks:nodegroup-name' in tags:
+            return
+
+        if 'LaunchTemplate' in as_group:
+            specification = as_group['LaunchTemplate']
+            mixed = False
+        elif 'MixedInstancesPolicy' in as_group:
+            specification = as_group['MixedInstancesPolicy']['LaunchTemplate']['LaunchTemplateSpecification']
+            mixed = True
+        else:
+            if as_group.get('LaunchConfigurationName'):
+                self.launch_configurations.append((region, name, as_group['LaunchConfigurationName']))
+            return
+
+        self.add_consumer(region, specification.get('LaunchTemplateId'), specification.get('LaunchTemplateName'), {
+            'type': 'asg',
+            'name': name,
+            'version': specification.get('Version', '$Default'),
+            'mixed': mixed,
+        })
+
+
+    def add_nodegroup(self, region, nodegroup):
+        launch_template = nodegroup.get('launchTemplate')
+        if not launch_template:
+            self.eks_managed.append((region, nodegroup['clusterName'], nodegroup['nodegroupName']))
+            return
+
+        self.add_consumer(region, launch_template.get('id'), launch_template.get('name'), {
+            'type': 'nodegroup',
+            'name': f"{nodegroup['clusterName']}/{nodegroup['nodegroupName']}",
+            'cluster': nodegroup['clusterName'],
+            'nodegroup': nodegroup['nodegroupName'],
+            'version': str(launch_template.get('version', '$Default')),
+        })
+
+
+    @phase("analysis")
+    def analyse_region(self, region):
+        ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+
+        for (template_region, template_id), template in self.templates.items():
+            if template_region != region or template['versions']:
+                continue
+
+            GUARD.check()
+            requested_versions = sorted(set(consumer['version'] for consumer in template['consumers']))
+            # $Latest is always resolved, migrating an older version changes what it points to
+            parameters = {'Versions': sorted(set(requested_versions) | {'$Latest'})}
+            if template_id:
+                parameters['LaunchTemplateId'] = template_id
+            else:
+                parameters['LaunchTemplateName'] = template['name']
+
+            # One call per template resolves every version its consumers reference, and the newest one
+            versions = ec2.describe_launch_template_versions(**parameters)['LaunchTemplateVersions']
+            for version in versions:
+                template['versions'][str(version['VersionNumber'])] = version
+                if version.get('DefaultVersion'):
+                    template['versions']['$Default'] = version
+            if versions:
+                template['versions']['$Latest'] = max(versions, key=lambda version: version['VersionNumber'])
+
+            for version in set(str(template['versions'][requested]['VersionNumber']) for requested in requested_versions if requested in template['versions']):
+                launch_template_version = template['versions'][version]
+                metadata_options = launch_template_version['LaunchTemplateData'].get('MetadataOptions', dict())
+                if metadata_options.get('HttpTokens') != 'required':
+                    self.resources_with_imds_v1.append((region, launch_template_version['LaunchTemplateId'], int(version)))
+
+        self.resources_with_imds_v1.sort(key=lambda resource: resource[2])
+
+        stats_table = PrettyTable()
+        stats_table.align = 'c' 
+        stats_table.valign = 'c' 
+        stats_table.field_names = ['Launch Templates', 'Template Versions with IMDSv1', 'Launch Configurations', 'EKS Managed Templates']
+        stats_table.add_row(
+            [
+                len(self.templates),
+                len(self.resources_with_imds_v1),
+                len(self.launch_configurations),
+                len(self.eks_managed)
+            ]
+        )
+
+        REPORTER.table(f"[+] Statistics from launch template analysis:", stats_table)
+
+
+    def template_for(self, region, template_id):
+        for (template_region, key), template in self.templates.items():
+            if template_region == region and (key == template_id or template['versions'].get('$Latest', {}).get('LaunchTemplateId') == template_id):
+                return template
+        return None
+
+
+    def consumers_of(self, template, version):
+        return [
+            consumer for consumer in template['consumers']
+            if str(template['versions'].get(consumer['version'], {}).get('VersionNumber')) == str(version)
+        ]
+
+
+    def latest_version(self, template):
+        return template['versions']['$Latest']['VersionNumber']
+
+
+    def metadata_options(self, template, version):
+        return template['versions'][str(version)]['LaunchTemplateData'].get('MetadataOptions', dict())
+
+
+    # Migrated versions keep their metadata endpoint setting unless --enable-imds is also given
+    def metadata_options_change(self, current, hop_limit=None, enable_imds=False):
+        target = dict(current)
+        target.update({
+            'HttpTokens': 'required',
+            'HttpPutResponseHopLimit': hop_limit if hop_limit != None else 2,
+        })
+        if enable_imds:
+            target['HttpEndpoint'] = 'enabled'
+        target.pop('State', None)
+        return target
+
+
+    # Every new version becomes the template's $Latest. Returns the templates whose newest version
+    # has to be published again after older versions were migrated, so $Latest keeps its content.
+    def templates_to_republish(self):
+        migrated = dict()
+        for region, template_id, version in self.resources_with_imds_v1:
+            migrated[(region, template_id)] = max(version, migrated.get((region, template_id), 0))
+
+        republish = list()
+        for (region, template_id), version in migrated.items():
+            template = self.template_for(region, template_id)
+            if version != self.latest_version(template):
+                republish.append((region, template_id, self.latest_version(template)))
+        return republish
+
+
+    def findings(self):
+        result = list()
+        for (region, template_id), template in self.templates.items():
+            for version in sorted(set(version['VersionNumber'] for version in template['versions'].values())):
+                metadata_options = template['versions'][str(version)]['LaunchTemplateData'].get('MetadataOptions', dict())
+                result.append({
+                    'region': region,
+                    'resource': f"{template_id}:{version}",
+                    'kind': 'ec2:launch-template-version',
+                    'imdsv1': (region, template_id, version) in self.resources_with_imds_v1,
+                    'metadata_disabled': metadata_options.get('HttpEndpoint') == 'disabled',
+                    'hop_limit': metadata_options.get('HttpPutResponseHopLimit'),
+                })
+        return result
+
+
+    def latest_consumer_changes(self, region, template, version):
+        # Consumers launching $Latest need no call of their own, they follow the newly published version
+        return [
+            {
+                'region': region,
+                'resource': consumer['name'],
+                'operation': None,
+                'current': {'Version': consumer['version'], 'LaunchTemplateVersion': str(version)},
+                'target': {'Version': consumer['version'], 'LaunchTemplateVersion': 'new'},
+            }
+            for consumer in self.consumers_of(template, version) if consumer['version'] == '$Latest' and consumer['type'] != 'nodegroup'
+        ]
+
+
+    def planned_changes(self, step, hop_limit=None, enable_imds=False):
+        changes = list()
+
+        for region, template_id, version in self.resources_with_imds_v1:
+            template = self.template_for(region, template_id)
+            current = self.metadata_options(template, version)
+            changes.append({
+                'region': region,
+                'resource': f"{template_id}:{version}",
+                'operation': 'ec2:CreateLaunchTemplateVersion',
+                'current': current,
+                'target': self.metadata_options_change(current, hop_limit, enable_imds),
+            })
+
+            for consumer in self.consumers_of(template, version):
+                if consumer['type'] == 'nodegroup':
+                    operation = 'eks:UpdateNodegroupVersion'
+                elif consumer['version'] == '$Default':
+                    operation = 'ec2:ModifyLaunchTemplate'
+                elif consumer['version'] == '$Latest':
+                    continue
+                else:
+                    operation = 'autoscaling:UpdateAutoScalingGroup'
+
+                changes.append({
+                    'region': region,
+                    'resource': template_id if operation == 'ec2:ModifyLaunchTemplate' else consumer['name'],
+                    'operation': operation,
+                    'current': {'Version': consumer['version']},
+                    'target': {'Version': 'new'},
+                })
+
+            changes.extend(self.latest_consumer_changes(region, template, version))
+
+        for region, template_id, version in self.templates_to_republish():
+            template = self.template_for(region, template_id)
+            current = self.metadata_options(template, version)
+            changes.append({
+                'region': region,
+                'resource': f"{template_id}:{version}",
+                'operation': 'ec2:CreateLaunchTemplateVersion',
+                'current': dict(current, Version=str(version)),
+                'target': dict(current, Version='$Latest'),
+            })
+            changes.extend(self.latest_consumer_changes(region, template, version))
+
+        # A template used as $Default by several groups only needs its default version moved once
+        unique_changes = list()
+        for change in changes:
+            if change not in unique_changes:
+                unique_changes.append(change)
+        return unique_changes
+
+
+    def skip_consumers(self, region, template_id, template, version, reason):
+        for consumer in self.consumers_of(template, version):
+            GUARD.skip_resource(region, template_id if consumer['version'] == '$Default' else consumer['name'], reason)
+
+
+    @phase("mutation")
+    def migrate_launch_templates(self, hop_limit=None, enable_imds=False):
+        REPORTER.echo(f"[+] Publishing IMDSv2-only versions of launch templates used by Auto Scaling groups and EKS nodegroups")
+
+        for region, name, launch_configuration in self.launch_configurations:
+            REPORTER.echo(f'[!] Auto Scaling group {name} in {region} uses launch configuration {launch_configuration}, which cannot be updated in place, migrate it to a launch template.', fg='yellow')
+        for region, cluster, nodegroup in self.eks_managed:
+            REPORTER.echo(f'[!] EKS nodegroup {cluster}/{nodegroup} in {region} uses the EKS managed launch template, use a custom launch template to require IMDSv2 for new nodes.', fg='yellow')
+
+        # Oldest source versions first, so a template's newest version is published last and stays its $Latest
+        published = dict()
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_imds_v1, desc=f"[+] Migrating launch templates to IMDSv2", colour='green', unit=' templates')
+        for region, template_id, version in progress_bar_with_resources:
+            template = self.template_for(region, template_id)
+            if not GUARD.allow('LaunchTemplates', region, resource=f"{template_id}:{version}"):
+                self.skip_consumers(region, template_id, template, version, 'launch template version was not created')
+                continue
+
+            current = self.metadata_options(template, version)
+            ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+
+            try:
+                new_version = ec2.create_launch_template_version(
+                    LaunchTemplateId = template_id,
+                    SourceVersion = str(version),
+                    VersionDescription = 'IMDShift: require IMDSv2',
+                    LaunchTemplateData = {'MetadataOptions': self.metadata_options_change(current, hop_limit, enable_imds)}
+                )['LaunchTemplateVersion']['VersionNumber']
+                published[(region, template_id)] = version
+
+                default_updated = False
+                for consumer in self.consumers_of(template, version):
+                    if consumer['type'] == 'nodegroup':
+                        # Rolls the nodegroup onto the new version
+                        eks = self.aws_utils.generate_client("eks", region=region, profile=self.profile, role_arn=self.role_arn)
+                        eks.update_nodegroup_version(
+                            clusterName = consumer['cluster'],
+                            nodegroupName = consumer['nodegroup'],
+                            launchTemplate = {'id': template_id, 'version': str(new_version)}
+                        )
+
+                    elif consumer['version'] == '$Default':
+                        if not default_updated:
+                            ec2.modify_launch_template(LaunchTemplateId=template_id, DefaultVersion=str(new_version))
+                            default_updated = True
+
+                    elif consumer['version'] != '$Latest':
+                        autoscaling = self.aws_utils.generate_client("autoscaling", region=region, profile=self.profile, role_arn=self.role_arn)
+                        specification = {'LaunchTemplateId': template_id, 'Version': str(new_version)}
+                        if consumer['mixed']:
+                            autoscaling.update_auto_scaling_group(
+                                AutoScalingGroupName = consumer['name'],
+                                MixedInstancesPolicy = {'LaunchTemplate': {'LaunchTemplateSpecification': specification}}
+                            )
+                        else:
+                            autoscaling.update_auto_scaling_group(AutoScalingGroupName=consumer['name'], LaunchTemplate=specification)
+
+                GUARD.record_success('LaunchTemplates', region)
+
+            except Exception as error:
+                GUARD.record_error('LaunchTemplates', region, error, resource=f"{template_id}:{version}")
+                self.skip_consumers(region, template_id, template, version, str(error))
+                REPORTER.echo(f'[!] An error occurred while migrating launch template {template_id} version {version}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
+
+        for (region, template_id), source in published.items():
+            template = self.template_for(region, template_id)
+            if source != self.latest_version(template):
+                self.republish_latest(region, template_id, template)
+
+
+    # An older version was published last, publishing the previous $Latest again puts its content back
+    def republish_latest(self, region, template_id, template):
+        version = self.latest_version(template)
+        ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
+
+        try:
+            # The source version's data is copied as it is, nothing needs to be overridden
+            ec2.create_launch_template_version(
+                LaunchTemplateId = template_id,
+                SourceVersion = str(version),
+                VersionDescription = f'IMDShift: version {version} as $Latest',
+                LaunchTemplateData = dict()
+            )
+            GUARD.record_success('LaunchTemplates', region)
+
+        except Exception as error:
+            GUARD.record_error('LaunchTemplates', region, error, resource=f"{template_id}:{version}")
+            for consumer in self.consumers_of(template, version):
+                if consumer['version'] == '$Latest':
+                    GUARD.skip_resource(region, consumer['name'], f"$Latest now points to a migrated older version: {error}")
+            REPORTER.echo(f'[!] An error occurred while publishing launch template {template_id} version {version} as $Latest again, $Latest now launches a migrated older version.', bold=True, fg='red')
+            REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
+
+
+
 class Lightsail():
 
+    STEPS = ['update_hop_limit', 'enable_metadata', 'migrate']
+
     def __init__(self, regions=None, profile=None, role_arn=None) -> None:
         self.regions = regions
         self.aws_utils = AWS_Utils()
@@ -381,27 +1110,29 @@ class Lightsail():
         self.resources_with_hop_limit_1 = list()
     
     def generate_result(self):
-        for region in self.regions:
-            self.process_result(region, self.profile, self.role_arn)
+        for region in self.aws_utils.regions_for('Lightsail', 'lightsail', self.regions):
+            GUARD.run('Lightsail', region, self.process_result, region, self.profile, self.role_arn)
     
+    @phase("discovery")
     def process_result(self, region, profile=None, role_arn=None):
-        try:
-            self.lightsail = self.aws_utils.generate_client("lightsail", region, profile, role_arn)
-            instances_details = self.lightsail.get_paginator('get_instances')
-            for page in instances_details.paginate():
-                for key in page:
-                    if key == 'instances':
-                        self.resource_list.extend(page['instances'])
+        self.lightsail = self.aws_utils.generate_client("lightsail", region, profile, role_arn)
+        instances_details = self.lightsail.get_paginator('get_instances')
+        for page in instances_details.paginate():
+            GUARD.check()
+            for key in page:
+                if key == 'instances':
+                    self.resource_list.extend(page['instances'])
 
-            self.analyse_resources()
-        
-        except Exception as error:
-            click.secho(f'[!] An error occurred while listing Lightsail resources.', bold=True, fg='red')
-            click.secho(f'[!] Error message: {error}.', bold=True, fg='red')
+        self.analyse_resources()
 
+    @phase("analysis")
     def analyse_resources(self):
 
-        progress_bar_with_resources = tqdm(self.resource_list, desc=f"[+] Analysing Lightsail resources", colour='green', unit=' resources')
+        self.resource_with_metadata_disabled = list()
+        self.resources_with_imds_v1 = list()
+        self.resources_with_hop_limit_1 = list()
+
+        progress_bar_with_resources = REPORTER.progress(self.resource_list, desc=f"[+] Analysing Lightsail resources", colour='green', unit=' resources')
         
         for resource in progress_bar_with_resources:
 
@@ -417,8 +1148,8 @@ class Lightsail():
                     self.resources_with_hop_limit_1.append(resource)
 
             except KeyError as error:
-                click.secho(f'[!] An error occurred while analysing Lightsail resource.', bold=True, fg='red')
-                click.secho(f'[!] Error message: {error}.\n', bold=True, fg='red')            
+                REPORTER.echo(f'[!] An error occurred while analysing Lightsail resource.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')            
 
 
         stats_table = PrettyTable()
@@ -434,52 +1165,112 @@ class Lightsail():
             ]
         )
 
-        click.echo(f"[+] Statistics from analysis:")
-        click.secho(stats_table.get_string(), bold=True, fg='yellow')
+        REPORTER.table(f"[+] Statistics from analysis:", stats_table)
 
+    @phase("mutation")
     def enable_metadata_for_resources(self, hop_limit=None):
-        click.echo(f"[+] Enabling metadata endpoint for Lightsail resources for which it is disabled")
-        progress_bar_with_resources = tqdm(self.resource_with_metadata_disabled, desc=f"[+] Enabling metadata for Lightsail resources", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Enabling metadata endpoint for Lightsail resources for which it is disabled")
+        progress_bar_with_resources = REPORTER.progress(self.resource_with_metadata_disabled, desc=f"[+] Enabling metadata for Lightsail resources", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource['location']['regionName']
+            if not GUARD.allow('Lightsail', region, resource=resource['name']):
+                continue
             lightsail = self.aws_utils.generate_client("lightsail", region=region, profile=self.profile, role_arn=self.role_arn)
-            response = lightsail.update_instance_metadata_options(
-                instanceName = resource['name'],
-                httpTokens = 'required',
-                httpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                httpEndpoint = 'enabled',
-                httpProtocolIpv6 = 'disabled',
-            ) 
+            try:
+                response = lightsail.update_instance_metadata_options(
+                    instanceName = resource['name'],
+                    **self.metadata_options_change(hop_limit)
+                )
+                GUARD.record_success('Lightsail', region)
+            except Exception as error:
+                GUARD.record_error('Lightsail', region, error, resource=resource['name'])
+                REPORTER.echo(f'[!] An error occurred while updating Lightsail resource {resource["name"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red') 
 
     
+    @phase("mutation")
     def update_hop_limit_for_resources(self, hop_limit=None):
-        click.echo(f"[+] Updating hop limit for Lightsail resources with metadata enabled")
-        progress_bar_with_resources = tqdm(self.resources_with_hop_limit_1, desc=f"[+] Updating hop limit for Lightsail resources to {hop_limit}", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Updating hop limit for Lightsail resources with metadata enabled")
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_hop_limit_1, desc=f"[+] Updating hop limit for Lightsail resources to {hop_limit}", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource['location']['regionName']
+            if not GUARD.allow('Lightsail', region, resource=resource['name']):
+                continue
             lightsail = self.aws_utils.generate_client("lightsail", region=region, profile=self.profile, role_arn=self.role_arn)
-            response = lightsail.update_instance_metadata_options(
-                instanceName = resource['name'],
-                httpTokens = 'required',
-                httpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                httpEndpoint = 'enabled',
-                httpProtocolIpv6 = 'disabled',
-            )
+            try:
+                response = lightsail.update_instance_metadata_options(
+                    instanceName = resource['name'],
+                    **self.metadata_options_change(hop_limit)
+                )
+                GUARD.record_success('Lightsail', region)
+            except Exception as error:
+                GUARD.record_error('Lightsail', region, error, resource=resource['name'])
+                REPORTER.echo(f'[!] An error occurred while updating Lightsail resource {resource["name"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
 
 
+    @phase("mutation")
     def migrate_resources(self, hop_limit=None):
-        click.echo(f"[+] Performing migration of Lightsail resources to IMDSv2")
-        progress_bar_with_resources = tqdm(self.resources_with_imds_v1, desc=f"[+] Migrating all Lightsail resources to IMDSv2", colour='green', unit=' resources')
+        REPORTER.echo(f"[+] Performing migration of Lightsail resources to IMDSv2")
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_imds_v1, desc=f"[+] Migrating all Lightsail resources to IMDSv2", colour='green', unit=' resources')
         for resource in progress_bar_with_resources:
             region = resource['location']['regionName']
+            if not GUARD.allow('Lightsail', region, resource=resource['name']):
+                continue
             lightsail = self.aws_utils.generate_client("lightsail", region=region, profile=self.profile, role_arn=self.role_arn)
-            response = lightsail.update_instance_metadata_options(
-                instanceName = resource['name'],
-                httpTokens = 'required',
-                httpPutResponseHopLimit = hop_limit if hop_limit != None else 2,
-                httpEndpoint = 'enabled',
-                httpProtocolIpv6 = 'disabled',
-            )
+            try:
+                response = lightsail.update_instance_metadata_options(
+                    instanceName = resource['name'],
+                    **self.metadata_options_change(hop_limit)
+                )
+                GUARD.record_success('Lightsail', region)
+            except Exception as error:
+                GUARD.record_error('Lightsail', region, error, resource=resource['name'])
+                REPORTER.echo(f'[!] An error occurred while migrating Lightsail resource {resource["name"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
+
+
+    def metadata_options_change(self, hop_limit=None):
+        return {
+            'httpTokens': 'required',
+            'httpPutResponseHopLimit': hop_limit if hop_limit != None else 2,
+            'httpEndpoint': 'enabled',
+            'httpProtocolIpv6': 'disabled',
+        }
+
+
+    def findings(self):
+        return [
+            {
+                'region': resource['location']['regionName'],
+                'resource': resource['name'],
+                'kind': 'lightsail:instance',
+                'imdsv1': resource.get('metadataOptions', dict()).get('httpTokens') != 'required',
+                'metadata_disabled': resource.get('metadataOptions', dict()).get('httpEndpoint') == 'disabled',
+                'hop_limit': resource.get('metadataOptions', dict()).get('httpPutResponseHopLimit'),
+            }
+            for resource in self.resource_list
+        ]
+
+
+    def planned_changes(self, step, hop_limit=None):
+        targets = {
+            'update_hop_limit': self.resources_with_hop_limit_1,
+            'enable_metadata': self.resource_with_metadata_disabled,
+            'migrate': self.resources_with_imds_v1,
+        }[step]
+        target = self.metadata_options_change(hop_limit)
+
+        return [
+            {
+                'region': resource['location']['regionName'],
+                'resource': resource['name'],
+                'operation': 'lightsail:UpdateInstanceMetadataOptions',
+                'current': {key: resource['metadataOptions'].get(key) for key in target},
+                'target': target,
+            }
+            for resource in targets
+        ]
 
 
 # Elastic Container Service
@@ -494,22 +1285,24 @@ class ECS():
         self.profile = profile
         self.role_arn = role_arn
 
+    @phase("discovery")
     def process_result(self, region):
         self.ec2 = self.aws_utils.generate_client(resource="ec2", region=region, profile=self.profile, role_arn=self.role_arn)
         self.ecs = self.aws_utils.generate_client(resource="ecs", region=region, profile=self.profile, role_arn=self.role_arn)
         clusters = self.list_clusters()
         instance_data = self.container_instance_data(clusters)
-        self.ec2_obj.resource_list = instance_data
+        self.ec2_obj.resource_list.extend(instance_data)
         self.ec2_obj.analyse_resources()
 
     def generate_results(self):
-        for region in self.regions:
-            self.process_result(region)
+        for region in self.aws_utils.regions_for('ECS', 'ecs', self.regions):
+            GUARD.run('ECS', region, self.process_result, region)
 
     def list_clusters(self):
         result = []
         paginator = self.ecs.get_paginator('list_clusters')
         for page in paginator.paginate():
+            GUARD.check()
             result.extend(page['clusterArns'])
         return result
 
@@ -518,6 +1311,7 @@ class ECS():
         for cluster in clusters:
             paginator = self.ecs.get_paginator('list_container_instances')
             for page in paginator.paginate(cluster=cluster):
+                GUARD.check()
                 container_instance_arns = page['containerInstanceArns']
                 if container_instance_arns:
                     describe_instances = self.ecs.describe_container_instances(cluster=cluster, containerInstances=container_instance_arns)['containerInstances']
@@ -530,9 +1324,11 @@ class ECS():
 # Elastic Kubernetes Service
 class EKS():
 
-    def __init__(self, regions=None, ec2_obj=None, profile=None, role_arn=None):
+    def __init__(self, regions=None, ec2_obj=None, profile=None, role_arn=None, launch_templates=None):
         self.regions = regions
         self.ec2_obj = ec2_obj
+        self.launch_templates = launch_templates
+        self.region = None
         self.aws_utils = AWS_Utils()
         self.ec2 = None
         self.eks = None
@@ -541,22 +1337,28 @@ class EKS():
         self.role_arn = role_arn
 
     def generate_results(self):
-        for region in self.regions:
-            self.process_result(region)
+        for region in self.aws_utils.regions_for('EKS', 'eks', self.regions):
+            GUARD.run('EKS', region, self.process_result, region)
     
+    @phase("discovery")
     def process_result(self, region):
+        self.region = region
         self.eks = self.aws_utils.generate_client(resource="eks", region=region, profile=self.profile, role_arn=self.role_arn)
         self.ec2 = self.aws_utils.generate_client(resource="ec2", region=region, profile=self.profile, role_arn=self.role_arn)
-        self.autoscaling = self.aws_utils.generate_client("autoscaling", region)
+        self.autoscaling = self.aws_utils.generate_client("autoscaling", region=region, profile=self.profile, role_arn=self.role_arn)
         clusters = self.list_clusters()
         instance_data = self.eks_nodegroups(clusters)
-        self.ec2_obj.resource_list = instance_data
+        self.ec2_obj.resource_list.extend(instance_data)
         self.ec2_obj.analyse_resources()
 
+        if self.launch_templates:
+            self.launch_templates.analyse_region(region)
+
     def list_clusters(self):
         result = []
         paginator = self.eks.get_paginator('list_clusters')
         for page in paginator.paginate():
+            GUARD.check()
             result.extend(page['clusters'])
         return result
 
@@ -566,7 +1368,10 @@ class EKS():
             paginator = self.eks.get_paginator('list_nodegroups')
             for page in paginator.paginate(clusterName=cluster):
                 for node_group_name in page['nodegroups']:
+                    GUARD.check()
                     node_group_details = self.eks.describe_nodegroup(clusterName=cluster, nodegroupName=node_group_name)
+                    if self.launch_templates:
+                        self.launch_templates.add_nodegroup(self.region, node_group_details["nodegroup"])
                     auto_scaling_groups = node_group_details["nodegroup"]["resources"]["autoScalingGroups"]
                     for asg in auto_scaling_groups:
                         asg_details = self.autoscaling.describe_auto_scaling_groups(AutoScalingGroupNames=[asg["name"]])["AutoScalingGroups"][0]["Instances"]
@@ -576,6 +1381,9 @@ class EKS():
 
     def process_instancedata(self, instance_ids):
         result = []
+        # Without IDs describe_instances would return every instance in the region
+        if not instance_ids:
+            return result
         paginator = self.ec2.get_paginator('describe_instances')
         for page in paginator.paginate(InstanceIds=instance_ids):
             for reservation in page['Reservations']:
@@ -584,28 +1392,184 @@ class EKS():
 
 class Beanstalk():
 
-    def __init__(self) -> None:
-        ...
+    STEPS = ['migrate_environments']
 
+    # describe_instances accepts at most 200 values per filter
+    INSTANCE_BATCH_SIZE = 200
 
-    def list_resources(self):
-        ...
+    def __init__(self, regions=None, ec2_obj=None, profile=None, role_arn=None) -> None:
+        self.regions = regions
+        self.ec2_obj = ec2_obj
+        self.aws_utils = AWS_Utils()
+        self.ec2 = None
+        self.elasticbeanstalk = None
+        self.profile = profile
+        self.role_arn = role_arn
+        self.environments = list()
+        self.resources_with_imds_v1 = list()
 
 
-    def analyse_resources(self):
-        ...
+    def generate_results(self):
+        for region in self.aws_utils.regions_for('Beanstalk', 'elasticbeanstalk', self.regions):
+            GUARD.run('Beanstalk', region, self.process_result, region)
 
 
-    def enable_metadata_for_resources(self):
-        ...
+    @phase("discovery")
+    def process_result(self, region):
+        self.elasticbeanstalk = self.aws_utils.generate_client("elasticbeanstalk", region=region, profile=self.profile, role_arn=self.role_arn)
+        self.ec2 = self.aws_utils.generate_client("ec2", region=region, profile=self.profile, role_arn=self.role_arn)
 
-    
-    def update_hop_limit_for_resources(self):
-        ...
+        environments = self.list_environments(region)
+        self.environment_settings(environments)
+        instance_ids = self.environment_instances(environments)
+        self.ec2_obj.resource_list.extend(self.instance_data(instance_ids))
+        self.ec2_obj.analyse_resources()
+        self.analyse_resources(environments)
+
+
+    def list_environments(self, region):
+        result = []
+        paginator = self.elasticbeanstalk.get_paginator('describe_environments')
+        for page in paginator.paginate(IncludeDeleted=False, PaginationConfig={'PageSize': 1000}):
+            GUARD.check()
+            for environment in page['Environments']:
+                # Worker and web server environments run on EC2, anything terminating has nothing left to migrate
+                if environment['Status'] in ['Terminating', 'Terminated']:
+                    continue
+                result.append({
+                    'region': region,
+                    'EnvironmentId': environment['EnvironmentId'],
+                    'EnvironmentName': environment['EnvironmentName'],
+                    'ApplicationName': environment['ApplicationName'],
+                    'Status': environment['Status'],
+                    'InstanceIds': list(),
+                })
+        return result
+
+
+    # Replacement instances launch with IMDSv1 unless DisableIMDSv1 is set, whatever the current instances use
+    def environment_settings(self, environments):
+        for environment in environments:
+            GUARD.check()
+            settings = self.elasticbeanstalk.describe_configuration_settings(
+                ApplicationName = environment['ApplicationName'],
+                EnvironmentName = environment['EnvironmentName']
+            )['ConfigurationSettings']
+            environment['DisableIMDSv1'] = 'false'
+            for option in (option for setting in settings for option in setting.get('OptionSettings', [])):
+                if option.get('Namespace') == 'aws:autoscaling:launchconfiguration' and option.get('OptionName') == 'DisableIMDSv1':
+                    environment['DisableIMDSv1'] = str(option.get('Value', 'false')).lower()
+
+
+    def environment_instances(self, environments):
+        result = []
+        for environment in environments:
+            GUARD.check()
+            resources = self.elasticbeanstalk.describe_environment_resources(EnvironmentId=environment['EnvironmentId'])['EnvironmentResources']
+            environment['InstanceIds'] = [instance['Id'] for instance in resources['Instances']]
+            result.extend(environment['InstanceIds'])
+        return result
 
 
-    def migrate_resources(self):
-        ...
+    def instance_data(self, instance_ids):
+        result = []
+        paginator = self.ec2.get_paginator('describe_instances')
+        # A filter, unlike InstanceIds, does not fail the whole batch when an instance has just been replaced
+        for index in range(0, len(instance_ids), self.INSTANCE_BATCH_SIZE):
+            batch = instance_ids[index:index + self.INSTANCE_BATCH_SIZE]
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': batch}]):
+                GUARD.check()
+                for reservation in page['Reservations']:
+                    result.extend(reservation['Instances'])
+        return result
+
+
+    @phase("analysis")
+    def analyse_resources(self, environments):
+        for environment in environments:
+            self.environments.append(environment)
+            if environment['DisableIMDSv1'] != 'true':
+                self.resources_with_imds_v1.append(environment)
+
+        stats_table = PrettyTable()
+        stats_table.align = 'c' 
+        stats_table.valign = 'c' 
+        stats_table.field_names = ['Environments with IMDSv1', 'Total Environments']
+        stats_table.add_row(
+            [
+                len(self.resources_with_imds_v1),
+                len(self.environments)
+            ]
+        )
+
+        REPORTER.table(f"[+] Statistics from Beanstalk environment analysis:", stats_table)
+
+
+    def option_settings_change(self):
+        return [
+            {
+                'Namespace': 'aws:autoscaling:launchconfiguration',
+                'OptionName': 'DisableIMDSv1',
+                'Value': 'true'
+            }
+        ]
+
+
+    def findings(self):
+        return [
+            {
+                'region': environment['region'],
+                'resource': environment['EnvironmentName'],
+                'kind': 'elasticbeanstalk:environment',
+                'imdsv1': environment in self.resources_with_imds_v1,
+            }
+            for environment in self.environments
+        ]
+
+
+    def planned_changes(self, step, hop_limit=None):
+        if step != 'migrate_environments':
+            return list()
+
+        return [
+            {
+                'region': environment['region'],
+                'resource': environment['EnvironmentName'],
+                'operation': 'elasticbeanstalk:UpdateEnvironment',
+                'current': {'DisableIMDSv1': environment['DisableIMDSv1']},
+                'target': {'DisableIMDSv1': 'true'},
+            }
+            for environment in self.resources_with_imds_v1
+        ]
+
+
+    # Sets DisableIMDSv1 on the environment, Beanstalk then replaces its instances
+    @phase("mutation")
+    def migrate_environments(self, hop_limit=None):
+        REPORTER.echo(f"[+] Disabling IMDSv1 for Beanstalk environments")
+        progress_bar_with_resources = REPORTER.progress(self.resources_with_imds_v1, desc=f"[+] Updating Beanstalk environments", colour='green', unit=' environments')
+        for environment in progress_bar_with_resources:
+            region = environment['region']
+            if not GUARD.allow('Beanstalk', region, resource=environment['EnvironmentName']):
+                continue
+
+            # Environments that are being updated reject further updates
+            if environment['Status'] != 'Ready':
+                REPORTER.echo(f'[!] Beanstalk environment {environment["EnvironmentName"]} is {environment["Status"]}, skipping.', fg='yellow')
+                GUARD.skip_resource(region, environment['EnvironmentName'], f"environment is {environment['Status']}")
+                continue
+
+            elasticbeanstalk = self.aws_utils.generate_client("elasticbeanstalk", region=region, profile=self.profile, role_arn=self.role_arn)
+            try:
+                response = elasticbeanstalk.update_environment(
+                    EnvironmentId = environment['EnvironmentId'],
+                    OptionSettings = self.option_settings_change()
+                )
+                GUARD.record_success('Beanstalk', region)
+            except Exception as error:
+                GUARD.record_error('Beanstalk', region, error, resource=environment['EnvironmentName'])
+                REPORTER.echo(f'[!] An error occurred while updating Beanstalk environment {environment["EnvironmentName"]}.', bold=True, fg='red')
+                REPORTER.echo(f'[!] Error message: {error}.\n', bold=True, fg='red')
 
 
 if __name__ == '__main__':
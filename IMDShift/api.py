@@ -0,0 +1,176 @@
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from .AWS import AWS_Utils, REGION_CACHE_TTL
+from .planner import Planner, Change
+from .reporting import REPORTER, CallbackReporter, ProgressEvent
+from .resilience import GUARD
+from .snapshots import SNAPSHOT_DIR, save_snapshot
+from .utilities import SERVICES_LIST, ScanRegion, scan_service, remediate
+
+
+# In-process entry points: nothing is printed, nothing exits, progress is streamed to an optional
+# callback as ProgressEvents. Sessions and clients stay warm in AWS_Utils between calls.
+ProgressCallback = Callable[[ProgressEvent], None]
+
+
+@dataclass
+class Resource:
+    # The service it was scanned for, e.g. "ASG" for the instances of an Auto Scaling group
+    service: str
+    region: str
+    resource: str
+    kind: str
+    imdsv1: bool
+    metadata_disabled: bool = False
+    hop_limit: Optional[int] = None
+
+
+@dataclass
+class RegionStatus:
+    service: str
+    region: str
+    status: str
+    reason: str
+
+
+@dataclass
+class ScanResult:
+    services: list
+    regions: list
+    profile: Optional[str] = None
+    role_arn: Optional[str] = None
+    resources: list = field(default_factory=list)
+    # region -> account level instance metadata defaults, when EC2 was scanned
+    account_defaults: dict = field(default_factory=dict)
+    incomplete: list = field(default_factory=list)
+    scanners: dict = field(default_factory=dict, repr=False)
+
+    @property
+    def imdsv1(self):
+        return [resource for resource in self.resources if resource.imdsv1]
+
+
+@dataclass
+class PlanResult:
+    changes: list = field(default_factory=list)
+    estimates: list = field(default_factory=list)
+    mutation_seconds: float = 0.0
+
+
+@dataclass
+class ChangeOutcome:
+    change: Change
+    # 'applied', 'failed' or 'skipped'
+    status: str
+    reason: Optional[str] = None
+
+
+@dataclass
+class ApplyResult:
+    outcomes: list = field(default_factory=list)
+    incomplete: list = field(default_factory=list)
+
+    @property
+    def applied(self):
+        return [outcome for outcome in self.outcomes if outcome.status == 'applied']
+
+    @property
+    def failed(self):
+        return [outcome for outcome in self.outcomes if outcome.status == 'failed']
+
+    @property
+    def skipped(self):
+        return [outcome for outcome in self.outcomes if outcome.status == 'skipped']
+
+
+def normalise_services(services):
+    if isinstance(services, str):
+        services = services.split(',')
+    services = [service.strip().upper() for service in services]
+
+    unsupported = [service for service in services if service not in SERVICES_LIST]
+    if unsupported:
+        raise ValueError(f"Unsupported services: {', '.join(unsupported)}")
+    return services
+
+
+def region_statuses():
+    return [RegionStatus(service, region, status, reason) for (service, region), (status, reason) in sorted(GUARD.report.items())]
+
+
+def collect_resources(scanners_by_service):
+    resources = list()
+    for service, scanners in scanners_by_service.items():
+        for scanner in scanners:
+            resources.extend(Resource(service=service, **finding) for finding in scanner.findings())
+    return resources
+
+
+def scan(services, regions='ALL', exclude_regions=None, profile=None, role_arn=None,
+         region_cache_ttl=REGION_CACHE_TTL, progress: Optional[ProgressCallback] = None) -> ScanResult:
+    services = normalise_services(services)
+
+    # Each call gets its own guard, so concurrent calls do not reset each other's state
+    with REPORTER.use(CallbackReporter(progress)), GUARD.use(GUARD.fresh()):
+        scan_regions = ScanRegion(included_regions=regions, excluded_regions=exclude_regions, profile=profile,
+                                  role_arn=role_arn, region_cache_ttl=region_cache_ttl).result()
+        result = ScanResult(services=services, regions=scan_regions, profile=profile, role_arn=role_arn)
+
+        for service in SERVICES_LIST:
+            if service not in services:
+                continue
+
+            scanners = scan_service(service, regions=scan_regions, profile=profile, role_arn=role_arn)
+            result.scanners[service] = scanners
+            result.resources.extend(collect_resources({service: scanners}))
+            for scanner in scanners:
+                result.account_defaults.update(getattr(scanner, 'account_defaults', dict()))
+
+        result.incomplete = region_statuses()
+
+    return result
+
+
+def plan(scan_result, migrate=True, update_hop_limit=None, enable_imds=False, migrate_templates=False,
+         set_account_defaults=False, max_concurrency=1, progress: Optional[ProgressCallback] = None) -> PlanResult:
+    planner = Planner(role_arn=scan_result.role_arn, max_concurrency=max_concurrency)
+
+    with REPORTER.use(CallbackReporter(progress)):
+        for service, scanners in scan_result.scanners.items():
+            remediate(service, scanners, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults, planner)
+
+    estimates = planner.estimates()
+    return PlanResult(changes=list(planner.changes), estimates=estimates, mutation_seconds=planner.mutation_seconds(estimates))
+
+
+# Stores the scan as a columnar snapshot for trend stats, needs the optional NumPy dependency
+def snapshot(scan_result, directory=SNAPSHOT_DIR) -> str:
+    account = AWS_Utils().account_key(scan_result.profile, scan_result.role_arn)
+    return save_snapshot(scan_result.resources, account, directory=directory)
+
+
+# Applies the changes plan() would list for the same arguments. The scan result describes the
+# resources as they were before, scan again to see the new state.
+def apply(scan_result, migrate=True, update_hop_limit=None, enable_imds=False, migrate_templates=False,
+          set_account_defaults=False, progress: Optional[ProgressCallback] = None) -> ApplyResult:
+    planned = plan(scan_result, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults, progress=progress)
+
+    with REPORTER.use(CallbackReporter(progress)), GUARD.use(GUARD.fresh()):
+        for service, scanners in scan_result.scanners.items():
+            remediate(service, scanners, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults)
+
+        failures = {(region, resource): reason for region, resource, reason in GUARD.failures}
+        skipped = {(region, resource): reason for region, resource, reason in GUARD.skipped}
+        result = ApplyResult(incomplete=region_statuses())
+
+    for change in planned.changes:
+        key = (change.region, change.resource)
+        if key in failures:
+            result.outcomes.append(ChangeOutcome(change, 'failed', failures[key]))
+        elif key in skipped:
+            result.outcomes.append(ChangeOutcome(change, 'skipped', skipped[key]))
+        else:
+            result.outcomes.append(ChangeOutcome(change, 'applied'))
+
+    return result
@@ -2,6 +2,14 @@ import click
 import sys
 
 
+from .AWS import AWS_Utils, REGION_CACHE_TTL
+from .api import collect_resources
+from .planner import Planner
+from .service import serve, DEFAULT_LISTEN, DEFAULT_INTERVAL
+from .resilience import GUARD
+from .scheduling import RunHistory
+from .snapshots import SNAPSHOT_DIR, load_numpy, save_snapshot, print_stats
+from .telemetry import TELEMETRY
 from .utilities import trigger_scan, validate_services, ScanRegion, print_policies, check_imdsv1_usage
 
 CLI_PROMPT = """
@@ -27,30 +35,100 @@ click.secho(CLI_PROMPT, bold=True, fg='cyan')
 @click.option('--migrate', is_flag=True, default=False, help='This boolean flag enables IMDShift to perform the migration, defaults to "False". Format: "--migrate"')
 @click.option('--update-hop-limit', type=int, default=None, help='This flag specifies if the hop limit should be updated and with what value. It is recommended to set the hop limit to "2" to enable containers to be able to work with the IMDS endpoint. If this flag is not passed, hop limit is not updated during migration. Format: "--update-hop-limit 3"')
 @click.option('--enable-imds', is_flag=True, default=False, help='This boolean flag enables IMDShift to enable the metadata endpoint for resources that have it disabled and then perform the migration, defaults to "False". Format: "--enable-imds"')
+@click.option('--migrate-templates', is_flag=True, default=False, help='This boolean flag enables IMDShift to publish a new version, requiring IMDSv2, of every launch template used by the scanned Auto Scaling groups and EKS nodegroups and to point them at it, and to set the "DisableIMDSv1" option of the scanned Beanstalk environments, so that new instances are launched with IMDSv2, defaults to "False". Updating an EKS nodegroup or a Beanstalk environment replaces its instances. Format: "--migrate-templates"')
+@click.option('--set-account-defaults', is_flag=True, default=False, help='This boolean flag, used with "--migrate", also sets the account level instance metadata defaults of every scanned region to require IMDSv2, with the hop limit from "--update-hop-limit" or "2", so that new instances launch with IMDSv2. Only applies when scanning EC2, defaults to "False". Format: "--migrate --set-account-defaults"')
 @click.option('--profile', type=str, default=None, help='This allows you to use any profile from your ~/.aws/credentials file. Format: "--profile prod-env"')
 @click.option('--role-arn', type=str, default=None, help='This flag let\'s you assume a role via aws sts. Format: "--role-arn arn:aws:sts::111111111:role/John"')
 @click.option('--print-scps', is_flag=True, default=False, help='This boolean flag prints Service Control Policies (SCPs) that can be used to control IMDS usage, like deny access for credentials fetched from IMDSv2 or deny creation of resources with IMDSv1, defaults to "False". Format: "--print-scps"')
 @click.option('--check-imds-usage', is_flag=True, default=False, help='This boolean flag launches a scan to identify how many instances are using IMDSv1 in specified regions, during the last 30 days, by using the "MetadataNoToken" CloudWatch metric, defaults to "False". Format: "--check-imds-usage"')
-def cli_handler(services, include_regions, exclude_regions, migrate, update_hop_limit, enable_imds, profile, role_arn, print_scps, check_imds_usage):
-    if print_scps:
-        print_policies()
+@click.option('--region-cache-ttl', type=int, default=REGION_CACHE_TTL, help='This flag specifies for how many seconds the list of enabled regions is cached on disk (in ~/.imdshift/regions.json) per account, "0" disables the on-disk cache, defaults to "86400". Format: "--region-cache-ttl 3600"')
+@click.option('--telemetry', is_flag=True, default=False, help='This boolean flag records per-API-call telemetry (call counts, latency, retries, throttles and response bytes per service, operation and region) and per-phase timings, and prints a summary at the end of the run, defaults to "False". Format: "--telemetry"')
+@click.option('--telemetry-output', type=str, default=None, help='This flag specifies a file to write the telemetry to, as JSON or, if the file name ends with ".prom", in the Prometheus textfile format. Implies "--telemetry". Format: "--telemetry-output imdshift.prom"')
+@click.option('--call-timeout', type=int, default=None, help='This flag specifies the connect and read timeout, in seconds, for every AWS API call. If this flag is not passed, botocore defaults are used. Format: "--call-timeout 10"')
+@click.option('--max-attempts', type=int, default=None, help='This flag specifies the maximum number of attempts, including retries, for every AWS API call. If this flag is not passed, botocore defaults are used. Format: "--max-attempts 3"')
+@click.option('--region-timeout', type=int, default=None, help='This flag specifies a time budget, in seconds, for scanning and for migrating each service in each region. Regions that exceed it are reported as partially scanned. If this flag is not passed, there is no time budget. Format: "--region-timeout 300"')
+@click.option('--max-region-errors', type=int, default=3, help='This flag specifies after how many consecutive errors a service is skipped for the rest of a region, "0" disables this, defaults to "3". Format: "--max-region-errors 5"')
+@click.option('--plan', is_flag=True, default=False, help='This boolean flag runs discovery and analysis, then prints the exact changes that "--migrate", "--enable-imds", "--update-hop-limit" and "--migrate-templates" would make, with an estimate of API calls and wall time, without modifying anything. If none of those flags are passed, the plan is for "--migrate". Format: "--plan"')
+@click.option('--plan-output', type=str, default=None, help='This flag specifies a JSON file to write the plan to. Format: "--plan-output plan.json"')
+@click.option('--serve', 'serve_mode', is_flag=True, default=False, help='This boolean flag runs IMDShift as a long-running service that keeps sessions, clients and the last inventory warm, rescans the specified services and regions on a schedule and serves the results over HTTP: "GET /status", "GET /inventory", "GET /changes?since=<generation>" for what changed since a given scan and "POST /scan" to rescan now. Nothing is migrated in this mode, defaults to "False". Format: "--serve"')
+@click.option('--listen', type=str, default=DEFAULT_LISTEN, help=f'This flag specifies where "--serve" listens, either "host:port" or "unix:<path>" for a Unix socket, defaults to "{DEFAULT_LISTEN}". Format: "--listen unix:/run/imdshift.sock"')
+@click.option('--interval', type=int, default=DEFAULT_INTERVAL, help=f'This flag specifies how many seconds "--serve" waits between scheduled rescans, "0" only rescans on request, defaults to "{DEFAULT_INTERVAL}". Format: "--interval 600"')
+@click.option('--snapshot', is_flag=True, default=False, help='This boolean flag stores the results of the scan as a columnar snapshot, used by "--stats" for trends over time. Needs NumPy, install it with "pip install IMDShift[stats]", defaults to "False". Format: "--snapshot"')
+@click.option('--snapshot-dir', type=str, default=SNAPSHOT_DIR, help='This flag specifies the directory snapshots are stored in and read from, defaults to "~/.imdshift/snapshots". Format: "--snapshot-dir /var/lib/imdshift"')
+@click.option('--stats', is_flag=True, default=False, help='This boolean flag prints the IMDSv1 share by week, account and region, the migration velocity and the resources that went back to accepting IMDSv1, from the stored snapshots, then exits. Needs NumPy. Format: "--stats"')
+@click.option('--max-concurrency', type=int, default=4, help='This flag specifies how many services are scanned and remediated at once, each within its own API rate limits, and is used to estimate the wall time of a plan, defaults to "4". Format: "--max-concurrency 8"')
+def cli_handler(services, include_regions, exclude_regions, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults, profile, role_arn, print_scps, check_imds_usage, region_cache_ttl, telemetry, telemetry_output, call_timeout, max_attempts, region_timeout, max_region_errors, plan, plan_output, serve_mode, listen, interval, snapshot, snapshot_dir, stats, max_concurrency):
+    # Plans rely on telemetry for discovery call counts and observed latencies
+    if telemetry or telemetry_output or plan:
+        TELEMETRY.enable()
 
+    planner = None
+    if plan:
+        planner = Planner(role_arn=role_arn, max_concurrency=max_concurrency)
+        if not (migrate or enable_imds or update_hop_limit != None or migrate_templates):
+            migrate = True
 
-    if check_imds_usage:
-        regions = ScanRegion(included_regions=include_regions, excluded_regions=exclude_regions, profile=profile, role_arn=role_arn).result()
-        click.echo(f"[+] Analysing IMDSv1 usage, in the last 30 days, with 'MetadataNoToken' CloudWatch metric.")
-        click.echo(f"[+] Scanning Regions: {', '.join(regions)}")
+    # Fail before scanning rather than after, when the optional NumPy dependency is missing
+    if snapshot or stats:
+        try:
+            load_numpy()
+        except ImportError as error:
+            click.secho(f'[!] {error}', bold=True, fg='red')
+            sys.exit(1)
 
-        check_imdsv1_usage(regions=regions, profile=profile, role_arn=role_arn)
+    GUARD.configure(call_timeout=call_timeout, max_attempts=max_attempts, region_timeout=region_timeout, max_region_errors=max_region_errors)
 
+    try:
+        if print_scps:
+            print_policies()
+            sys.exit(0)
 
-    if services == None:
-        click.secho('[!] No services specified to scan. Exiting.', bold=True, fg='red')
 
-    else:
-        services = [service.strip().upper() for service in services.split(',')]
-        regions = ScanRegion(included_regions=include_regions, excluded_regions=exclude_regions, profile=profile, role_arn=role_arn).result()
-        click.echo(f"[+] Scanning specified services: {', '.join(services)}")
-        click.echo(f"[+] Scanning Regions: {', '.join(regions)}")
-        validate_services(services)
-        trigger_scan(services=services,regions=regions, migrate=migrate, update_hop_limit=update_hop_limit, enable_imds=enable_imds, profile=profile, role_arn=role_arn)
\ No newline at end of file
+        if stats:
+            print_stats(snapshot_dir)
+            sys.exit(0)
+
+
+        if check_imds_usage:
+            regions = ScanRegion(included_regions=include_regions, excluded_regions=exclude_regions, profile=profile, role_arn=role_arn, region_cache_ttl=region_cache_ttl).result()
+            click.echo(f"[+] Analysing IMDSv1 usage, in the last 30 days, with 'MetadataNoToken' CloudWatch metric.")
+            click.echo(f"[+] Scanning Regions: {', '.join(regions)}")
+
+            check_imdsv1_usage(regions=regions, profile=profile, role_arn=role_arn)
+            sys.exit(0)
+
+
+        if services == None:
+            click.secho('[!] No services specified to scan. Exiting.', bold=True, fg='red')
+
+        elif serve_mode:
+            services = [service.strip().upper() for service in services.split(',')]
+            validate_services(services)
+            serve(services=services, regions=include_regions, exclude_regions=exclude_regions, profile=profile, role_arn=role_arn, region_cache_ttl=region_cache_ttl, listen=listen, interval=interval, snapshot_dir=snapshot_dir if snapshot else None)
+
+        else:
+            services = [service.strip().upper() for service in services.split(',')]
+            regions = ScanRegion(included_regions=include_regions, excluded_regions=exclude_regions, profile=profile, role_arn=role_arn, region_cache_ttl=region_cache_ttl).result()
+            click.echo(f"[+] Scanning specified services: {', '.join(services)}")
+            click.echo(f"[+] Scanning Regions: {', '.join(regions)}")
+            validate_services(services)
+            results = trigger_scan(services=services,regions=regions, migrate=migrate, update_hop_limit=update_hop_limit, enable_imds=enable_imds, profile=profile, role_arn=role_arn, planner=planner, migrate_templates=migrate_templates, set_account_defaults=set_account_defaults, max_concurrency=max_concurrency, history=RunHistory())
+
+            if snapshot:
+                path = save_snapshot(collect_resources(results), AWS_Utils().account_key(profile, role_arn), directory=snapshot_dir)
+                click.echo(f"[+] Snapshot written to {path}")
+
+            if planner:
+                planner.print_plan()
+
+                if plan_output:
+                    planner.dump(plan_output)
+
+    finally:
+        GUARD.print_report()
+
+        if telemetry or telemetry_output:
+            TELEMETRY.print_summary()
+
+            if telemetry_output:
+                TELEMETRY.dump(telemetry_output)
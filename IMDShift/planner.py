@@ -0,0 +1,222 @@
+import click
+import heapq
+import json
+import threading
+
+from dataclasses import dataclass, field, asdict
+from prettytable import PrettyTable
+from typing import Optional
+
+from .telemetry import TELEMETRY
+from .throttling import API_RATE_LIMITS, DEFAULT_RATE_LIMIT
+from .utilities import SERVICE_GROUPS
+
+
+# Used when telemetry has not observed an operation yet
+DEFAULT_CALL_LATENCY = 0.25
+
+# Assumed role credentials last an hour by default and are refreshed 15 minutes before they expire
+ASSUME_ROLE_REFRESH_SECONDS = 45 * 60
+
+
+@dataclass
+class Change:
+    service: str
+    region: str
+    resource: str
+    # None for changes that follow from another one, such as groups launching a template's $Latest
+    operation: Optional[str]
+    current: dict = field(default_factory=dict)
+    target: dict = field(default_factory=dict)
+
+
+@dataclass
+class Estimate:
+    operation: str
+    # None for global APIs such as STS
+    region: Optional[str]
+    calls: int
+    latency: float
+    rate_limit: tuple
+    seconds: float
+
+
+class Planner():
+
+    def __init__(self, role_arn=None, max_concurrency=1) -> None:
+        self.role_arn = role_arn
+        self.max_concurrency = max(max_concurrency or 1, 1)
+        self.changes = list()
+        self.lock = threading.Lock()
+        self.planned = set()
+
+
+    # Instances found by several services are changed once, as GUARD.claim does when applying, so
+    # only the first service to plan a change for a resource lists it
+    def add(self, service, changes):
+        with self.lock:
+            for change in changes:
+                key = (change['region'], change['resource'], change['operation'])
+                if key in self.planned:
+                    continue
+                self.planned.add(key)
+                self.changes.append(Change(service=service, **change))
+
+
+    # Average latency of an operation in a region, or across regions if the region has not been observed
+    def observed_latency(self, operation, region=None):
+        service, name = operation.split(':')
+        calls = 0
+        latency = 0.0
+        region_calls = 0
+        region_latency = 0.0
+        for (observed_service, observed_name, observed_region), stats in TELEMETRY.api_calls.items():
+            if observed_service == service and observed_name == name:
+                calls += stats['calls']
+                latency += stats['latency_sum']
+                if observed_region == region:
+                    region_calls += stats['calls']
+                    region_latency += stats['latency_sum']
+        if region_calls:
+            return region_latency / region_calls
+        return latency / calls if calls else DEFAULT_CALL_LATENCY
+
+
+    # Changes are made the way trigger_scan makes them: each (service group, region) unit makes its
+    # calls one after another, and the units run at most max_concurrency at a time
+    def unit_calls(self):
+        units = dict()
+        for change in self.changes:
+            if change.operation:
+                unit = units.setdefault((SERVICE_GROUPS.get(change.service, change.service), change.region), dict())
+                unit[change.operation] = unit.get(change.operation, 0) + 1
+        return units
+
+
+    # Seconds until all units are done, with units started longest first on the first free worker
+    def schedule_seconds(self, durations):
+        workers = [0.0] * min(self.max_concurrency, len(durations))
+        for duration in sorted(durations, reverse=True):
+            heapq.heappush(workers, heapq.heappop(workers) + duration)
+        return max(workers, default=0.0)
+
+
+    # The rate limiter keeps one token bucket per operation and region, shared by every unit in the region
+    def rate_limit_seconds(self, operation, calls):
+        bucket, refill = API_RATE_LIMITS.get(operation, DEFAULT_RATE_LIMIT)
+        return max(calls - bucket, 0) / refill
+
+
+    def estimate_operation(self, operation, region, unit_calls):
+        latency = self.observed_latency(operation, region)
+        calls = sum(unit_calls)
+        # Bounded both by the units making these calls in sequence and by the region's token bucket
+        sequential_seconds = self.schedule_seconds([count * latency for count in unit_calls])
+        seconds = max(sequential_seconds, self.rate_limit_seconds(operation, calls))
+        return Estimate(operation, region, calls, latency, API_RATE_LIMITS.get(operation, DEFAULT_RATE_LIMIT), seconds)
+
+
+    def changes_seconds(self):
+        units = self.unit_calls()
+        buckets = dict()
+        for (group, region), operations in units.items():
+            for operation, count in operations.items():
+                buckets[(operation, region)] = buckets.get((operation, region), 0) + count
+
+        durations = list()
+        for (group, region), operations in units.items():
+            sequential_seconds = sum(count * self.observed_latency(operation, region) for operation, count in operations.items())
+            # A unit cannot finish before the buckets it draws from have let all of the region's calls through
+            rate_limit_seconds = max(self.rate_limit_seconds(operation, buckets[(operation, region)]) for operation in operations)
+            durations.append(max(sequential_seconds, rate_limit_seconds))
+        return self.schedule_seconds(durations)
+
+
+    def estimates(self):
+        calls = dict()
+        for (group, region), operations in self.unit_calls().items():
+            for operation, count in operations.items():
+                calls.setdefault((operation, region), list()).append(count)
+
+        estimates = [self.estimate_operation(operation, region, unit_calls) for (operation, region), unit_calls in calls.items()]
+
+        # The session assumed during discovery is reused, the role is only assumed again when its credentials are refreshed
+        refreshes = int(self.changes_seconds() // ASSUME_ROLE_REFRESH_SECONDS)
+        if self.role_arn and refreshes:
+            estimates.append(self.estimate_operation('sts:AssumeRole', None, [refreshes]))
+
+        # What a --check-imds-usage pass over the affected instances would cost before migrating, one call per instance
+        instances = dict()
+        for change in self.changes:
+            if change.operation == 'ec2:ModifyInstanceMetadataOptions':
+                instances.setdefault(change.region, set()).add(change.resource)
+        for region, resources in instances.items():
+            estimates.append(self.estimate_operation('cloudwatch:GetMetricData', region, [len(resources)]))
+
+        return estimates
+
+
+    def mutation_seconds(self, estimates):
+        # Role refreshes happen in between the changes, CloudWatch estimates are for an optional usage check
+        return self.changes_seconds() + sum(estimate.seconds for estimate in estimates if estimate.operation == 'sts:AssumeRole')
+
+
+    def discovery_calls(self):
+        return sum(stats['calls'] for stats in TELEMETRY.api_calls.values())
+
+
+    def to_dict(self):
+        estimates = self.estimates()
+        return {
+            'changes': [asdict(change) for change in self.changes],
+            'estimates': [asdict(estimate) for estimate in estimates],
+            'discovery_api_calls': self.discovery_calls(),
+            'discovery_seconds': TELEMETRY.wall_time('discovery', 'analysis'),
+            'max_concurrency': self.max_concurrency,
+            'mutation_seconds': self.mutation_seconds(estimates),
+        }
+
+
+    def print_plan(self):
+        changes_table = PrettyTable()
+        changes_table.align = 'l'
+        changes_table.field_names = ['Service', 'Region', 'Resource', 'API Call', 'Changes']
+
+        for change in self.changes:
+            differences = [f"{key}: {change.current.get(key)} -> {value}" for key, value in change.target.items() if change.current.get(key) != value]
+            changes_table.add_row([change.service, change.region, change.resource, change.operation or '(none)', '\n'.join(differences)])
+
+        estimates = self.estimates()
+        estimates_table = PrettyTable()
+        estimates_table.align = 'c'
+        estimates_table.valign = 'c'
+        estimates_table.field_names = ['API Call', 'Region', 'Calls', 'Avg Latency (ms)', 'Rate Limit (bucket/refill per s)', 'Estimated Time (s)']
+
+        for estimate in estimates:
+            estimates_table.add_row(
+                [
+                    estimate.operation,
+                    estimate.region or '-',
+                    estimate.calls,
+                    round(estimate.latency * 1000, 1),
+                    f"{estimate.rate_limit[0]}/{estimate.rate_limit[1]}",
+                    round(estimate.seconds, 1)
+                ]
+            )
+
+        mutation_seconds = self.mutation_seconds(estimates)
+
+        click.echo(f"\n[+] Planned changes ({len(self.changes)}), nothing has been modified:")
+        if self.changes:
+            click.secho(changes_table.get_string(), bold=True, fg='yellow')
+        click.echo(f"[+] Estimated API usage at a concurrency of {self.max_concurrency}:")
+        click.secho(estimates_table.get_string(), bold=True, fg='yellow')
+        click.echo(f"[+] Discovery made {self.discovery_calls()} API calls.")
+        click.echo(f"[+] Estimated wall time for the changes: {round(mutation_seconds, 1)}s")
+
+
+    def dump(self, path):
+        with open(path, 'w') as output_file:
+            json.dump(self.to_dict(), output_file, indent=2, default=str)
+
+        click.echo(f"[+] Plan written to {path}")
@@ -0,0 +1,134 @@
+import click
+import contextlib
+import contextvars
+import re
+
+from dataclasses import dataclass, field
+from tqdm import tqdm
+
+
+@dataclass
+class ProgressEvent:
+    # 'message', 'table' or 'progress'
+    kind: str
+    message: str
+    # 'info', 'warning' or 'error'
+    level: str = 'info'
+    data: dict = field(default_factory=dict)
+
+
+# Prints to the terminal, as the CLI always has
+class ConsoleReporter():
+
+    def echo(self, message, **style):
+        click.secho(message, **style)
+
+
+    def table(self, title, table):
+        if title:
+            click.echo(title)
+        click.secho(table.get_string(), bold=True, fg='yellow')
+
+
+    def progress(self, iterable, desc=None, colour=None, unit=None):
+        return tqdm(iterable, desc=desc, colour=colour, unit=unit)
+
+
+# No console I/O, everything is passed to an optional callback as a ProgressEvent
+class CallbackReporter():
+
+    LEVELS = {'red': 'error', 'yellow': 'warning'}
+
+    def __init__(self, callback=None) -> None:
+        self.callback = callback
+
+
+    def emit(self, event):
+        if self.callback:
+            self.callback(event)
+
+
+    def clean(self, message):
+        return re.sub(r'^\[[+!]\] ', '', str(message).strip())
+
+
+    def echo(self, message, fg=None, **style):
+        self.emit(ProgressEvent('message', self.clean(message), self.LEVELS.get(fg, 'info')))
+
+
+    def table(self, title, table):
+        self.emit(ProgressEvent('table', self.clean(title), data={
+            'columns': list(table.field_names),
+            'rows': [list(row) for row in table.rows],
+        }))
+
+
+    def progress(self, iterable, desc=None, colour=None, unit=None):
+        items = iterable if hasattr(iterable, '__len__') else list(iterable)
+        description = self.clean(desc or '')
+        self.emit(ProgressEvent('progress', description, data={'completed': 0, 'total': len(items), 'unit': (unit or '').strip()}))
+        for completed, item in enumerate(items, 1):
+            yield item
+            self.emit(ProgressEvent('progress', description, data={'completed': completed, 'total': len(items), 'unit': (unit or '').strip()}))
+
+
+# Holds messages and tables back until flush(), so concurrent services do not interleave their output.
+# Progress bars are live and go straight to the parent reporter.
+class BufferedReporter():
+
+    def __init__(self, parent) -> None:
+        self.parent = parent
+        self.buffer = list()
+
+
+    def echo(self, message, **style):
+        self.buffer.append(('echo', (message,), style))
+
+
+    def table(self, title, table):
+        self.buffer.append(('table', (title, table), dict()))
+
+
+    def progress(self, iterable, desc=None, colour=None, unit=None):
+        return self.parent.progress(iterable, desc=desc, colour=colour, unit=unit)
+
+
+    def flush(self):
+        buffer, self.buffer = self.buffer, list()
+        for method, args, kwargs in buffer:
+            getattr(self.parent, method)(*args, **kwargs)
+
+
+# Forwards to the reporter of the current context, so library calls can swap it without affecting the CLI
+class Reporting():
+
+    def __init__(self) -> None:
+        self.current = contextvars.ContextVar('imdshift_reporter', default=ConsoleReporter())
+
+
+    def echo(self, message, **style):
+        self.current.get().echo(message, **style)
+
+
+    def table(self, title, table):
+        self.current.get().table(title, table)
+
+
+    def progress(self, iterable, desc=None, colour=None, unit=None):
+        return self.current.get().progress(iterable, desc=desc, colour=colour, unit=unit)
+
+
+    def reporter(self):
+        return self.current.get()
+
+
+    @contextlib.contextmanager
+    def use(self, reporter):
+        token = self.current.set(reporter)
+        try:
+            yield reporter
+        finally:
+            self.current.reset(token)
+
+
+REPORTER = Reporting()
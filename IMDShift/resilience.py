@@ -0,0 +1,215 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+from botocore.config import Config
+from prettytable import PrettyTable
+
+from .reporting import REPORTER
+
+
+class RegionTimeout(Exception):
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class RunGuard():
+
+    def __init__(self) -> None:
+        self.call_timeout = None
+        self.max_attempts = None
+        self.region_timeout = None
+        self.max_region_errors = 3
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+
+    def configure(self, call_timeout=None, max_attempts=None, region_timeout=None, max_region_errors=3):
+        self.call_timeout = call_timeout
+        self.max_attempts = max_attempts
+        self.region_timeout = region_timeout
+        self.max_region_errors = max_region_errors
+
+
+    # Same configuration, none of this guard's state
+    def fresh(self):
+        guard = RunGuard()
+        guard.configure(self.call_timeout, self.max_attempts, self.region_timeout, self.max_region_errors)
+        return guard
+
+
+    def reset(self):
+        with self.lock:
+            self.deadlines = dict()
+            self.consecutive_errors = dict()
+            self.open_circuits = dict()
+            self.report = dict()
+            # Per resource outcomes of mutations, as (region, resource, reason)
+            self.failures = list()
+            self.skipped = list()
+        self.release_claims()
+
+
+    def release_claims(self):
+        with self.lock:
+            self.claimed = set()
+
+
+    def client_config(self):
+        options = dict()
+        if self.call_timeout:
+            options['connect_timeout'] = self.call_timeout
+            options['read_timeout'] = self.call_timeout
+        if self.max_attempts:
+            options['retries'] = {'max_attempts': self.max_attempts, 'mode': 'standard'}
+        return Config(**options) if options else None
+
+
+    def mark(self, service, region, status, reason):
+        with self.lock:
+            # A region that was partially scanned stays partial even if a later phase skips it
+            if (service, region) not in self.report or status == 'partial':
+                self.report[(service, region)] = (status, reason)
+
+
+    def deadline_for(self, service, region, stage):
+        if not self.region_timeout:
+            return None
+        with self.lock:
+            return self.deadlines.setdefault((service, region, stage), time.monotonic() + self.region_timeout)
+
+
+    def check(self, service=None, region=None, stage='discovery'):
+        if service is None:
+            service, region, stage = getattr(self.local, 'current', (None, None, None))
+            if service is None:
+                return
+
+        if (service, region) in self.open_circuits:
+            raise CircuitOpen(self.open_circuits[(service, region)])
+
+        deadline = self.deadline_for(service, region, stage)
+        if deadline and time.monotonic() > deadline:
+            raise RegionTimeout(f"{stage} exceeded the {self.region_timeout}s region budget")
+
+
+    def allow(self, service, region, stage='mutation', resource=None):
+        try:
+            self.check(service, region, stage)
+            return True
+        except CircuitOpen as error:
+            reason = f"circuit open: {error}"
+        except RegionTimeout as error:
+            reason = str(error)
+
+        self.mark(service, region, 'partial', reason)
+        if resource is not None:
+            self.skip_resource(region, resource, reason)
+        return False
+
+
+    def skip_resource(self, region, resource, reason):
+        with self.lock:
+            self.skipped.append((region, resource, reason))
+
+
+    def claim(self, region, resource, step):
+        # Services running concurrently can find the same instance, only the first one changes it
+        with self.lock:
+            if (region, resource, step) in self.claimed:
+                return False
+            self.claimed.add((region, resource, step))
+            return True
+
+
+    def record_success(self, service, region):
+        with self.lock:
+            self.consecutive_errors[(service, region)] = 0
+
+
+    def record_error(self, service, region, error, resource=None):
+        with self.lock:
+            if resource is not None:
+                self.failures.append((region, resource, str(error)))
+            errors = self.consecutive_errors.get((service, region), 0) + 1
+            self.consecutive_errors[(service, region)] = errors
+            if self.max_region_errors and errors >= self.max_region_errors and (service, region) not in self.open_circuits:
+                self.open_circuits[(service, region)] = f"{errors} consecutive errors, last: {error}"
+                REPORTER.echo(f'[!] Too many errors for {service} in {region}, skipping the rest of this region.', bold=True, fg='red')
+
+
+    def run(self, service, region, function, *args, **kwargs):
+        if (service, region) in self.open_circuits:
+            self.mark(service, region, 'skipped', f"circuit open: {self.open_circuits[(service, region)]}")
+            return None
+
+        self.local.current = (service, region, 'discovery')
+        try:
+            result = function(*args, **kwargs)
+            self.record_success(service, region)
+            return result
+
+        except RegionTimeout as error:
+            REPORTER.echo(f'[!] Stopped scanning {service} in {region}: {error}.', bold=True, fg='red')
+            self.mark(service, region, 'partial', str(error))
+
+        except CircuitOpen as error:
+            self.mark(service, region, 'partial', f"circuit open: {error}")
+
+        except Exception as error:
+            REPORTER.echo(f'[!] An error occurred while scanning {service} resources in {region}.', bold=True, fg='red')
+            REPORTER.echo(f'[!] Error message: {error}.', bold=True, fg='red')
+            self.record_error(service, region, error)
+            self.mark(service, region, 'partial', str(error))
+
+        finally:
+            self.local.current = (None, None, None)
+
+
+    def print_report(self):
+        if not self.report:
+            return
+
+        report_table = PrettyTable()
+        report_table.align = 'c'
+        report_table.valign = 'c'
+        report_table.field_names = ['Service', 'Region', 'Status', 'Reason']
+
+        for (service, region), (status, reason) in sorted(self.report.items()):
+            report_table.add_row([service, region, status, reason[:100]])
+
+        REPORTER.echo(f"\n[!] Some regions were skipped or only partially scanned:", bold=True, fg='red')
+        REPORTER.table("", report_table)
+
+
+# Forwards to the guard of the current context, so concurrent library calls each keep their own state.
+# Worker threads started with contextvars.copy_context() share their caller's guard.
+class Guarding():
+
+    def __init__(self) -> None:
+        self.current = contextvars.ContextVar('imdshift_guard', default=RunGuard())
+
+
+    def __getattr__(self, name):
+        return getattr(self.current.get(), name)
+
+
+    def guard(self):
+        return self.current.get()
+
+
+    @contextlib.contextmanager
+    def use(self, guard):
+        token = self.current.set(guard)
+        try:
+            yield guard
+        finally:
+            self.current.reset(token)
+
+
+GUARD = Guarding()
@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+
+from .AWS import IMDSHIFT_HOME
+from .reporting import REPORTER
+
+
+HISTORY_FILE = os.path.join(IMDSHIFT_HOME, 'history.json')
+
+# Weight of the latest run in the moving average, so one slow run does not reorder everything
+HISTORY_WEIGHT = 0.5
+
+
+# Discovery and mutation durations per (account, region, service) from previous runs
+class RunHistory():
+
+    def __init__(self, path=HISTORY_FILE) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.durations = self.read()
+
+
+    def read(self):
+        try:
+            with open(self.path) as history_file:
+                return json.load(history_file)
+        except (OSError, ValueError):
+            return dict()
+
+
+    def key(self, account, region, service):
+        return f"{account}/{region}/{service}"
+
+
+    def duration(self, account, region, service, phase):
+        with self.lock:
+            return self.durations.get(self.key(account, region, service), dict()).get(phase)
+
+
+    def record(self, account, region, service, phase, seconds):
+        with self.lock:
+            entry = self.durations.setdefault(self.key(account, region, service), dict())
+            previous = entry.get(phase)
+            entry[phase] = seconds if previous is None else HISTORY_WEIGHT * seconds + (1 - HISTORY_WEIGHT) * previous
+
+
+    def estimate(self, account, region, services, mutation=False):
+        phases = ['discovery', 'mutation'] if mutation else ['discovery']
+        durations = [self.duration(account, region, service, phase) for service in services for phase in phases]
+        if all(duration is None for duration in durations):
+            return None
+        return sum(duration or 0.0 for duration in durations)
+
+
+    def save(self):
+        with self.lock:
+            durations = dict(self.durations)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Written to a temporary file first, so an interrupted run never leaves a truncated history
+            with open(f"{self.path}.tmp", 'w') as history_file:
+                json.dump(durations, history_file, indent=2, sort_keys=True)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as error:
+            REPORTER.echo(f'[!] Unable to write run history: {error}.', fg='yellow')
+
+
+# Longest processing time first: the units expected to take longest start first, so a large region is
+# not left running alone at the end. Units without history are assumed to be as long as the longest
+# known one, the order of equal units is kept.
+def longest_first(units, estimates):
+    known = [estimate for estimate in estimates if estimate is not None]
+    fallback = max(known) if known else 0.0
+    order = sorted(range(len(units)), key=lambda index: -(estimates[index] if estimates[index] is not None else fallback))
+    return [units[index] for index in order]
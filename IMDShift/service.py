@@ -0,0 +1,273 @@
+import click
+import collections
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from . import api
+from .AWS import AWS_Utils, REGION_CACHE_TTL
+
+
+DEFAULT_LISTEN = '127.0.0.1:8765'
+DEFAULT_INTERVAL = 300
+
+# Diffs kept for clients polling /changes, older generations get the full inventory instead
+MAX_CHANGESETS = 100
+
+
+def resource_key(resource):
+    return (resource.service, resource.region, resource.resource)
+
+
+def resource_tuple(resource):
+    return (resource['service'], resource['region'], resource['resource'])
+
+
+def diff_inventories(previous, current):
+    changes = {'added': list(), 'removed': list(), 'changed': list()}
+    for key, resource in current.items():
+        if key not in previous:
+            changes['added'].append(asdict(resource))
+        elif previous[key] != resource:
+            changes['changed'].append({'before': asdict(previous[key]), 'after': asdict(resource)})
+    for key, resource in previous.items():
+        if key not in current:
+            changes['removed'].append(asdict(resource))
+    return changes
+
+
+# Keeps sessions, clients, regions and the last inventory warm between scans
+class ComplianceService():
+
+    def __init__(self, services, regions='ALL', exclude_regions=None, profile=None, role_arn=None,
+                 region_cache_ttl=REGION_CACHE_TTL, interval=DEFAULT_INTERVAL, snapshot_dir=None) -> None:
+        self.services = services
+        self.regions = regions
+        self.exclude_regions = exclude_regions
+        self.profile = profile
+        self.role_arn = role_arn
+        self.region_cache_ttl = region_cache_ttl
+        self.interval = interval
+        # Every scan is also stored as a snapshot for --stats when set
+        self.snapshot_dir = snapshot_dir
+
+        self.scan_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.generation = 0
+        self.inventory = dict()
+        self.changesets = collections.deque(maxlen=MAX_CHANGESETS)
+        self.last_result = None
+        self.last_scan = None
+        self.last_duration = None
+        self.regions_refreshed = time.time()
+
+
+    def log(self, event):
+        if event.kind == 'message' and event.level != 'info':
+            click.secho(f"[!] {event.message}", fg='red' if event.level == 'error' else 'yellow')
+
+
+    def scan(self):
+        with self.scan_lock:
+            # The enabled regions are memoised for the life of the process, let them expire like the disk cache
+            if self.region_cache_ttl and time.time() - self.regions_refreshed > self.region_cache_ttl:
+                AWS_Utils.enabled_regions_cache.clear()
+                self.regions_refreshed = time.time()
+
+            start = time.time()
+            result = api.scan(self.services, regions=self.regions, exclude_regions=self.exclude_regions, profile=self.profile,
+                              role_arn=self.role_arn, region_cache_ttl=self.region_cache_ttl, progress=self.log)
+            inventory = {resource_key(resource): resource for resource in result.resources}
+
+            with self.state_lock:
+                changes = diff_inventories(self.inventory, inventory)
+                self.generation += 1
+                self.changesets.append((self.generation, changes))
+                self.inventory = inventory
+                self.last_result = result
+                self.last_scan = start
+                self.last_duration = time.time() - start
+
+            if self.snapshot_dir:
+                api.snapshot(result, directory=self.snapshot_dir)
+
+            click.echo(f"[+] Scan {self.generation} finished in {round(self.last_duration, 1)}s: "
+                       f"{len(changes['added'])} added, {len(changes['removed'])} removed, {len(changes['changed'])} changed")
+            return self.generation, changes
+
+
+    def changes_since(self, generation):
+        with self.state_lock:
+            oldest = self.changesets[0][0] if self.changesets else self.generation + 1
+            # Too old to replay, start the client over from the current inventory
+            if generation < oldest - 1:
+                return {
+                    'generation': self.generation,
+                    'full': True,
+                    'added': [asdict(resource) for resource in self.inventory.values()],
+                    'removed': list(),
+                    'changed': list(),
+                }
+
+            # Compare what the client last saw with what is there now, for every resource touched since
+            before = dict()
+            for changeset_generation, changes in self.changesets:
+                if changeset_generation <= generation:
+                    continue
+                for resource in changes['added']:
+                    before.setdefault(resource_tuple(resource), None)
+                for change in changes['changed']:
+                    before.setdefault(resource_tuple(change['before']), change['before'])
+                for resource in changes['removed']:
+                    before.setdefault(resource_tuple(resource), resource)
+
+            current = {key: asdict(resource) for key, resource in self.inventory.items()}
+            result = {'generation': self.generation, 'full': False, 'added': list(), 'removed': list(), 'changed': list()}
+            for key, previous in before.items():
+                after = current.get(key)
+                if previous is None and after is not None:
+                    result['added'].append(after)
+                elif previous is not None and after is None:
+                    result['removed'].append(previous)
+                elif previous != after:
+                    result['changed'].append({'before': previous, 'after': after})
+            return result
+
+
+    def status(self):
+        with self.state_lock:
+            result = self.last_result
+            return {
+                'generation': self.generation,
+                'services': self.services,
+                'regions': result.regions if result else list(),
+                'last_scan': self.last_scan,
+                'last_duration': self.last_duration,
+                'interval': self.interval,
+                'resources': len(self.inventory),
+                'imdsv1': len(result.imdsv1) if result else 0,
+                'account_defaults': result.account_defaults if result else dict(),
+                'incomplete': [asdict(status) for status in result.incomplete] if result else list(),
+            }
+
+
+    def inventory_view(self):
+        with self.state_lock:
+            return {
+                'generation': self.generation,
+                'resources': [asdict(resource) for resource in self.inventory.values()],
+            }
+
+
+    def run_schedule(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except Exception as error:
+                click.secho(f'[!] Scheduled scan failed: {error}.', bold=True, fg='red')
+            # An interval of 0 only scans on request, after the initial scan
+            self.stopped.wait(self.interval if self.interval > 0 else None)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+
+    # Set on the subclass created by serve()
+    compliance_service = None
+
+    def send_json(self, status, body):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            self.send_json(200, self.compliance_service.status())
+        elif url.path == '/inventory':
+            self.send_json(200, self.compliance_service.inventory_view())
+        elif url.path == '/changes':
+            try:
+                since = int(parse_qs(url.query).get('since', ['0'])[0])
+            except ValueError:
+                return self.send_json(400, {'error': '"since" must be a scan generation number'})
+            self.send_json(200, self.compliance_service.changes_since(since))
+        else:
+            self.send_json(404, {'error': f"unknown path {url.path}"})
+
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/scan':
+            return self.send_json(404, {'error': f"unknown path {url.path}"})
+
+        try:
+            generation, changes = self.compliance_service.scan()
+        except Exception as error:
+            return self.send_json(500, {'error': str(error)})
+        self.send_json(200, dict(changes, generation=generation, full=False))
+
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+
+    def log_message(self, format, *args):
+        click.echo(f"[+] {self.address_string()} {format % args}")
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.TCPServer.server_bind(self)
+        os.chmod(self.server_address, 0o600)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def create_server(listen, handler):
+    if listen.startswith('unix:'):
+        return UnixHTTPServer(listen[len('unix:'):], handler)
+
+    host, _, port = listen.rpartition(':')
+    return ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+
+def serve(services, regions='ALL', exclude_regions=None, profile=None, role_arn=None,
+          region_cache_ttl=REGION_CACHE_TTL, listen=DEFAULT_LISTEN, interval=DEFAULT_INTERVAL, snapshot_dir=None):
+    compliance_service = ComplianceService(services, regions=regions, exclude_regions=exclude_regions, profile=profile, role_arn=role_arn,
+                                           region_cache_ttl=region_cache_ttl, interval=interval, snapshot_dir=snapshot_dir)
+    handler = type('Handler', (ServiceRequestHandler,), {'compliance_service': compliance_service})
+    server = create_server(listen, handler)
+
+    click.echo(f"[+] Serving on {listen}, rescanning every {interval}s")
+    click.echo(f"[+] Endpoints: GET /status, GET /inventory, GET /changes?since=<generation>, POST /scan")
+
+    scheduler = threading.Thread(target=compliance_service.run_schedule, name='imdshift-scheduler', daemon=True)
+    scheduler.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        click.echo(f"\n[+] Shutting down")
+    finally:
+        compliance_service.stopped.set()
+        server.server_close()
+        if listen.startswith('unix:') and os.path.exists(listen[len('unix:'):]):
+            os.unlink(listen[len('unix:'):])
@@ -0,0 +1,286 @@
+import click
+import glob
+import os
+import re
+import time
+
+from prettytable import PrettyTable
+
+from .AWS import IMDSHIFT_HOME
+
+
+SNAPSHOT_DIR = os.path.join(IMDSHIFT_HOME, 'snapshots')
+
+# Fixed vocabularies, so codes mean the same thing in every snapshot
+HTTP_TOKENS = ['required', 'optional']
+ENDPOINT = ['enabled', 'disabled']
+
+WEEK_SECONDS = 7 * 24 * 60 * 60
+# The Unix epoch is a Thursday, weeks start on Monday
+WEEK_OFFSET = 4 * 24 * 60 * 60
+
+
+# NumPy is an optional dependency, only snapshots and stats need it
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('Snapshots and stats need NumPy, install it with: pip install "IMDShift[stats]"')
+    return numpy
+
+
+def encode(values):
+    numpy = load_numpy()
+    vocabulary, codes = numpy.unique(numpy.asarray(values, dtype=str), return_inverse=True)
+    return vocabulary, codes.astype(numpy.uint16)
+
+
+# One row per resource, a resource found by several services (e.g. an ASG instance also scanned as
+# EC2) is only counted once
+def save_snapshot(resources, account, timestamp=None, directory=SNAPSHOT_DIR):
+    numpy = load_numpy()
+    timestamp = timestamp or time.time()
+
+    rows = dict()
+    for resource in resources:
+        rows.setdefault((resource.region, resource.resource), resource)
+    rows = list(rows.values())
+
+    region_names, region = encode([resource.region for resource in rows])
+    service_names, service = encode([resource.service for resource in rows])
+    kind_names, kind = encode([resource.kind for resource in rows])
+
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime(timestamp))}.{int(timestamp * 1000) % 1000:03d}Z-{re.sub(r'[^A-Za-z0-9_.-]', '_', account)}.npz"
+    path = os.path.join(directory, name)
+    numpy.savez_compressed(
+        path,
+        timestamp=numpy.float64(timestamp),
+        account=numpy.str_(account),
+        region=region,
+        region_names=region_names,
+        service=service,
+        service_names=service_names,
+        kind=kind,
+        kind_names=kind_names,
+        resource=numpy.asarray([resource.resource for resource in rows], dtype=str),
+        http_tokens=numpy.asarray([HTTP_TOKENS.index('optional' if resource.imdsv1 else 'required') for resource in rows], dtype=numpy.uint8),
+        endpoint=numpy.asarray([ENDPOINT.index('disabled' if resource.metadata_disabled else 'enabled') for resource in rows], dtype=numpy.uint8),
+        # -1 when the resource has no hop limit, e.g. Sagemaker notebooks
+        hop_limit=numpy.asarray([resource.hop_limit if resource.hop_limit is not None else -1 for resource in rows], dtype=numpy.int16),
+    )
+    return path
+
+
+# All snapshots in a directory as one set of columns, with region and kind codes remapped to shared
+# vocabularies. Resource ids are only read when regressions need them.
+class SnapshotHistory():
+
+    def __init__(self, directory=SNAPSHOT_DIR) -> None:
+        numpy = self.numpy = load_numpy()
+        self.paths = sorted(glob.glob(os.path.join(directory, '*.npz')))
+
+        snapshots = list()
+        for path in self.paths:
+            with numpy.load(path, allow_pickle=False) as data:
+                snapshots.append({key: data[key] for key in data.files if key != 'resource'})
+
+        order = numpy.argsort([float(snapshot['timestamp']) for snapshot in snapshots], kind='stable')
+        snapshots = [snapshots[index] for index in order]
+        self.paths = [self.paths[index] for index in order]
+
+        self.timestamps = numpy.asarray([float(snapshot['timestamp']) for snapshot in snapshots], dtype=numpy.float64)
+        self.account_names, self.accounts = encode([str(snapshot['account']) for snapshot in snapshots])
+        self.weeks = ((self.timestamps - WEEK_OFFSET) // WEEK_SECONDS).astype(numpy.int64)
+
+        self.region_names, self.region = self.merge(snapshots, 'region')
+        self.kind_names, self.kind = self.merge(snapshots, 'kind')
+        self.snapshot = numpy.repeat(numpy.arange(len(snapshots), dtype=numpy.int32), [len(snapshot['region']) for snapshot in snapshots])
+        self.offsets = numpy.r_[0, numpy.cumsum([len(snapshot['region']) for snapshot in snapshots])]
+        self.http_tokens = self.concatenate(snapshots, 'http_tokens', numpy.uint8)
+        self.endpoint = self.concatenate(snapshots, 'endpoint', numpy.uint8)
+        self.hop_limit = self.concatenate(snapshots, 'hop_limit', numpy.int16)
+        self.imdsv1 = self.http_tokens == HTTP_TOKENS.index('optional')
+
+        # Resources and IMDSv1 resources per snapshot and region, the stats are computed from these
+        shape = (len(snapshots), len(self.region_names))
+        cells = self.snapshot.astype(numpy.int64) * len(self.region_names) + self.region
+        self.totals = numpy.bincount(cells, minlength=shape[0] * shape[1]).reshape(shape)
+        self.imdsv1_totals = numpy.bincount(cells[self.imdsv1], minlength=shape[0] * shape[1]).reshape(shape)
+
+
+    def __len__(self):
+        return len(self.timestamps)
+
+
+    def concatenate(self, snapshots, column, dtype):
+        if not snapshots:
+            return self.numpy.zeros(0, dtype=dtype)
+        return self.numpy.concatenate([snapshot[column] for snapshot in snapshots]).astype(dtype)
+
+
+    def merge(self, snapshots, column):
+        numpy = self.numpy
+        if not snapshots:
+            return numpy.zeros(0, dtype=str), numpy.zeros(0, dtype=numpy.uint16)
+
+        vocabulary = numpy.unique(numpy.concatenate([snapshot[f"{column}_names"] for snapshot in snapshots]))
+        codes = [numpy.searchsorted(vocabulary, snapshot[f"{column}_names"]).astype(numpy.uint16)[snapshot[column]] for snapshot in snapshots]
+        return vocabulary, numpy.concatenate(codes)
+
+
+    def resources(self, index):
+        with self.numpy.load(self.paths[index], allow_pickle=False) as data:
+            return data['resource']
+
+
+    def region_keys(self, regions, resources):
+        return self.numpy.char.add(self.numpy.char.add(regions.astype(str), ':'), resources)
+
+
+    # Share of IMDSv1 resources per week, account and region, from each account's last snapshot of the week
+    def weekly_share(self):
+        numpy = self.numpy
+        if not len(self):
+            return list()
+
+        snapshot_keys = (self.weeks - self.weeks.min()) * len(self.account_names) + self.accounts
+        # Snapshots are in time order, so the first occurrence in the reversed keys is the latest
+        _, reversed_index = numpy.unique(snapshot_keys[::-1], return_index=True)
+        latest = numpy.sort(len(self) - 1 - reversed_index)
+
+        snapshot, region = numpy.nonzero(self.totals[latest])
+        snapshot = latest[snapshot]
+        totals = self.totals[snapshot, region]
+        imdsv1 = self.imdsv1_totals[snapshot, region]
+        return [
+            {
+                'week': time.strftime('%Y-%m-%d', time.gmtime(int(self.weeks[snapshot[index]]) * WEEK_SECONDS + WEEK_OFFSET)),
+                'account': str(self.account_names[self.accounts[snapshot[index]]]),
+                'region': str(self.region_names[region[index]]),
+                'resources': int(totals[index]),
+                'imdsv1': int(imdsv1[index]),
+                'share': float(imdsv1[index] / totals[index]),
+            }
+            for index in range(len(snapshot))
+        ]
+
+
+    # IMDSv1 resources removed per day, between each account's last two snapshots and over its whole history
+    def velocity(self):
+        numpy = self.numpy
+        if not len(self):
+            return list()
+
+        imdsv1 = self.imdsv1_totals.sum(axis=1)
+        order = numpy.lexsort((self.timestamps, self.accounts))
+        accounts = self.accounts[order]
+        first = numpy.r_[True, accounts[1:] != accounts[:-1]]
+        last = numpy.r_[accounts[1:] != accounts[:-1], True]
+
+        # Accounts with a single snapshot compare it with itself, which leaves their velocity undefined
+        last_position = numpy.flatnonzero(last)
+        previous_position = numpy.where(first[last_position], last_position, last_position - 1)
+        first_index = order[first]
+        previous_index = order[previous_position]
+        last_index = order[last_position]
+        snapshots = numpy.bincount(self.accounts, minlength=len(self.account_names))
+
+        recent_days = (self.timestamps[last_index] - self.timestamps[previous_index]) / 86400
+        overall_days = (self.timestamps[last_index] - self.timestamps[first_index]) / 86400
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            recent = numpy.where(recent_days > 0, (imdsv1[previous_index] - imdsv1[last_index]) / recent_days, numpy.nan)
+            overall = numpy.where(overall_days > 0, (imdsv1[first_index] - imdsv1[last_index]) / overall_days, numpy.nan)
+
+        return [
+            {
+                'account': str(self.account_names[self.accounts[last_index[index]]]),
+                'snapshots': int(snapshots[self.accounts[last_index[index]]]),
+                'imdsv1': int(imdsv1[last_index[index]]),
+                'recent_per_day': None if numpy.isnan(recent[index]) else float(recent[index]),
+                'overall_per_day': None if numpy.isnan(overall[index]) else float(overall[index]),
+            }
+            for index in range(len(last_index))
+        ]
+
+
+    # Resources that required IMDSv2 in an account's previous snapshot and accept IMDSv1 in its latest
+    def regressions(self):
+        numpy = self.numpy
+        found = list()
+        for account in range(len(self.account_names)):
+            snapshots = numpy.flatnonzero(self.accounts == account)
+            if len(snapshots) < 2:
+                continue
+
+            previous, latest = snapshots[-2], snapshots[-1]
+            previous_rows = slice(self.offsets[previous], self.offsets[previous + 1])
+            latest_rows = slice(self.offsets[latest], self.offsets[latest + 1])
+            required_before = ~self.imdsv1[previous_rows]
+            optional_now = self.imdsv1[latest_rows]
+
+            now_resources = self.resources(latest)[optional_now]
+            now_regions = self.region[latest_rows][optional_now]
+
+            # The same id in another region is another resource, so rows are matched on region and id together
+            before_keys = self.region_keys(self.region[previous_rows][required_before], self.resources(previous)[required_before])
+            now_keys = self.region_keys(now_regions, now_resources)
+            _, _, now_index = numpy.intersect1d(before_keys, now_keys, return_indices=True)
+            for index in numpy.sort(now_index):
+                found.append({
+                    'account': str(self.account_names[account]),
+                    'region': str(self.region_names[now_regions[index]]),
+                    'resource': str(now_resources[index]),
+                    'since': time.strftime('%Y-%m-%d %H:%M', time.gmtime(self.timestamps[previous])),
+                })
+        return found
+
+
+def print_stats(directory=SNAPSHOT_DIR):
+    start = time.perf_counter()
+    history = SnapshotHistory(directory)
+    if not len(history):
+        click.secho(f'[!] No snapshots found in {directory}, record some with "--snapshot".', bold=True, fg='red')
+        return
+
+    share_table = PrettyTable()
+    share_table.align = 'c'
+    share_table.valign = 'c'
+    share_table.field_names = ['Week', 'Account', 'Region', 'Resources', 'IMDSv1', 'IMDSv1 Share (%)']
+    for row in history.weekly_share():
+        share_table.add_row([row['week'], row['account'], row['region'], row['resources'], row['imdsv1'], round(row['share'] * 100, 1)])
+
+    velocity_table = PrettyTable()
+    velocity_table.align = 'c'
+    velocity_table.valign = 'c'
+    velocity_table.field_names = ['Account', 'Snapshots', 'IMDSv1 Now', 'Migrated per Day (last two)', 'Migrated per Day (overall)']
+    for row in history.velocity():
+        velocity_table.add_row([
+            row['account'],
+            row['snapshots'],
+            row['imdsv1'],
+            '-' if row['recent_per_day'] is None else round(row['recent_per_day'], 1),
+            '-' if row['overall_per_day'] is None else round(row['overall_per_day'], 1),
+        ])
+
+    regressions = history.regressions()
+    elapsed = time.perf_counter() - start
+
+    click.echo(f"[+] {len(history)} snapshots, {len(history.snapshot)} resource records, analysed in {round(elapsed * 1000, 1)}ms")
+    click.echo(f"[+] IMDSv1 share by week, account and region:")
+    click.secho(share_table.get_string(), bold=True, fg='yellow')
+    click.echo(f"[+] Migration velocity:")
+    click.secho(velocity_table.get_string(), bold=True, fg='yellow')
+
+    if regressions:
+        regressions_table = PrettyTable()
+        regressions_table.align = 'c'
+        regressions_table.valign = 'c'
+        regressions_table.field_names = ['Account', 'Region', 'Resource', 'Required IMDSv2 At']
+        for row in regressions:
+            regressions_table.add_row([row['account'], row['region'], row['resource'], row['since']])
+
+        click.secho(f"[!] Resources that accept IMDSv1 again ({len(regressions)}):", bold=True, fg='red')
+        click.secho(regressions_table.get_string(), bold=True, fg='yellow')
+    else:
+        click.echo(f"[+] No regressions since the previous snapshot.")
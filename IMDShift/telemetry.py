@@ -0,0 +1,304 @@
+import click
+import functools
+import json
+import threading
+import time
+
+from contextlib import contextmanager
+from prettytable import PrettyTable
+
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+THROTTLING_ERROR_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'TransactionInProgressException',
+    'RequestLimitExceeded',
+    'BandwidthLimitExceeded',
+    'LimitExceededException',
+    'RequestThrottled',
+    'SlowDown',
+    'PriorRequestNotComplete',
+    'EC2ThrottledException',
+]
+
+
+class Telemetry():
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.api_calls = dict()
+        self.phases = dict()
+        # phase -> threads currently in it, and the (start, end) periods it had at least one
+        self.active = dict()
+        self.periods = dict()
+
+
+    def enable(self):
+        self.enabled = True
+
+
+    def reset(self):
+        with self.lock:
+            self.api_calls = dict()
+            self.phases = dict()
+            self.active = dict()
+            self.periods = dict()
+
+
+    def instrument(self, client):
+        if not self.enabled or client is None:
+            return client
+
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        client.meta.events.register('before-call.*.*', functools.partial(self.before_call, service, region))
+        client.meta.events.register('after-call.*.*', self.after_call)
+        client.meta.events.register('after-call-error.*.*', self.after_call_error)
+        client.meta.events.register('needs-retry.*.*', functools.partial(self.needs_retry, service, region))
+        return client
+
+
+    def stats_for(self, key):
+        if key not in self.api_calls:
+            self.api_calls[key] = {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'response_bytes': 0,
+                'latency_sum': 0.0,
+                'latency_max': 0.0,
+                'latency_buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        return self.api_calls[key]
+
+
+    def record_call(self, key, start, http_response=None, parsed=None):
+        latency = time.perf_counter() - start
+        retries = 0
+        response_bytes = 0
+        error = parsed is None or 'Error' in parsed
+
+        if parsed:
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if http_response is not None:
+            # Never touch http_response.content here, it would consume streaming bodies
+            content_length = http_response.headers.get('content-length')
+            if content_length:
+                response_bytes = int(content_length)
+            else:
+                response_bytes = len(getattr(http_response, '_content', None) or b'')
+
+        bucket = len(LATENCY_BUCKETS)
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if latency <= upper_bound:
+                bucket = index
+                break
+
+        with self.lock:
+            stats = self.stats_for(key)
+            stats['calls'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['retries'] += retries
+            stats['response_bytes'] += response_bytes
+            stats['latency_sum'] += latency
+            stats['latency_max'] = max(stats['latency_max'], latency)
+            stats['latency_buckets'][bucket] += 1
+
+
+    # botocore event handlers, these must always return None to leave the request untouched
+    def before_call(self, service, region, model, context, **kwargs):
+        context['imdshift_telemetry'] = ((service, model.name, region), time.perf_counter())
+
+
+    def after_call(self, http_response, parsed, context, **kwargs):
+        if 'imdshift_telemetry' in context:
+            self.record_call(*context.pop('imdshift_telemetry'), http_response=http_response, parsed=parsed)
+
+
+    def after_call_error(self, context, **kwargs):
+        if 'imdshift_telemetry' in context:
+            self.record_call(*context.pop('imdshift_telemetry'))
+
+
+    def needs_retry(self, service, region, operation, response=None, **kwargs):
+        if response is None:
+            return
+
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERROR_CODES:
+            with self.lock:
+                self.stats_for((service, operation.name, region))['throttles'] += 1
+
+
+    def enter_phase(self, name, now):
+        with self.lock:
+            if not self.active.get(name):
+                self.periods.setdefault(name, list()).append([now, None])
+            self.active[name] = self.active.get(name, 0) + 1
+
+
+    def leave_phase(self, name, now):
+        with self.lock:
+            self.active[name] -= 1
+            if not self.active[name]:
+                period = self.periods[name][-1]
+                period[1] = now
+                self.phases[name] = self.phases.get(name, 0.0) + now - period[0]
+
+
+    # Phases nest (discovery -> analysis), a thread is only in its innermost phase. A phase's time is
+    # wall-clock time during which at least one thread was in it, so threads working in the same phase
+    # at once are counted once, and different phases running on different threads overlap.
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.local.__dict__.setdefault('stack', list())
+        now = time.perf_counter()
+        if stack:
+            self.leave_phase(stack[-1], now)
+        self.enter_phase(name, now)
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+            now = time.perf_counter()
+            self.leave_phase(name, now)
+            if stack:
+                self.enter_phase(stack[-1], now)
+
+
+    # Wall-clock time during which at least one of the phases was running, finished periods only
+    def wall_time(self, *names):
+        with self.lock:
+            periods = sorted(tuple(period) for name in names for period in self.periods.get(name, list()) if period[1] is not None)
+
+        total = 0.0
+        start, end = None, None
+        for period_start, period_end in periods:
+            if end is None or period_start > end:
+                total += end - start if end is not None else 0.0
+                start, end = period_start, period_end
+            else:
+                end = max(end, period_end)
+        return total + (end - start if end is not None else 0.0)
+
+
+    def print_summary(self):
+        api_table = PrettyTable()
+        api_table.align = 'c'
+        api_table.valign = 'c'
+        api_table.field_names = ['Service', 'Operation', 'Region', 'Calls', 'Errors', 'Retries', 'Throttles', 'Avg Latency (ms)', 'Max Latency (ms)', 'Response Bytes']
+
+        for (service, operation, region), stats in sorted(self.api_calls.items(), key=lambda item: -item[1]['latency_sum']):
+            api_table.add_row(
+                [
+                    service,
+                    operation,
+                    region,
+                    stats['calls'],
+                    stats['errors'],
+                    stats['retries'],
+                    stats['throttles'],
+                    round(stats['latency_sum'] / stats['calls'] * 1000, 1) if stats['calls'] else 0,
+                    round(stats['latency_max'] * 1000, 1),
+                    stats['response_bytes']
+                ]
+            )
+
+        phase_table = PrettyTable()
+        phase_table.align = 'c'
+        phase_table.valign = 'c'
+        phase_table.field_names = ['Phase', 'Wall Time (s)']
+
+        for name, elapsed in self.phases.items():
+            phase_table.add_row([name, round(elapsed, 3)])
+
+        click.echo(f"\n[+] API call telemetry:")
+        click.secho(api_table.get_string(), bold=True, fg='yellow')
+        click.echo(f"[+] Phase timings:")
+        click.secho(phase_table.get_string(), bold=True, fg='yellow')
+
+
+    def to_dict(self):
+        return {
+            'latency_buckets': LATENCY_BUCKETS,
+            'api_calls': [
+                dict(service=service, operation=operation, region=region, **stats)
+                for (service, operation, region), stats in self.api_calls.items()
+            ],
+            'phases': dict(self.phases),
+        }
+
+
+    def to_prometheus(self):
+        lines = list()
+
+        counters = [
+            ('calls', 'imdshift_api_calls_total', 'Number of AWS API calls made.'),
+            ('errors', 'imdshift_api_errors_total', 'Number of AWS API calls that failed.'),
+            ('retries', 'imdshift_api_retries_total', 'Number of retry attempts made by botocore.'),
+            ('throttles', 'imdshift_api_throttles_total', 'Number of throttled AWS API attempts.'),
+            ('response_bytes', 'imdshift_api_response_bytes_total', 'Bytes received in AWS API responses.'),
+        ]
+
+        for field, metric, description in counters:
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} counter')
+            for (service, operation, region), stats in self.api_calls.items():
+                lines.append(f'{metric}{{service="{service}",operation="{operation}",region="{region}"}} {stats[field]}')
+
+        metric = 'imdshift_api_call_duration_seconds'
+        lines.append(f'# HELP {metric} Latency of AWS API calls, including retries.')
+        lines.append(f'# TYPE {metric} histogram')
+        for (service, operation, region), stats in self.api_calls.items():
+            labels = f'service="{service}",operation="{operation}",region="{region}"'
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS + ['+Inf'], stats['latency_buckets']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{labels}}} {stats["latency_sum"]}')
+            lines.append(f'{metric}_count{{{labels}}} {stats["calls"]}')
+
+        metric = 'imdshift_phase_duration_seconds'
+        lines.append(f'# HELP {metric} Wall-clock time spent in each IMDShift phase.')
+        lines.append(f'# TYPE {metric} gauge')
+        for name, elapsed in self.phases.items():
+            lines.append(f'{metric}{{phase="{name}"}} {elapsed}')
+
+        return '\n'.join(lines) + '\n'
+
+
+    def dump(self, path):
+        with open(path, 'w') as output_file:
+            if path.endswith('.prom'):
+                output_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), output_file, indent=2)
+
+        click.echo(f"[+] Telemetry written to {path}")
+
+
+def phase(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with TELEMETRY.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+TELEMETRY = Telemetry()
@@ -0,0 +1,114 @@
+import functools
+import threading
+import time
+
+
+# (bucket size, refill per second) token buckets for the calls IMDShift makes. The EC2 and STS
+# values are the documented defaults, the others are conservative assumptions. Calls not listed
+# here get DEFAULT_RATE_LIMIT.
+API_RATE_LIMITS = {
+    # Discovery
+    'ec2:DescribeRegions': (100, 20),
+    'ec2:DescribeInstances': (100, 20),
+    'ec2:DescribeLaunchTemplateVersions': (100, 20),
+    'ec2:GetInstanceMetadataDefaults': (100, 20),
+    'autoscaling:DescribeAutoScalingGroups': (40, 10),
+    'ecs:ListClusters': (50, 20),
+    'ecs:ListContainerInstances': (50, 20),
+    'ecs:DescribeContainerInstances': (50, 20),
+    'eks:ListClusters': (20, 10),
+    'eks:ListNodegroups': (20, 10),
+    'eks:DescribeNodegroup': (20, 10),
+    'sagemaker:ListNotebookInstances': (20, 10),
+    'sagemaker:DescribeNotebookInstance': (20, 10),
+    'lightsail:GetInstances': (20, 5),
+    'elasticbeanstalk:DescribeEnvironments': (20, 5),
+    'elasticbeanstalk:DescribeEnvironmentResources': (20, 5),
+    'elasticbeanstalk:DescribeConfigurationSettings': (20, 5),
+    # Changes
+    'ec2:ModifyInstanceMetadataOptions': (200, 5),
+    'ec2:ModifyInstanceMetadataDefaults': (200, 5),
+    'ec2:CreateLaunchTemplateVersion': (100, 2),
+    'ec2:ModifyLaunchTemplate': (100, 2),
+    'autoscaling:UpdateAutoScalingGroup': (20, 2),
+    'eks:UpdateNodegroupVersion': (10, 1),
+    'elasticbeanstalk:UpdateEnvironment': (10, 1),
+    'lightsail:UpdateInstanceMetadataOptions': (10, 2),
+    'sagemaker:UpdateNotebookInstance': (10, 1),
+    'sts:AssumeRole': (600, 600),
+    'cloudwatch:GetMetricData': (50, 50),
+}
+DEFAULT_RATE_LIMIT = (20, 5)
+
+
+class TokenBucket():
+
+    def __init__(self, size, refill) -> None:
+        self.size = size
+        self.refill = refill
+        self.tokens = float(size)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.size, self.tokens + (now - self.updated) * self.refill)
+            self.updated = now
+            # Tokens are reserved up front, so concurrent callers queue up behind each other instead of racing
+            self.tokens -= 1
+            wait = -self.tokens / self.refill if self.tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+# Keeps concurrent services within each API's rate limit, per region, so they do not throttle each other
+class RateLimiter():
+
+    def __init__(self) -> None:
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.waited = dict()
+
+
+    def reset(self):
+        with self.lock:
+            self.buckets = dict()
+            self.waited = dict()
+
+
+    def install(self, client):
+        if client is None:
+            return client
+
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        client.meta.events.register('before-call.*.*', functools.partial(self.before_call, service, region))
+        return client
+
+
+    def bucket_for(self, operation, region):
+        with self.lock:
+            if (operation, region) not in self.buckets:
+                self.buckets[(operation, region)] = TokenBucket(*API_RATE_LIMITS.get(operation, DEFAULT_RATE_LIMIT))
+            return self.buckets[(operation, region)]
+
+
+    # botocore event handler, this must always return None to leave the request untouched
+    def before_call(self, service, region, model, **kwargs):
+        operation = f"{service}:{model.name}"
+        # Every call is paced, with the same limits the planner estimates with
+        if not self.enabled:
+            return
+
+        wait = self.bucket_for(operation, region).acquire()
+        if wait:
+            with self.lock:
+                self.waited[operation] = self.waited.get(operation, 0.0) + wait
+
+
+LIMITER = RateLimiter()
@@ -1,16 +1,27 @@
 import click
+import contextlib
+import contextvars
 import sys
+import time
 
-from .AWS import AWS_Utils
-from .AWS import EC2, Sagemaker, ASG, Lightsail, ECS, EKS, Beanstalk
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .AWS import AWS_Utils, REGION_CACHE_TTL
+from .AWS import EC2, Sagemaker, ASG, Lightsail, ECS, EKS, Beanstalk, LaunchTemplates
+from .reporting import REPORTER, BufferedReporter
+from .resilience import GUARD
+from .scheduling import longest_first
 
 
 SERVICES_LIST = ['EC2', 'SAGEMAKER', 'ASG', 'LIGHTSAIL', 'ECS', 'EKS', 'BEANSTALK', 'AUTOSCALING']
 
+# Services that change the same resources run one after another in the same worker, Auto Scaling
+# groups and EKS nodegroups can share launch templates
+SERVICE_GROUPS = {'ASG': 'LAUNCH_TEMPLATES', 'AUTOSCALING': 'LAUNCH_TEMPLATES', 'EKS': 'LAUNCH_TEMPLATES'}
+
 class ScanRegion():
-    def __init__(self, included_regions=None, excluded_regions=None, profile=None, role_arn=None):
+    def __init__(self, included_regions=None, excluded_regions=None, profile=None, role_arn=None, region_cache_ttl=REGION_CACHE_TTL):
         self.aws_utils = AWS_Utils()
-        self.all_regions = self.aws_utils.get_enabled_regions(profile, role_arn)
         self.included_regions = included_regions or "ALL"
         self.excluded_regions = excluded_regions or []
 
@@ -18,22 +29,30 @@ class ScanRegion():
             self.included_regions = self.included_regions.split(",")
             if "ALL" not in self.included_regions:
                 self.included_regions = [region.strip(" ") for region in self.included_regions]
-            else:
-                self.scan_regions = self.all_regions
         else:
             self.included_regions = list(self.included_regions)
 
+        # Explicit region lists are only validated against the cache, they never trigger a lookup
+        if "ALL" in self.included_regions:
+            self.all_regions = self.aws_utils.get_enabled_regions(profile, role_arn, region_cache_ttl)
+        else:
+            self.all_regions = self.aws_utils.get_cached_regions(profile, role_arn, region_cache_ttl)
+
         self.scan_regions = []
 
         if "ALL" in self.included_regions:
-            self.scan_regions = self.all_regions
+            self.scan_regions = list(self.all_regions)
         else:
             for region in self.included_regions:
-                if region in self.all_regions:
+                if self.all_regions is None or region in self.all_regions:
                     self.scan_regions.append(region)
+                else:
+                    REPORTER.echo(f'[!] "{region}" is either invalid region or is not enabled. Skipping.', bold=True, fg='red')
 
         if isinstance(self.excluded_regions, str):
             self.excluded_regions = self.excluded_regions.split(",")
+
+        if self.excluded_regions:
             if "ALL" in self.included_regions:
                 self.excluded_regions = [region.strip(" ") for region in self.excluded_regions]
                 self.scan_regions = [region for region in self.all_regions if region not in self.excluded_regions]
@@ -44,7 +63,7 @@ class ScanRegion():
                         self.scan_regions.remove(region)
 
         if not self.scan_regions:
-            print("No regions to scan.")
+            REPORTER.echo("No regions to scan.")
             return
 
     def result(self):
@@ -54,135 +73,177 @@ class ScanRegion():
 def check_imdsv1_usage(regions=None, profile=None, role_arn=None):
     ec2_obj = EC2(regions=regions, profile=profile, role_arn=role_arn)
     ec2_obj.generate_imdsv1_usage_result()
+    return ec2_obj.imdsv1_usage_analysis
+
+
+def scan_service(service, regions=None, profile=None, role_arn=None):
+    if service == 'EC2':
+        ec2_obj = EC2(regions=regions, profile=profile, role_arn=role_arn)
+        ec2_obj.generate_result()
+        return [ec2_obj]
+
+    elif service == 'ECS':
+        # ECS runs on EC2 instances, which are analysed and migrated through an EC2 object
+        ec2_obj = EC2(regions=None, profile=profile, role_arn=role_arn)
+        ECS(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn).generate_results()
+        return [ec2_obj]
+
+    elif service in ['EKS', 'ASG', 'AUTOSCALING']:
+        # Instances are migrated through an EC2 object, the launch templates they are created from separately
+        ec2_obj = EC2(regions=None, profile=profile, role_arn=role_arn)
+        launch_templates_obj = LaunchTemplates(profile=profile, role_arn=role_arn)
+        scanner_class = {'EKS': EKS, 'ASG': ASG, 'AUTOSCALING': ASG}[service]
+        scanner_class(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn, launch_templates=launch_templates_obj).generate_results()
+        return [ec2_obj, launch_templates_obj]
+
+    elif service == 'LIGHTSAIL':
+        lightsail_obj = Lightsail(regions=regions, profile=profile, role_arn=role_arn)
+        lightsail_obj.generate_result()
+        return [lightsail_obj]
+
+    elif service == 'SAGEMAKER':
+        sagemaker_obj = Sagemaker(regions=regions, profile=profile, role_arn=role_arn)
+        sagemaker_obj.generate_result()
+        return [sagemaker_obj]
+
+    elif service == 'BEANSTALK':
+        # Environment instances are migrated through an EC2 object, the environments' own settings separately
+        ec2_obj = EC2(regions=None, profile=profile, role_arn=role_arn)
+        beanstalk_obj = Beanstalk(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn)
+        beanstalk_obj.generate_results()
+        return [ec2_obj, beanstalk_obj]
+
+    return []
+
+
+def remediation_steps(service, migrate=False, update_hop_limit=None, enable_imds=False, migrate_templates=False, set_account_defaults=False):
+    if service == 'SAGEMAKER':
+        return [('migrate', None)] if migrate else []
+
+    steps = []
+    if update_hop_limit != None:
+        steps.append(('update_hop_limit', update_hop_limit))
+    if enable_imds:
+        steps.append(('enable_metadata', update_hop_limit))
+    # Defaults first, so instances launched during the migration are already compliant
+    if migrate and set_account_defaults:
+        steps.append(('set_account_defaults', update_hop_limit))
+    if migrate:
+        steps.append(('migrate', update_hop_limit))
+    if migrate_templates:
+        steps.append(('migrate_templates', update_hop_limit))
+        # Beanstalk environments launch from their own DisableIMDSv1 setting rather than a launch template
+        steps.append(('migrate_environments', None))
+    return steps
+
+
+def apply_remediation_step(scanner, step, hop_limit=None, enable_imds=False):
+    if step == 'update_hop_limit':
+        scanner.update_hop_limit_for_resources(hop_limit)
+    elif step == 'enable_metadata':
+        scanner.enable_metadata_for_resources(hop_limit)
+    elif step == 'set_account_defaults':
+        scanner.set_account_defaults(hop_limit)
+    elif step == 'migrate':
+        scanner.migrate_resources(hop_limit)
+    elif step == 'migrate_templates':
+        scanner.migrate_launch_templates(hop_limit, enable_imds)
+    elif step == 'migrate_environments':
+        scanner.migrate_environments()
+
+
+def remediate(service, scanners, migrate=False, update_hop_limit=None, enable_imds=False, \
+              migrate_templates=False, set_account_defaults=False, planner=None):
+    for step, hop_limit in remediation_steps(service, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults):
+        for scanner in scanners:
+            if step not in scanner.STEPS:
+                continue
+
+            # New launch template versions only enable the metadata endpoint if --enable-imds was requested too
+            options = {'enable_imds': enable_imds} if step == 'migrate_templates' else {}
+            if planner:
+                planner.add(service, scanner.planned_changes(step, hop_limit, **options))
+            else:
+                apply_remediation_step(scanner, step, hop_limit, **options)
 
-    sys.exit(0)
-
-
-def trigger_scan(services, regions=None, migrate=False, \
-                 update_hop_limit=None, enable_imds=False, \
-                    profile = None, role_arn=None):
-
-        for service in SERVICES_LIST:
-
-            if service in services:
-                click.echo(f"\n[+] Fetching all {service} resources")
-
-                services.pop(services.index(service))
-
-                if service == 'EC2':
-                    ec2_obj = EC2(regions=regions, profile=profile, role_arn=role_arn)
-                    ec2_obj.generate_result()
-
-                    if update_hop_limit != None:
-                        ec2_obj.update_hop_limit_for_resources(update_hop_limit)
-
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources(update_hop_limit)
-
-                        if migrate:
-                            ec2_obj.migrate_resources(update_hop_limit)
-
-                    else:
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources(update_hop_limit)
-
-                        if migrate:
-                            ec2_obj.migrate_resources(update_hop_limit)
-
-                
-                elif service == "ECS":
-                    ec2_obj = EC2(regions=None, profile=profile, role_arn=role_arn)
-                    ecs_obj = ECS(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn)
-                    ecs_obj.generate_results()
-                    ecs_obj.ecs 
-                    if update_hop_limit != None:
-                        ec2_obj.update_hop_limit_for_resources(update_hop_limit)
-
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources(update_hop_limit)
-
-                        if migrate:
-                            ec2_obj.migrate_resources(update_hop_limit)
-
-                    else:
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources()
-
-                        if migrate:
-                            ec2_obj.migrate_resources()
-                
-                
-                elif service == "EKS":
-                    ec2_obj = EC2(region=None, profile=profile, role_arn=role_arn)
-                    eks_obj = EKS(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn)
-                    eks_obj.generate_results()
-
-                    if update_hop_limit != None:
-                        ec2_obj.update_hop_limit_for_resources(update_hop_limit)
-
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources(update_hop_limit)
-
-                        if migrate:
-                            ec2_obj.migrate_resources(update_hop_limit)
-
-                    else:
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources()
-
-                        if migrate:
-                            ec2_obj.migrate_resources()
-
-
-                elif service == "ASG" or service == "AUTOSCALING":
-                    ec2_obj = EC2(region=None, profile=profile, role_arn=role_arn)
-                    asg_obj = ASG(regions=regions, ec2_obj=ec2_obj, profile=profile, role_arn=role_arn)
-                    asg_obj.generate_results()
-                
-                    if update_hop_limit != None:
-                        ec2_obj.update_hop_limit_for_resources(update_hop_limit)
-
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources(update_hop_limit)
-
-                        if migrate:
-                            ec2_obj.migrate_resources(update_hop_limit)
-
-                    else:
-                        if enable_imds:
-                            ec2_obj.enable_metadata_for_resources()
-
-                        if migrate:
-                            ec2_obj.migrate_resources()
-
-
-                elif service == 'LIGHTSAIL':
-                    lightsail_obj = Lightsail(regions=regions, profile=profile, role_arn=role_arn)
-                    lightsail_obj.generate_result()
-
-                    if update_hop_limit != None:
-                        lightsail_obj.update_hop_limit_for_resources(update_hop_limit)
 
-                        if enable_imds:
-                            lightsail_obj.enable_metadata_for_resources(update_hop_limit)
+def scan_and_remediate(services, regions=None, migrate=False, update_hop_limit=None, enable_imds=False, \
+                       profile=None, role_arn=None, planner=None, migrate_templates=False, set_account_defaults=False, reporter=None, history=None):
+    results = dict()
+    location = f" in {regions[0]}" if regions and len(regions) == 1 else ""
+    account = AWS_Utils().account_key(profile, role_arn)
 
-                        if migrate:
-                            lightsail_obj.migrate_resources(update_hop_limit)
+    with REPORTER.use(reporter) if reporter else contextlib.nullcontext():
+        for service in services:
+            REPORTER.echo(f"\n[+] Fetching all {service} resources{location}")
 
-                    else:
-                        if enable_imds:
-                            lightsail_obj.enable_metadata_for_resources(update_hop_limit)
+            start = time.perf_counter()
+            scanners = scan_service(service, regions=regions, profile=profile, role_arn=role_arn)
+            discovered = time.perf_counter()
+            remediate(service, scanners, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults, planner)
+            results[service] = scanners
 
-                        if migrate:
-                            lightsail_obj.migrate_resources(update_hop_limit)
+            # Durations are only comparable for single region units, plans change nothing so they are not mutation times
+            if history and location:
+                history.record(account, regions[0], service, 'discovery', discovered - start)
+                if not planner and remediation_steps(service, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults):
+                    history.record(account, regions[0], service, 'mutation', time.perf_counter() - discovered)
+    return results
 
 
-                elif service == 'SAGEMAKER':
-                    sagemaker_obj = Sagemaker(regions=regions, profile=profile, role_arn=role_arn)
-                    sagemaker_obj.generate_result()
+def trigger_scan(services, regions=None, migrate=False, \
+                 update_hop_limit=None, enable_imds=False, \
+                    profile = None, role_arn=None, planner=None, migrate_templates=False, set_account_defaults=False, max_concurrency=1, history=None):
 
-                    if migrate: 
-                        sagemaker_obj.migrate_resources()
+        groups = dict()
+        for service in SERVICES_LIST:
+            if service in services:
+                groups.setdefault(SERVICE_GROUPS.get(service, service), list()).append(service)
+
+        options = dict(migrate=migrate, update_hop_limit=update_hop_limit, enable_imds=enable_imds, profile=profile, role_arn=role_arn,
+                       planner=planner, migrate_templates=migrate_templates, set_account_defaults=set_account_defaults)
+
+        # Claims only dedupe changes within one run
+        GUARD.release_claims()
+
+        # The scanners of each service, as found before any remediation
+        results = dict()
+        units = [(group, region) for group in groups.values() for region in regions or []]
+        if max_concurrency <= 1 or len(units) <= 1:
+            for group in groups.values():
+                results.update(scan_and_remediate(group, regions=regions, **options))
+            return results
+
+        # Each service group and region is a unit of work, started longest first according to previous runs
+        if history:
+            account = AWS_Utils().account_key(profile, role_arn)
+            mutating = not planner and any(remediation_steps(service, migrate, update_hop_limit, enable_imds, migrate_templates, set_account_defaults) for service in services)
+            units = longest_first(units, [history.estimate(account, region, group, mutating) for group, region in units])
+
+        # Workers run in a copy of this context, so they report through the caller's reporter, and their
+        # output is buffered and printed one unit at a time as each finishes
+        parent = REPORTER.reporter()
+        futures = dict()
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='imdshift') as executor:
+            for group, region in units:
+                reporter = BufferedReporter(parent)
+                future = executor.submit(contextvars.copy_context().run, scan_and_remediate, group, regions=[region], reporter=reporter, history=history, **options)
+                futures[future] = reporter
+
+            for future in as_completed(futures):
+                futures[future].flush()
+
+        for future in futures:
+            for service, scanners in future.result().items():
+                results.setdefault(service, list()).extend(scanners)
+
+        if history:
+            history.save()
+
+        # Keep plans grouped by service and region, as in a sequential run
+        if planner:
+            planner.changes.sort(key=lambda change: (SERVICES_LIST.index(change.service), regions.index(change.region) if change.region in regions else len(regions)))
+        return {service: results[service] for service in SERVICES_LIST if service in results}
 
 def print_policies():
     SCPS_STRINGS = """
@@ -274,9 +335,6 @@ def print_policies():
     click.secho("  * https://aws.amazon.com/blogs/machine-learning/amazon-sagemaker-notebook-instances-now-support-configuring-and-restricting-imds-versions/", fg='yellow')
 
 
-    sys.exit(0)
-
-
 def validate_services(services):
     for service in services:
         if service not in SERVICES_LIST:
@@ -0,0 +1,385 @@
+import click
+import collections
+import contextlib
+import copy
+import io
+import os
+import sys
+import tempfile
+
+from prettytable import PrettyTable
+
+# Clients are created for real, they just never leave the process
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from IMDShift import api
+from IMDShift.AWS import AWS_Utils
+from IMDShift.planner import Planner
+from IMDShift.resilience import GUARD
+from IMDShift.service import ComplianceService
+from IMDShift.snapshots import SnapshotHistory, save_snapshot
+from IMDShift.throttling import LIMITER
+from IMDShift.utilities import trigger_scan
+
+from .fake_aws import FakeAWS
+from .fleet import SyntheticFleet
+
+
+REGION = 'us-east-1'
+
+OPTIONAL = {'HttpTokens': 'optional', 'HttpPutResponseHopLimit': 1, 'HttpEndpoint': 'enabled', 'State': 'applied'}
+REQUIRED = {'HttpTokens': 'required', 'HttpPutResponseHopLimit': 2, 'HttpEndpoint': 'enabled', 'State': 'applied'}
+
+
+# Templates with several versions, $Latest and $Default consumers and a template shared by an
+# Auto Scaling group and a nodegroup, each consumer named after what it launches
+def launch_template_fleet():
+    fleet = SyntheticFleet(regions=[REGION], instances=0, asgs=0, ecs_clusters=0, eks_clusters=0, notebooks=0, lightsail=0, beanstalk_environments=0)
+    fleet.account_defaults[REGION] = dict()
+
+    # Newest version uses IMDSv1, the default does not
+    template = fleet.add_launch_template(REGION, 'newest-imdsv1', versions=0, default=2)
+    for options in [OPTIONAL, REQUIRED, OPTIONAL]:
+        fleet.add_launch_template_version(template, dict(options))
+    for name, version in [('latest', '$Latest'), ('default', '$Default'), ('1', '1'), ('2', '2')]:
+        fleet.add_asg(REGION, f"newest-imdsv1-{name}", 1, template_id=template, version=version)
+
+    # Only an older version uses IMDSv1, migrating it must not change what $Latest launches
+    template = fleet.add_launch_template(REGION, 'older-imdsv1', versions=0, default=1)
+    for options in [OPTIONAL, REQUIRED]:
+        fleet.add_launch_template_version(template, dict(options))
+    for name, version in [('latest', '$Latest'), ('default', '$Default'), ('1', '1')]:
+        fleet.add_asg(REGION, f"older-imdsv1-{name}", 1, template_id=template, version=version)
+
+    # Endpoint disabled on purpose, only versions allowing IMDSv1 are migrated and the endpoint stays disabled
+    template = fleet.add_launch_template(REGION, 'endpoint-disabled', versions=0, default=1)
+    for options in [dict(REQUIRED, HttpEndpoint='disabled'), dict(OPTIONAL, HttpEndpoint='disabled')]:
+        fleet.add_launch_template_version(template, options)
+    for name, version in [('latest', '$Latest'), ('1', '1')]:
+        fleet.add_asg(REGION, f"endpoint-disabled-{name}", 1, template_id=template, version=version)
+
+    # Shared by a group launching $Default and a nodegroup pinned to the same version
+    template = fleet.add_launch_template(REGION, 'shared', versions=0, default=1)
+    for options in [OPTIONAL, REQUIRED]:
+        fleet.add_launch_template_version(template, dict(options))
+    fleet.add_asg(REGION, 'shared-default', 1, template_id=template, version='$Default')
+    fleet.add_asg(REGION, 'eks-shared-nodegroup', 1, nodegroup='nodegroup', template_id=template, version='1')
+    fleet.eks_clusters[REGION]['shared'] = {
+        'nodegroup': {'asg_name': 'eks-shared-nodegroup', 'launchTemplate': {'id': template, 'name': 'shared', 'version': '1'}},
+    }
+    return fleet
+
+
+def launches(fleet):
+    return {
+        (region, name): copy.deepcopy(fleet.launched_version(region, name))
+        for region in fleet.regions for name, as_group in fleet.asgs[region].items()
+        if 'LaunchTemplate' in as_group or 'MixedInstancesPolicy' in as_group
+    }
+
+
+@contextlib.contextmanager
+def served(fleet):
+    fake_aws = FakeAWS(fleet)
+    AWS_Utils.register_client_hook(fake_aws.install)
+    GUARD.reset()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            yield fake_aws
+    finally:
+        AWS_Utils.unregister_client_hook(fake_aws.install)
+
+
+def migrate(fleet, enable_imds=False, plan=False):
+    planner = Planner() if plan else None
+    with served(fleet):
+        trigger_scan(services=['ASG', 'EKS'], regions=fleet.regions, enable_imds=enable_imds, migrate_templates=True, planner=planner)
+    return planner
+
+
+def managed_by_eks(fleet, region, name):
+    return any(
+        nodegroup['asg_name'] == name and not nodegroup['launchTemplate']
+        for cluster in fleet.eks_clusters[region].values() for nodegroup in cluster.values()
+    )
+
+
+# Every consumer launches the same image as before, only requiring IMDSv2, with the endpoint
+# left as it was unless it was enabled on purpose
+def launch_problems(fleet, before, after, enable_imds=False):
+    problems = list()
+    for (region, name), previous in before.items():
+        current = after[(region, name)]
+        previous_data = dict(previous['LaunchTemplateData'])
+        current_data = dict(current['LaunchTemplateData'])
+        previous_options = previous_data.pop('MetadataOptions', dict())
+        current_options = current_data.pop('MetadataOptions', dict())
+
+        if previous_data != current_data:
+            problems.append(f"{name} launches {current_data.get('ImageId')} instead of {previous_data.get('ImageId')}")
+        # Groups on the EKS managed template are only reported, never changed
+        if managed_by_eks(fleet, region, name):
+            continue
+        if current_options.get('HttpTokens') != 'required':
+            problems.append(f"{name} launches version {current['VersionNumber']}, which allows IMDSv1")
+        # Only versions that are migrated get the endpoint enabled, compliant ones are left alone
+        migrated = previous_options.get('HttpTokens') != 'required'
+        expected_endpoint = 'enabled' if enable_imds and migrated else previous_options.get('HttpEndpoint')
+        if current_options.get('HttpEndpoint') != expected_endpoint:
+            problems.append(f"{name} launches with the metadata endpoint {current_options.get('HttpEndpoint')}, expected {expected_endpoint}")
+    return problems
+
+
+def check_launch_templates(fleet, enable_imds=False):
+    before = launches(fleet)
+    migrate(fleet, enable_imds)
+    return launch_problems(fleet, before, launches(fleet), enable_imds)
+
+
+def check_explicit_versions():
+    fleet = launch_template_fleet()
+    problems = check_launch_templates(fleet)
+
+    expected = {
+        'newest-imdsv1-latest': 'ami-{}-3', 'newest-imdsv1-default': 'ami-{}-2', 'newest-imdsv1-1': 'ami-{}-1',
+        'older-imdsv1-latest': 'ami-{}-2', 'older-imdsv1-default': 'ami-{}-1', 'older-imdsv1-1': 'ami-{}-1',
+        'shared-default': 'ami-{}-1', 'eks-shared-nodegroup': 'ami-{}-1',
+    }
+    for name, image in expected.items():
+        launched = fleet.launched_version(REGION, name)
+        image = image.format(launched['LaunchTemplateId'][3:])
+        if launched['LaunchTemplateData']['ImageId'] != image:
+            problems.append(f"{name} launches {launched['LaunchTemplateData']['ImageId']}, expected {image}")
+
+    # Already compliant versions are left alone, whatever their endpoint setting
+    if fleet.launched_version(REGION, 'endpoint-disabled-1')['VersionNumber'] != 1:
+        problems.append("endpoint-disabled-1 was moved off a version that already requires IMDSv2")
+    return problems
+
+
+def check_planned_consumers():
+    fleet = launch_template_fleet()
+    before = launches(fleet)
+    planner = migrate(fleet, plan=True)
+
+    problems = list()
+    if launches(fleet) != before:
+        problems.append("planning changed the fleet")
+
+    planned = set(change.resource for change in planner.changes)
+    for name in ['newest-imdsv1-latest', 'older-imdsv1-latest', 'endpoint-disabled-latest']:
+        if name not in planned:
+            problems.append(f"{name} launches $Latest but is missing from the plan")
+    return problems
+
+
+# A plan for --enable-imds must not leak into a later apply without it
+def check_plan_then_apply():
+    fleet = launch_template_fleet()
+    before = launches(fleet)
+    with served(fleet):
+        scan_result = api.scan(['ASG', 'EKS'], regions=REGION, region_cache_ttl=0)
+        api.plan(scan_result, migrate=False, enable_imds=True, migrate_templates=True)
+        api.apply(scan_result, migrate=False, migrate_templates=True)
+    return launch_problems(fleet, before, launches(fleet))
+
+
+# Instances found by several services are planned once, as they are changed once
+def check_planned_calls():
+    fleet = SyntheticFleet(regions=['check-region-1', 'check-region-2'], instances=20, seed=3)
+    planner = Planner()
+    with served(fleet):
+        trigger_scan(services=['EC2', 'ASG', 'ECS', 'EKS', 'BEANSTALK'], regions=fleet.regions, migrate=True, planner=planner)
+    planned = dict()
+    for change in planner.changes:
+        if change.operation:
+            planned[change.operation] = planned.get(change.operation, 0) + 1
+
+    with served(fleet) as fake_aws:
+        calls = dict()
+        for (service, operation), handler in fake_aws.handlers.items():
+            fake_aws.handlers[(service, operation)] = counted(calls, f"{service}:{operation}", handler)
+        trigger_scan(services=['EC2', 'ASG', 'ECS', 'EKS', 'BEANSTALK'], regions=fleet.regions, migrate=True)
+
+    return [
+        f"{operation} planned {count} times, called {calls.get(operation, 0)} times"
+        for operation, count in planned.items() if count != calls.get(operation, 0)
+    ]
+
+
+def counted(calls, operation, handler):
+    def wrapper(region, params):
+        calls[operation] = calls.get(operation, 0) + 1
+        return handler(region, params)
+    return wrapper
+
+
+# Replacement instances follow DisableIMDSv1, not the instances an environment runs today
+def check_beanstalk_settings():
+    fleet = SyntheticFleet(regions=[REGION], instances=0, asgs=0, ecs_clusters=0, eks_clusters=0, notebooks=0, lightsail=0, beanstalk_environments=0)
+    fleet.add_beanstalk_environment(REGION, 'no-instances', 0, disable_imdsv1=False)
+    fixed = fleet.add_beanstalk_environment(REGION, 'instances-fixed', 2, disable_imdsv1=False)
+    for instance_id in fleet.beanstalk_environments[REGION][fixed]['InstanceIds']:
+        fleet.instances[REGION][instance_id]['MetadataOptions']['HttpTokens'] = 'required'
+    fleet.add_beanstalk_environment(REGION, 'already-disabled', 2, disable_imdsv1=True)
+
+    problems = list()
+    planner = Planner()
+    with served(fleet):
+        trigger_scan(services=['BEANSTALK'], regions=fleet.regions, migrate_templates=True, planner=planner)
+    planned = {change.resource: change.current for change in planner.changes if change.operation == 'elasticbeanstalk:UpdateEnvironment'}
+    if planned != {'no-instances': {'DisableIMDSv1': 'false'}, 'instances-fixed': {'DisableIMDSv1': 'false'}}:
+        problems.append(f"planned environment updates {planned}")
+
+    with served(fleet) as fake_aws:
+        calls = dict()
+        handler = fake_aws.handlers[('elasticbeanstalk', 'UpdateEnvironment')]
+        fake_aws.handlers[('elasticbeanstalk', 'UpdateEnvironment')] = counted(calls, 'elasticbeanstalk:UpdateEnvironment', handler)
+        trigger_scan(services=['BEANSTALK'], regions=fleet.regions, migrate_templates=True)
+    if calls.get('elasticbeanstalk:UpdateEnvironment', 0) != 2:
+        problems.append(f"{calls.get('elasticbeanstalk:UpdateEnvironment', 0)} environments updated, expected 2")
+    for environment in fleet.beanstalk_environments[REGION].values():
+        if environment['OptionSettings'][('aws:autoscaling:launchconfiguration', 'DisableIMDSv1')] != 'true':
+            problems.append(f"{environment['EnvironmentName']} still launches instances allowing IMDSv1")
+    return problems
+
+
+def check_synthetic_fleet(enable_imds):
+    return check_launch_templates(SyntheticFleet(regions=['check-region-1', 'check-region-2'], instances=0, asgs=40, eks_clusters=3,
+                                                 template_versions=4, shared_template_ratio=0.4, seed=7), enable_imds)
+
+
+# Clients polling /changes get what changed since the generation they last saw, netted over the
+# scans in between, or the whole inventory once that generation is no longer kept
+def check_changes_since():
+    fleet = SyntheticFleet(regions=[REGION], instances=3, asgs=0, ecs_clusters=0, eks_clusters=0, notebooks=0, lightsail=0, beanstalk_environments=0)
+    changed, removed, flipped = fleet.instances[REGION]
+    compliance_service = ComplianceService(['EC2'], regions=[REGION], region_cache_ttl=0)
+    compliance_service.changesets = collections.deque(maxlen=2)
+
+    def summary(changes):
+        return {
+            'full': changes['full'],
+            'added': sorted(resource['resource'] for resource in changes['added']),
+            'removed': sorted(resource['resource'] for resource in changes['removed']),
+            'changed': sorted((change['before']['resource'], change['before']['imdsv1'], change['after']['imdsv1']) for change in changes['changed']),
+        }
+
+    def tokens(instance_id):
+        return fleet.instances[REGION][instance_id]['MetadataOptions']['HttpTokens']
+
+    def set_tokens(instance_id, http_tokens):
+        fleet.instances[REGION][instance_id]['MetadataOptions']['HttpTokens'] = http_tokens
+
+    def opposite(instance_id):
+        return 'required' if tokens(instance_id) == 'optional' else 'optional'
+
+    with served(fleet):
+        compliance_service.scan()
+        changed_before, flipped_before = tokens(changed) == 'optional', tokens(flipped) == 'optional'
+        set_tokens(changed, opposite(changed))
+        set_tokens(flipped, opposite(flipped))
+        del fleet.instances[REGION][removed]
+        added = fleet.add_instance(REGION)
+        compliance_service.scan()
+        # Changed back, so clients that saw generation 1 have nothing to update for it
+        set_tokens(flipped, opposite(flipped))
+        compliance_service.scan()
+
+    expected = {
+        0: {'full': True, 'added': sorted([changed, flipped, added]), 'removed': [], 'changed': []},
+        1: {'full': False, 'added': [added], 'removed': [removed], 'changed': [(changed, changed_before, not changed_before)]},
+        2: {'full': False, 'added': [], 'removed': [], 'changed': [(flipped, not flipped_before, flipped_before)]},
+        3: {'full': False, 'added': [], 'removed': [], 'changed': []},
+    }
+    problems = list()
+    for generation, changes in expected.items():
+        found = summary(compliance_service.changes_since(generation))
+        if found != changes:
+            problems.append(f"changes since generation {generation}: {found}, expected {changes}")
+    return problems
+
+
+# Monday 2024-01-01 00:00 UTC
+WEEK_START = 1704067200
+DAY = 24 * 60 * 60
+
+
+def snapshot_resources(*resources):
+    return [api.Resource('EC2', region, resource, 'instance', imdsv1) for region, resource, imdsv1 in resources]
+
+
+# Account "a" migrates i-1 in its first week, then i-shared accepts IMDSv1 again in us-east-1 only,
+# while the instance with the same id in eu-west-1 accepted it all along
+def check_snapshot_history():
+    with tempfile.TemporaryDirectory() as directory:
+        save_snapshot(snapshot_resources(('us-east-1', 'i-1', True), ('us-east-1', 'i-2', False), ('us-east-1', 'i-shared', False),
+                                         ('eu-west-1', 'i-shared', True)), 'a', timestamp=WEEK_START + 3600, directory=directory)
+        save_snapshot(snapshot_resources(('us-east-1', 'i-1', False), ('us-east-1', 'i-2', False), ('us-east-1', 'i-shared', False),
+                                         ('eu-west-1', 'i-shared', True)), 'a', timestamp=WEEK_START + 2 * DAY, directory=directory)
+        save_snapshot(snapshot_resources(('eu-west-1', 'i-shared', True), ('us-east-1', 'i-1', False), ('us-east-1', 'i-2', False),
+                                         ('us-east-1', 'i-shared', True)), 'a', timestamp=WEEK_START + 8 * DAY, directory=directory)
+        save_snapshot(snapshot_resources(('us-east-1', 'i-1', True)), 'b', timestamp=WEEK_START + 3 * DAY, directory=directory)
+        # Resource ids are read from the files when regressions need them, so the directory stays until then
+        history = SnapshotHistory(directory)
+
+        problems = list()
+        # Each account's last snapshot of the week, week 1 of account "a" comes from its second snapshot
+        weekly_share = sorted(tuple(row.values()) for row in history.weekly_share())
+        expected = [
+            ('2024-01-01', 'a', 'eu-west-1', 1, 1, 1.0), ('2024-01-01', 'a', 'us-east-1', 3, 0, 0.0), ('2024-01-01', 'b', 'us-east-1', 1, 1, 1.0),
+            ('2024-01-08', 'a', 'eu-west-1', 1, 1, 1.0), ('2024-01-08', 'a', 'us-east-1', 3, 1, 1 / 3),
+        ]
+        if weekly_share != expected:
+            problems.append(f"weekly share {weekly_share}, expected {expected}")
+
+        velocity = sorted(tuple(row.values()) for row in history.velocity())
+        expected = [('a', 3, 2, -1 / 6, 0.0), ('b', 1, 1, None, None)]
+        if velocity != expected:
+            problems.append(f"velocity {velocity}, expected {expected}")
+
+        regressions = history.regressions()
+        expected = [{'account': 'a', 'region': 'us-east-1', 'resource': 'i-shared', 'since': '2024-01-03 00:00'}]
+        if regressions != expected:
+            problems.append(f"regressions {regressions}, expected {expected}")
+        return problems
+
+
+CHECKS = {
+    'explicit versions': check_explicit_versions,
+    '$Latest consumers planned': check_planned_consumers,
+    'plan, then apply': check_plan_then_apply,
+    'planned calls are made once': check_planned_calls,
+    'Beanstalk DisableIMDSv1': check_beanstalk_settings,
+    'synthetic fleet': lambda: check_synthetic_fleet(False),
+    'synthetic fleet, --enable-imds': lambda: check_synthetic_fleet(True),
+    'changes since a generation': check_changes_since,
+    'snapshot history': check_snapshot_history,
+}
+
+
+@click.command()
+def checks():
+    # The fake has no per-API rate limits to stay under
+    LIMITER.enabled = False
+
+    results_table = PrettyTable()
+    results_table.align = 'l'
+    results_table.field_names = ['Check', 'Result']
+
+    failed = False
+    for name, check in CHECKS.items():
+        problems = check()
+        failed = failed or bool(problems)
+        results_table.add_row([name, '\n'.join(problems) or 'passed'])
+
+    click.echo(f"[+] Behaviour checks:")
+    click.secho(results_table.get_string(), bold=True, fg='red' if failed else 'green')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    checks()
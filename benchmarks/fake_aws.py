@@ -0,0 +1,389 @@
+import random
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+
+# Serves a SyntheticFleet to botocore clients without touching the network. Responses are
+# returned from a "before-call" handler, the same short-circuit botocore's Stubber uses, so
+# the code under test runs unmodified. Throttled attempts are retried with backoff like
+# botocore's standard retry mode would.
+class FakeAWS():
+
+    def __init__(self, fleet, latency=0.0, region_latency=None, throttle_rate=0.0, max_attempts=3, seed=0) -> None:
+        self.fleet = fleet
+        self.latency = latency
+        self.region_latency = region_latency or dict()
+        self.throttle_rate = throttle_rate
+        self.max_attempts = max_attempts
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.attempts = 0
+        self.throttles = 0
+
+        self.handlers = {
+            ('ec2', 'DescribeRegions'): self.describe_regions,
+            ('ec2', 'DescribeInstances'): self.describe_instances,
+            ('ec2', 'ModifyInstanceMetadataOptions'): self.modify_instance_metadata_options,
+            ('ec2', 'GetInstanceMetadataDefaults'): self.get_instance_metadata_defaults,
+            ('ec2', 'ModifyInstanceMetadataDefaults'): self.modify_instance_metadata_defaults,
+            ('ec2', 'DescribeLaunchTemplateVersions'): self.describe_launch_template_versions,
+            ('ec2', 'CreateLaunchTemplateVersion'): self.create_launch_template_version,
+            ('ec2', 'ModifyLaunchTemplate'): self.modify_launch_template,
+            ('autoscaling', 'DescribeAutoScalingGroups'): self.describe_auto_scaling_groups,
+            ('autoscaling', 'UpdateAutoScalingGroup'): self.update_auto_scaling_group,
+            ('ecs', 'ListClusters'): self.ecs_list_clusters,
+            ('ecs', 'ListContainerInstances'): self.list_container_instances,
+            ('ecs', 'DescribeContainerInstances'): self.describe_container_instances,
+            ('eks', 'ListClusters'): self.eks_list_clusters,
+            ('eks', 'ListNodegroups'): self.list_nodegroups,
+            ('eks', 'DescribeNodegroup'): self.describe_nodegroup,
+            ('eks', 'UpdateNodegroupVersion'): self.update_nodegroup_version,
+            ('sagemaker', 'ListNotebookInstances'): self.list_notebook_instances,
+            ('sagemaker', 'DescribeNotebookInstance'): self.describe_notebook_instance,
+            ('sagemaker', 'UpdateNotebookInstance'): self.update_notebook_instance,
+            ('lightsail', 'GetInstances'): self.get_instances,
+            ('lightsail', 'UpdateInstanceMetadataOptions'): self.update_instance_metadata_options,
+            ('elasticbeanstalk', 'DescribeEnvironments'): self.describe_environments,
+            ('elasticbeanstalk', 'DescribeEnvironmentResources'): self.describe_environment_resources,
+            ('elasticbeanstalk', 'DescribeConfigurationSettings'): self.describe_configuration_settings,
+            ('elasticbeanstalk', 'UpdateEnvironment'): self.update_environment,
+            ('cloudwatch', 'GetMetricData'): self.get_metric_data,
+        }
+
+
+    def install(self, client):
+        if client is None:
+            return client
+
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        client.meta.events.register_first('before-parameter-build.*.*', self.capture_params)
+        client.meta.events.register('before-call.*.*', lambda model, context, **kwargs: self.respond(service, region, model, context))
+        return client
+
+
+    def capture_params(self, params, context, **kwargs):
+        context['fake_aws_params'] = dict(params)
+
+
+    def respond(self, service, region, model, context):
+        handler = self.handlers.get((service, model.name))
+        if handler is None:
+            return self.error(400, 'UnsupportedOperation', f"{service}:{model.name} is not simulated")
+
+        retries = 0
+        while True:
+            with self.lock:
+                self.attempts += 1
+                throttled = self.random.random() < self.throttle_rate
+                self.throttles += 1 if throttled else 0
+
+            time.sleep(self.region_latency.get(region, self.latency))
+
+            if not throttled:
+                break
+            if retries + 1 >= self.max_attempts:
+                return self.error(400, 'Throttling', 'Rate exceeded', retries)
+
+            time.sleep(min(self.random.random() * 2 ** retries * 0.05, 1))
+            retries += 1
+
+        parsed = handler(region, context.get('fake_aws_params', dict()))
+        if 'Error' in parsed:
+            return self.error(400, parsed['Error']['Code'], parsed['Error']['Message'], retries)
+
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': retries}
+        return AWSResponse(None, 200, {}, None), parsed
+
+
+    def error(self, status_code, code, message, retries=0):
+        parsed = {
+            'Error': {'Code': code, 'Message': message},
+            'ResponseMetadata': {'HTTPStatusCode': status_code, 'RetryAttempts': retries},
+        }
+        return AWSResponse(None, status_code, {}, None), parsed
+
+
+    def page(self, items, token, page_size):
+        start = int(token or 0)
+        end = start + page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+
+    def describe_regions(self, region, params):
+        return {'Regions': [{'RegionName': name, 'OptInStatus': 'opt-in-not-required'} for name in self.fleet.regions]}
+
+
+    def describe_instances(self, region, params):
+        instances = self.fleet.instances.get(region, dict())
+        if params.get('InstanceIds'):
+            missing = [instance_id for instance_id in params['InstanceIds'] if instance_id not in instances]
+            if missing:
+                return {'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': f"The instance IDs '{', '.join(missing)}' do not exist"}}
+            selected = [instances[instance_id] for instance_id in params['InstanceIds']]
+        elif params.get('Filters'):
+            instance_ids = [instance_id for item in params['Filters'] if item['Name'] == 'instance-id' for instance_id in item['Values']]
+            selected = [instances[instance_id] for instance_id in instance_ids if instance_id in instances]
+        else:
+            selected = list(instances.values())
+
+        selected, token = self.page(selected, params.get('NextToken'), params.get('MaxResults', 1000))
+        response = {'Reservations': [{'ReservationId': f"r-{instance['InstanceId'][2:]}", 'Instances': [dict(instance)]} for instance in selected]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+    def modify_instance_metadata_options(self, region, params):
+        instance = self.fleet.instances.get(region, dict()).get(params['InstanceId'])
+        if instance is None:
+            return {'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': f"The instance ID '{params['InstanceId']}' does not exist"}}
+
+        options = dict(instance['MetadataOptions'])
+        for key in ['HttpTokens', 'HttpPutResponseHopLimit', 'HttpEndpoint', 'HttpProtocolIpv6', 'InstanceMetadataTags']:
+            if key in params:
+                options[key] = params[key]
+        instance['MetadataOptions'] = options
+        return {'InstanceId': instance['InstanceId'], 'InstanceMetadataOptions': options}
+
+
+    def get_instance_metadata_defaults(self, region, params):
+        return {'AccountLevel': dict(self.fleet.account_defaults[region])}
+
+
+    def modify_instance_metadata_defaults(self, region, params):
+        for key in ['HttpTokens', 'HttpPutResponseHopLimit', 'HttpEndpoint', 'InstanceMetadataTags']:
+            if key in params:
+                self.fleet.account_defaults[region][key] = params[key]
+        return {'Return': True}
+
+
+    def launch_template(self, region, params):
+        template = self.fleet.launch_templates.get(params.get('LaunchTemplateId'))
+        if template is None or template['region'] != region:
+            return None
+        return template
+
+
+    def describe_launch_template_versions(self, region, params):
+        template = self.launch_template(region, params)
+        if template is None:
+            return {'Error': {'Code': 'InvalidLaunchTemplateId.NotFound', 'Message': f"The launch template '{params.get('LaunchTemplateId')}' does not exist"}}
+
+        selected = list()
+        for requested in params.get('Versions') or [str(version['VersionNumber']) for version in template['versions']]:
+            if requested == '$Latest':
+                number = len(template['versions'])
+            elif requested == '$Default':
+                number = template['default']
+            else:
+                number = int(requested)
+            selected.append(number)
+
+        return {
+            'LaunchTemplateVersions': [
+                dict(template['versions'][number - 1], DefaultVersion=number == template['default'])
+                for number in sorted(set(selected))
+            ]
+        }
+
+
+    def create_launch_template_version(self, region, params):
+        template = self.launch_template(region, params)
+        if template is None:
+            return {'Error': {'Code': 'InvalidLaunchTemplateId.NotFound', 'Message': f"The launch template '{params.get('LaunchTemplateId')}' does not exist"}}
+
+        source = template['versions'][int(params.get('SourceVersion', template['default'])) - 1]
+        data = dict(source['LaunchTemplateData'])
+        data.update(params['LaunchTemplateData'])
+        version = dict(source, VersionNumber=len(template['versions']) + 1, LaunchTemplateData=data)
+        template['versions'].append(version)
+        return {'LaunchTemplateVersion': version}
+
+
+    def modify_launch_template(self, region, params):
+        template = self.launch_template(region, params)
+        template['default'] = int(params['DefaultVersion'])
+        return {'LaunchTemplate': {'LaunchTemplateId': params['LaunchTemplateId'], 'DefaultVersionNumber': template['default']}}
+
+
+    def update_auto_scaling_group(self, region, params):
+        as_group = self.fleet.asgs[region][params['AutoScalingGroupName']]
+        if 'LaunchTemplate' in params:
+            as_group['LaunchTemplate'] = params['LaunchTemplate']
+        return {}
+
+
+    def describe_auto_scaling_groups(self, region, params):
+        asgs = self.fleet.asgs.get(region, dict())
+        names = params.get('AutoScalingGroupNames') or list(asgs)
+        groups = [asgs[name] for name in names if name in asgs]
+        groups, token = self.page(groups, params.get('NextToken'), params.get('MaxRecords', 50))
+        response = {'AutoScalingGroups': groups}
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+    def ecs_list_clusters(self, region, params):
+        clusters, token = self.page(list(self.fleet.ecs_clusters.get(region, dict())), params.get('nextToken'), params.get('maxResults', 100))
+        response = {'clusterArns': clusters}
+        if token:
+            response['nextToken'] = token
+        return response
+
+
+    def list_container_instances(self, region, params):
+        instance_ids = self.fleet.ecs_clusters.get(region, dict()).get(params['cluster'], list())
+        arns = [f"{params['cluster']}/container-instance/{instance_id}" for instance_id in instance_ids]
+        arns, token = self.page(arns, params.get('nextToken'), params.get('maxResults', 100))
+        response = {'containerInstanceArns': arns}
+        if token:
+            response['nextToken'] = token
+        return response
+
+
+    def describe_container_instances(self, region, params):
+        return {
+            'containerInstances': [
+                {'containerInstanceArn': arn, 'ec2InstanceId': arn.rsplit('/', 1)[-1]}
+                for arn in params['containerInstances']
+            ],
+            'failures': [],
+        }
+
+
+    def eks_list_clusters(self, region, params):
+        clusters, token = self.page(list(self.fleet.eks_clusters.get(region, dict())), params.get('nextToken'), params.get('maxResults', 100))
+        response = {'clusters': clusters}
+        if token:
+            response['nextToken'] = token
+        return response
+
+
+    def list_nodegroups(self, region, params):
+        nodegroups = list(self.fleet.eks_clusters.get(region, dict()).get(params['clusterName'], dict()))
+        nodegroups, token = self.page(nodegroups, params.get('nextToken'), params.get('maxResults', 100))
+        response = {'nodegroups': nodegroups}
+        if token:
+            response['nextToken'] = token
+        return response
+
+
+    def describe_nodegroup(self, region, params):
+        nodegroup = self.fleet.eks_clusters[region][params['clusterName']][params['nodegroupName']]
+        response = {
+            'nodegroup': {
+                'nodegroupName': params['nodegroupName'],
+                'clusterName': params['clusterName'],
+                'resources': {'autoScalingGroups': [{'name': nodegroup['asg_name']}]},
+            }
+        }
+        if nodegroup['launchTemplate']:
+            response['nodegroup']['launchTemplate'] = dict(nodegroup['launchTemplate'])
+        return response
+
+
+    def update_nodegroup_version(self, region, params):
+        nodegroup = self.fleet.eks_clusters[region][params['clusterName']][params['nodegroupName']]
+        nodegroup['launchTemplate'] = dict(nodegroup['launchTemplate'], **params['launchTemplate'])
+        return {'update': {'id': f"update-{params['nodegroupName']}", 'status': 'InProgress', 'type': 'VersionUpdate'}}
+
+
+    def list_notebook_instances(self, region, params):
+        names, token = self.page(list(self.fleet.notebooks.get(region, dict())), params.get('NextToken'), params.get('MaxResults', 100))
+        response = {'NotebookInstances': [{'NotebookInstanceName': name, 'NotebookInstanceStatus': 'InService'} for name in names]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+    def describe_notebook_instance(self, region, params):
+        return {
+            'NotebookInstanceName': params['NotebookInstanceName'],
+            'InstanceMetadataServiceConfiguration': {
+                'MinimumInstanceMetadataServiceVersion': self.fleet.notebooks[region][params['NotebookInstanceName']]
+            },
+        }
+
+
+    def update_notebook_instance(self, region, params):
+        version = params.get('InstanceMetadataServiceConfiguration', dict()).get('MinimumInstanceMetadataServiceVersion')
+        if version:
+            self.fleet.notebooks[region][params['NotebookInstanceName']] = version
+        return {}
+
+
+    def get_instances(self, region, params):
+        instances, token = self.page(list(self.fleet.lightsail.get(region, dict()).values()), params.get('pageToken'), 50)
+        response = {'instances': instances}
+        if token:
+            response['nextPageToken'] = token
+        return response
+
+
+    def update_instance_metadata_options(self, region, params):
+        instance = self.fleet.lightsail[region][params['instanceName']]
+        for key in ['httpTokens', 'httpPutResponseHopLimit', 'httpEndpoint', 'httpProtocolIpv6']:
+            if key in params:
+                instance['metadataOptions'][key] = params[key]
+        return {'operations': [{'resourceName': params['instanceName'], 'status': 'Succeeded'}]}
+
+
+    def describe_environments(self, region, params):
+        environments = list(self.fleet.beanstalk_environments.get(region, dict()).values())
+        environments, token = self.page(environments, params.get('NextToken'), params.get('MaxRecords', 1000))
+        response = {
+            'Environments': [
+                {key: environment[key] for key in ['EnvironmentId', 'EnvironmentName', 'ApplicationName', 'Status']}
+                for environment in environments
+            ]
+        }
+        if token:
+            response['NextToken'] = token
+        return response
+
+
+    def describe_environment_resources(self, region, params):
+        environment = self.fleet.beanstalk_environments[region][params['EnvironmentId']]
+        return {
+            'EnvironmentResources': {
+                'EnvironmentName': environment['EnvironmentName'],
+                'AutoScalingGroups': [{'Name': f"awseb-{environment['EnvironmentId']}"}],
+                'Instances': [{'Id': instance_id} for instance_id in environment['InstanceIds']],
+                'LaunchConfigurations': [],
+                'LaunchTemplates': [],
+                'LoadBalancers': [],
+                'Triggers': [],
+                'Queues': [],
+            }
+        }
+
+
+    def describe_configuration_settings(self, region, params):
+        for environment in self.fleet.beanstalk_environments.get(region, dict()).values():
+            if environment['EnvironmentName'] == params.get('EnvironmentName') and environment['ApplicationName'] == params['ApplicationName']:
+                return {
+                    'ConfigurationSettings': [{
+                        'ApplicationName': environment['ApplicationName'],
+                        'EnvironmentName': environment['EnvironmentName'],
+                        'OptionSettings': [
+                            {'Namespace': namespace, 'OptionName': name, 'Value': value}
+                            for (namespace, name), value in environment['OptionSettings'].items()
+                        ],
+                    }]
+                }
+        return {'Error': {'Code': 'InvalidParameterValue', 'Message': f"No Environment found for EnvironmentName = '{params.get('EnvironmentName')}'."}}
+
+
+    def update_environment(self, region, params):
+        environment = self.fleet.beanstalk_environments[region][params['EnvironmentId']]
+        for option in params.get('OptionSettings', []):
+            environment['OptionSettings'][(option['Namespace'], option['OptionName'])] = option['Value']
+        return {key: environment[key] for key in ['EnvironmentId', 'EnvironmentName', 'ApplicationName']}
+
+
+    def get_metric_data(self, region, params):
+        return {'MetricDataResults': [{'Id': query['Id'], 'Values': [], 'StatusCode': 'Complete'} for query in params['MetricDataQueries']]}
@@ -0,0 +1,207 @@
+import random
+
+
+class SyntheticFleet():
+
+    def __init__(self, regions=None, instances=1000, asgs=10, asg_size=10, ecs_clusters=5, ecs_cluster_size=10,
+                 eks_clusters=2, eks_nodegroups=3, nodegroup_size=10, notebooks=20, lightsail=50,
+                 beanstalk_environments=5, beanstalk_environment_size=4, template_versions=3, shared_template_ratio=0.2,
+                 imdsv1_ratio=0.6, disabled_ratio=0.05, hop_limit_1_ratio=0.4, seed=0) -> None:
+        self.regions = regions or ['us-east-1', 'eu-west-1']
+        self.random = random.Random(seed)
+        self.imdsv1_ratio = imdsv1_ratio
+        self.disabled_ratio = disabled_ratio
+        self.hop_limit_1_ratio = hop_limit_1_ratio
+        self.template_versions = template_versions
+        self.shared_template_ratio = shared_template_ratio
+        self.instance_counter = 0
+        self.last_template_id = None
+        # launch template id -> {'LaunchTemplateName', 'region', 'default', 'versions'}
+        self.launch_templates = dict()
+
+        self.instances = dict()
+        self.account_defaults = dict()
+        self.asgs = dict()
+        self.ecs_clusters = dict()
+        self.eks_clusters = dict()
+        self.notebooks = dict()
+        self.lightsail = dict()
+        self.beanstalk_environments = dict()
+
+        for region in self.regions:
+            self.instances[region] = dict()
+            # Most accounts never set their defaults, the rest half way
+            self.account_defaults[region] = dict() if self.random.random() < 0.7 else {'HttpTokens': 'optional', 'HttpPutResponseHopLimit': 1}
+            self.asgs[region] = dict()
+            self.ecs_clusters[region] = dict()
+            self.eks_clusters[region] = dict()
+            self.notebooks[region] = dict()
+            self.lightsail[region] = dict()
+            self.beanstalk_environments[region] = dict()
+
+            for _ in range(instances):
+                self.add_instance(region)
+
+            for index in range(asgs):
+                # Some groups share the previous group's template, pinned to the same or another version
+                shared = index and self.random.random() < self.shared_template_ratio
+                self.add_asg(region, f"asg-{index}", asg_size, template_id=self.last_template_id if shared else None)
+
+            for index in range(ecs_clusters):
+                arn = f"arn:aws:ecs:{region}:111111111111:cluster/cluster-{index}"
+                self.ecs_clusters[region][arn] = [self.add_instance(region) for _ in range(ecs_cluster_size)]
+
+            for index in range(eks_clusters):
+                cluster = f"eks-{index}"
+                self.eks_clusters[region][cluster] = dict()
+                for nodegroup_index in range(eks_nodegroups):
+                    nodegroup = f"nodegroup-{nodegroup_index}"
+                    asg_name = f"eks-{cluster}-{nodegroup}"
+                    launch_template = self.add_asg(region, asg_name, nodegroup_size, nodegroup=nodegroup)
+                    # Roughly a third of nodegroups run on the EKS managed launch template
+                    self.eks_clusters[region][cluster][nodegroup] = {
+                        'asg_name': asg_name,
+                        'launchTemplate': launch_template if nodegroup_index % 3 else None,
+                    }
+
+            for index in range(notebooks):
+                name = f"notebook-{index}"
+                self.notebooks[region][name] = "1" if self.random.random() < self.imdsv1_ratio else "2"
+
+            for index in range(lightsail):
+                name = f"lightsail-{index}"
+                self.lightsail[region][name] = {
+                    'name': name,
+                    'location': {'availabilityZone': f"{region}a", 'regionName': region},
+                    'metadataOptions': self.metadata_options(lowercase=True),
+                }
+
+
+            for index in range(beanstalk_environments):
+                self.add_beanstalk_environment(region, f"environment-{index}", beanstalk_environment_size)
+
+
+    def metadata_options(self, lowercase=False):
+        options = {
+            'HttpTokens': 'optional' if self.random.random() < self.imdsv1_ratio else 'required',
+            'HttpPutResponseHopLimit': 1 if self.random.random() < self.hop_limit_1_ratio else 2,
+            'HttpEndpoint': 'disabled' if self.random.random() < self.disabled_ratio else 'enabled',
+            'HttpProtocolIpv6': 'disabled',
+            'InstanceMetadataTags': 'disabled',
+            'State': 'applied',
+        }
+        if lowercase:
+            options = {key[0].lower() + key[1:]: value for key, value in options.items() if key != 'InstanceMetadataTags'}
+        return options
+
+
+    def add_instance(self, region):
+        self.instance_counter += 1
+        instance_id = f"i-{self.instance_counter:017x}"
+        self.instances[region][instance_id] = {
+            'InstanceId': instance_id,
+            'InstanceType': 't3.micro',
+            'State': {'Code': 16, 'Name': 'running'},
+            'Placement': {'AvailabilityZone': f"{region}a"},
+            'MetadataOptions': self.metadata_options(),
+        }
+        return instance_id
+
+
+    # Every version gets its own image, so what a consumer launches can be told apart by version
+    def add_beanstalk_environment(self, region, name, size, disable_imdsv1=None):
+        environment_id = f"e-{region}-{len(self.beanstalk_environments[region])}"
+        self.beanstalk_environments[region][environment_id] = {
+            'EnvironmentId': environment_id,
+            'EnvironmentName': name,
+            'ApplicationName': 'application',
+            'Status': 'Ready',
+            'InstanceIds': [self.add_instance(region) for _ in range(size)],
+            'OptionSettings': dict(),
+        }
+        if disable_imdsv1 is None:
+            disable_imdsv1 = self.random.random() >= self.imdsv1_ratio
+        self.beanstalk_environments[region][environment_id]['OptionSettings'][('aws:autoscaling:launchconfiguration', 'DisableIMDSv1')] = str(disable_imdsv1).lower()
+        return environment_id
+
+
+    def add_launch_template(self, region, name, versions=1, default=None):
+        template_id = f"lt-{len(self.launch_templates) + 1:017x}"
+        self.launch_templates[template_id] = {
+            'LaunchTemplateName': name,
+            'region': region,
+            'default': default or self.random.randint(1, versions),
+            'versions': list(),
+        }
+        # Described versions report a State in their metadata options, like EC2 does
+        for _ in range(versions):
+            self.add_launch_template_version(template_id, self.metadata_options())
+        self.last_template_id = template_id
+        return template_id
+
+
+    def add_launch_template_version(self, template_id, metadata_options):
+        template = self.launch_templates[template_id]
+        number = len(template['versions']) + 1
+        template['versions'].append({
+            'LaunchTemplateId': template_id,
+            'LaunchTemplateName': template['LaunchTemplateName'],
+            'VersionNumber': number,
+            'LaunchTemplateData': {'ImageId': f"ami-{template_id[3:]}-{number}", 'InstanceType': 't3.micro', 'MetadataOptions': metadata_options},
+        })
+        return number
+
+
+    def resolve_version(self, template_id, version):
+        template = self.launch_templates[template_id]
+        if version == '$Latest':
+            return template['versions'][-1]
+        if version == '$Default':
+            return template['versions'][template['default'] - 1]
+        return template['versions'][int(version) - 1]
+
+
+    # The launch template version new instances of an Auto Scaling group or nodegroup start from
+    def launched_version(self, region, name):
+        as_group = self.asgs[region][name]
+        specification = as_group.get('LaunchTemplate') or as_group['MixedInstancesPolicy']['LaunchTemplate']['LaunchTemplateSpecification']
+        for cluster in self.eks_clusters[region].values():
+            for nodegroup in cluster.values():
+                if nodegroup['asg_name'] == name and nodegroup['launchTemplate']:
+                    specification = {'LaunchTemplateId': nodegroup['launchTemplate']['id'], 'Version': nodegroup['launchTemplate']['version']}
+        return self.resolve_version(specification['LaunchTemplateId'], specification.get('Version', '$Default'))
+
+
+    def add_asg(self, region, name, size, nodegroup=None, template_id=None, version=None):
+        template_id = template_id or self.add_launch_template(region, f"{name}-template", versions=self.random.randint(1, self.template_versions))
+        versions = len(self.launch_templates[template_id]['versions'])
+        version = version or self.random.choice(['$Latest', '$Default', str(self.random.randint(1, versions))])
+        tags = [{'Key': 'eks:nodegroup-name', 'Value': nodegroup}] if nodegroup else []
+        self.asgs[region][name] = {
+            'AutoScalingGroupName': name,
+            'LaunchTemplate': {'LaunchTemplateId': template_id, 'Version': version},
+            'Tags': tags,
+            'MinSize': 0,
+            'MaxSize': size,
+            'DesiredCapacity': size,
+            'Instances': [
+                {'InstanceId': self.add_instance(region), 'LifecycleState': 'InService', 'HealthStatus': 'Healthy'}
+                for _ in range(size)
+            ],
+        }
+        # Nodegroups always reference a version number
+        return {'id': template_id, 'name': self.launch_templates[template_id]['LaunchTemplateName'], 'version': str(self.random.randint(1, versions))}
+
+
+    def summary(self):
+        return {
+            'regions': len(self.regions),
+            'instances': sum(len(instances) for instances in self.instances.values()),
+            'asgs': sum(len(asgs) for asgs in self.asgs.values()),
+            'launch_templates': len(self.launch_templates),
+            'ecs_clusters': sum(len(clusters) for clusters in self.ecs_clusters.values()),
+            'eks_nodegroups': sum(len(nodegroups) for clusters in self.eks_clusters.values() for nodegroups in clusters.values()),
+            'notebooks': sum(len(notebooks) for notebooks in self.notebooks.values()),
+            'lightsail': sum(len(instances) for instances in self.lightsail.values()),
+            'beanstalk_environments': sum(len(environments) for environments in self.beanstalk_environments.values()),
+        }
@@ -0,0 +1,255 @@
+import click
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from datetime import datetime
+from prettytable import PrettyTable
+
+# Clients are created for real, they just never leave the process
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from IMDShift.AWS import AWS_Utils, EC2, ECS, EKS, ASG, LaunchTemplates, Sagemaker, Lightsail, Beanstalk
+from IMDShift.resilience import GUARD
+from IMDShift.telemetry import TELEMETRY
+from IMDShift.throttling import LIMITER
+from IMDShift.utilities import trigger_scan
+
+from .fake_aws import FakeAWS
+from .fleet import SyntheticFleet
+
+
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.jsonl')
+
+SCENARIOS = ['EC2', 'ECS', 'EKS', 'ASG', 'SAGEMAKER', 'LIGHTSAIL', 'BEANSTALK', 'TRIGGER_SCAN']
+
+
+def run_scenario(scenario, regions, migrate, max_concurrency=1):
+    if scenario == 'EC2':
+        ec2_obj = EC2(regions=regions)
+        ec2_obj.generate_result()
+        if migrate:
+            ec2_obj.set_account_defaults(2)
+            ec2_obj.migrate_resources(2)
+
+    elif scenario == 'ECS':
+        ec2_obj = EC2(regions=None)
+        ECS(regions=regions, ec2_obj=ec2_obj).generate_results()
+        if migrate:
+            ec2_obj.migrate_resources(2)
+
+    elif scenario in ['EKS', 'ASG']:
+        ec2_obj = EC2(regions=None)
+        launch_templates_obj = LaunchTemplates()
+        scanner = {'EKS': EKS, 'ASG': ASG}[scenario](regions=regions, ec2_obj=ec2_obj, launch_templates=launch_templates_obj)
+        scanner.generate_results()
+        if migrate:
+            ec2_obj.migrate_resources(2)
+            launch_templates_obj.migrate_launch_templates(2)
+
+    elif scenario == 'SAGEMAKER':
+        sagemaker_obj = Sagemaker(regions=regions)
+        sagemaker_obj.generate_result()
+        if migrate:
+            sagemaker_obj.migrate_resources()
+
+    elif scenario == 'LIGHTSAIL':
+        lightsail_obj = Lightsail(regions=regions)
+        lightsail_obj.generate_result()
+        if migrate:
+            lightsail_obj.migrate_resources(2)
+
+    elif scenario == 'BEANSTALK':
+        ec2_obj = EC2(regions=None)
+        beanstalk_obj = Beanstalk(regions=regions, ec2_obj=ec2_obj)
+        beanstalk_obj.generate_results()
+        if migrate:
+            ec2_obj.migrate_resources(2)
+            beanstalk_obj.migrate_environments()
+
+    elif scenario == 'TRIGGER_SCAN':
+        trigger_scan(services=['EC2', 'SAGEMAKER', 'ASG', 'LIGHTSAIL', 'ECS', 'EKS', 'BEANSTALK'], regions=regions, migrate=migrate, migrate_templates=migrate, set_account_defaults=migrate, max_concurrency=max_concurrency)
+
+
+def measure(scenario, fleet_options, fake_options, migrate, trace_memory, max_concurrency=1):
+    fleet = SyntheticFleet(**fleet_options)
+    fake_aws = FakeAWS(fleet, **fake_options)
+    AWS_Utils.register_client_hook(fake_aws.install)
+    TELEMETRY.reset()
+    GUARD.reset()
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            run_scenario(scenario, fleet.regions, migrate, max_concurrency)
+    finally:
+        wall_time = time.perf_counter() - start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        AWS_Utils.unregister_client_hook(fake_aws.install)
+
+    operations = dict()
+    for (service, operation, region), stats in TELEMETRY.api_calls.items():
+        operations[f"{service}:{operation}"] = operations.get(f"{service}:{operation}", 0) + stats['calls']
+
+    return {
+        'wall_time': wall_time,
+        'api_calls': sum(operations.values()),
+        'attempts': fake_aws.attempts,
+        'throttles': fake_aws.throttles,
+        'peak_memory': peak_memory,
+        'operations': operations,
+        'phases': dict(TELEMETRY.phases),
+    }
+
+
+def load_history(path):
+    history = list()
+    if os.path.exists(path):
+        with open(path) as history_file:
+            for line in history_file:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(result, baseline, tolerance):
+    regressions = list()
+    for scenario, metrics in result.items():
+        previous = baseline.get(scenario)
+        if previous is None:
+            continue
+
+        if metrics['wall_time'] > previous['wall_time'] * (1 + tolerance):
+            regressions.append((scenario, 'wall_time', previous['wall_time'], metrics['wall_time']))
+        if metrics['api_calls'] > previous['api_calls']:
+            regressions.append((scenario, 'api_calls', previous['api_calls'], metrics['api_calls']))
+        if metrics['peak_memory'] and previous.get('peak_memory') and metrics['peak_memory'] > previous['peak_memory'] * (1 + tolerance):
+            regressions.append((scenario, 'peak_memory', previous['peak_memory'], metrics['peak_memory']))
+    return regressions
+
+
+@click.command()
+@click.option('--scenarios', type=str, default=','.join(SCENARIOS), help=f'Comma separated scenarios to run from [{", ".join(SCENARIOS)}].')
+@click.option('--regions', type=int, default=2, help='Number of synthetic regions.')
+@click.option('--instances', type=int, default=1000, help='Standalone EC2 instances per region.')
+@click.option('--asgs', type=int, default=10, help='Auto Scaling groups per region.')
+@click.option('--asg-size', type=int, default=10, help='Instances per Auto Scaling group.')
+@click.option('--ecs-clusters', type=int, default=5, help='ECS clusters per region.')
+@click.option('--ecs-cluster-size', type=int, default=10, help='Container instances per ECS cluster.')
+@click.option('--eks-clusters', type=int, default=2, help='EKS clusters per region.')
+@click.option('--eks-nodegroups', type=int, default=3, help='Managed nodegroups per EKS cluster.')
+@click.option('--nodegroup-size', type=int, default=10, help='Instances per EKS nodegroup.')
+@click.option('--notebooks', type=int, default=20, help='Sagemaker notebook instances per region.')
+@click.option('--lightsail', type=int, default=50, help='Lightsail instances per region.')
+@click.option('--beanstalk-environments', type=int, default=5, help='Beanstalk environments per region.')
+@click.option('--beanstalk-environment-size', type=int, default=4, help='Instances per Beanstalk environment.')
+@click.option('--latency-ms', type=float, default=5.0, help='Injected latency per API attempt, in milliseconds.')
+@click.option('--slow-region-latency-ms', type=float, default=None, help='Injected latency for the last region, to simulate one slow region.')
+@click.option('--throttle-rate', type=float, default=0.0, help='Probability of an API attempt being throttled.')
+@click.option('--max-concurrency', type=int, default=4, help='Services run at once by the TRIGGER_SCAN scenario.')
+@click.option('--migrate', is_flag=True, default=False, help='Also run the mutation paths against the synthetic fleet.')
+@click.option('--no-memory', is_flag=True, default=False, help='Skip the separate tracemalloc run used to measure peak memory.')
+@click.option('--history-file', type=str, default=HISTORY_FILE, help='JSON lines file used to track results over time.')
+@click.option('--save', is_flag=True, default=False, help='Append this run to the history file.')
+@click.option('--tolerance', type=float, default=0.2, help='Relative wall time and memory increase tolerated before reporting a regression.')
+@click.option('--fail-on-regression', is_flag=True, default=False, help='Exit with status 1 if a regression is detected.')
+def benchmark(scenarios, regions, instances, asgs, asg_size, ecs_clusters, ecs_cluster_size, eks_clusters, eks_nodegroups,
+              nodegroup_size, notebooks, lightsail, beanstalk_environments, beanstalk_environment_size, latency_ms, slow_region_latency_ms, throttle_rate, max_concurrency, migrate, no_memory,
+              history_file, save, tolerance, fail_on_regression):
+    region_names = [f"bench-region-{index + 1}" for index in range(regions)]
+    fleet_options = dict(regions=region_names, instances=instances, asgs=asgs, asg_size=asg_size, ecs_clusters=ecs_clusters,
+                         ecs_cluster_size=ecs_cluster_size, eks_clusters=eks_clusters, eks_nodegroups=eks_nodegroups,
+                         nodegroup_size=nodegroup_size, notebooks=notebooks, lightsail=lightsail,
+                         beanstalk_environments=beanstalk_environments, beanstalk_environment_size=beanstalk_environment_size)
+    fake_options = dict(latency=latency_ms / 1000, throttle_rate=throttle_rate)
+    if slow_region_latency_ms is not None:
+        fake_options['region_latency'] = {region_names[-1]: slow_region_latency_ms / 1000}
+
+    config = dict(fleet=fleet_options, latency_ms=latency_ms, slow_region_latency_ms=slow_region_latency_ms,
+                  throttle_rate=throttle_rate, migrate=migrate, max_concurrency=max_concurrency)
+
+    TELEMETRY.enable()
+    # The fake has no per-API rate limits to stay under, throttling is simulated with --throttle-rate instead
+    LIMITER.enabled = False
+    click.echo(f"[+] Synthetic fleet: {SyntheticFleet(**fleet_options).summary()}")
+
+    result = dict()
+    for scenario in [scenario.strip().upper() for scenario in scenarios.split(',')]:
+        if scenario not in SCENARIOS:
+            click.secho(f"[!] Unknown scenario {scenario}, skipping.", bold=True, fg='red')
+            continue
+
+        click.echo(f"[+] Running {scenario}")
+        result[scenario] = measure(scenario, fleet_options, fake_options, migrate, trace_memory=False, max_concurrency=max_concurrency)
+        if not no_memory:
+            result[scenario]['peak_memory'] = measure(scenario, fleet_options, fake_options, migrate, trace_memory=True, max_concurrency=max_concurrency)['peak_memory']
+
+    baseline = None
+    for record in reversed(load_history(history_file)):
+        if record['config'] == config:
+            baseline = record
+            break
+
+    results_table = PrettyTable()
+    results_table.align = 'c'
+    results_table.valign = 'c'
+    results_table.field_names = ['Scenario', 'Wall Time (s)', 'Baseline (s)', 'API Calls', 'Attempts', 'Throttles', 'Peak Memory (MiB)']
+
+    for scenario, metrics in result.items():
+        previous = baseline['results'].get(scenario) if baseline else None
+        results_table.add_row(
+            [
+                scenario,
+                round(metrics['wall_time'], 3),
+                round(previous['wall_time'], 3) if previous else '-',
+                metrics['api_calls'],
+                metrics['attempts'],
+                metrics['throttles'],
+                round(metrics['peak_memory'] / 2 ** 20, 2) if metrics['peak_memory'] else '-'
+            ]
+        )
+
+    click.echo(f"[+] Benchmark results:")
+    click.secho(results_table.get_string(), bold=True, fg='yellow')
+
+    regressions = find_regressions(result, baseline['results'], tolerance) if baseline else list()
+    if baseline:
+        click.echo(f"[+] Compared against run from {baseline['timestamp']} (revision {baseline['revision']})")
+    for scenario, metric, previous, current in regressions:
+        click.secho(f"[!] Regression in {scenario}: {metric} went from {previous} to {current}", bold=True, fg='red')
+
+    if save:
+        with open(history_file, 'a') as history:
+            history.write(json.dumps({
+                'timestamp': datetime.utcnow().isoformat(),
+                'revision': git_revision(),
+                'config': config,
+                'results': result,
+            }) + '\n')
+        click.echo(f"[+] Results appended to {history_file}")
+
+    if regressions and fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
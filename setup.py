@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name='IMDShift',
     version='1.0.0',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     include_package_data=True,
     install_requires=[
         'click',
@@ -11,6 +11,9 @@ setup(
         'boto3',
         'prettytable'
     ],
+    extras_require={
+        'stats': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
             'imdshift = IMDShift.imdshift:cli_handler',